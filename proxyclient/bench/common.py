@@ -0,0 +1,145 @@
+# SPDX-License-Identifier: MIT
+# Shared helpers for the benchmark scripts in this directory: connecting to a
+# real target or a local stand-in (m1n1.sim), timing loops and JSON results.
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+
+import json, os, platform, statistics, subprocess, time
+
+from m1n1.proxy import UartInterface, M1N1Proxy
+from m1n1.proxyutils import ProxyUtils, bootstrap_port
+from m1n1.sim import SimTarget
+
+__all__ = ["add_args", "connect", "Results", "summary", "time_op", "time_xfer"]
+
+def add_args(parser):
+    parser.add_argument('--sim', action="store_true",
+                        help="Run against a local stand-in target instead of M1N1DEVICE")
+    parser.add_argument('--sim-latency', type=float, default=0, metavar="SECONDS",
+                        help="Per-command latency of the stand-in target")
+    parser.add_argument('-o', '--output', type=pathlib.Path,
+                        help="Write JSON results to this file ('-' for stdout)")
+    parser.add_argument('-k', '--only', action="append", default=[], metavar="SUBSTR",
+                        help="Only run benchmarks whose name contains SUBSTR")
+    parser.add_argument('-r', '--rounds', type=int, default=5,
+                        help="Timing rounds per benchmark")
+    parser.add_argument('-q', '--quick', action="store_true",
+                        help="Fewer iterations and smaller sizes")
+    parser.add_argument('-l', '--label', type=str, default=None,
+                        help="Free-form label stored in the results")
+
+class Target:
+    def __init__(self, iface, p, u, sim=None):
+        self.iface = iface
+        self.p = p
+        self.u = u
+        self.sim = sim
+
+def connect(args):
+    '''Connect to the target selected by args. Returns a Target.'''
+    sim = None
+    if args.sim:
+        sim = SimTarget(latency=args.sim_latency)
+        iface = UartInterface(sim.connect())
+    else:
+        iface = UartInterface()
+    p = M1N1Proxy(iface)
+    bootstrap_port(iface, p)
+    u = ProxyUtils(p)
+    return Target(iface, p, u, sim)
+
+def _git_rev():
+    try:
+        return subprocess.check_output(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=pathlib.Path(__file__).parent, stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class Results:
+    '''Collects benchmark results and writes them out as JSON'''
+    def __init__(self, args, target):
+        self.args = args
+        self.meta = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "git": _git_rev(),
+            "label": args.label,
+            "target": "sim" if target.sim else "hw",
+            "device": target.iface.devpath or os.environ.get("M1N1DEVICE"),
+            "iodev": None,
+            "features": str(target.iface.enabled_features),
+            "python": platform.python_version(),
+            "host": platform.node(),
+        }
+        try:
+            self.meta["iodev"] = target.p.iodev_whoami()
+        except Exception:
+            pass
+        self.results = {}
+
+    def wanted(self, name):
+        return not self.args.only or any(s in name for s in self.args.only)
+
+    def add(self, name, result):
+        self.results[name] = result
+        print(f"  {name:40s} {self.format(result)}")
+
+    @staticmethod
+    def format(result):
+        if result["unit"] == "s":
+            return (f"{result['median'] * 1e6:10.1f} us/op "
+                    f"(min {result['min'] * 1e6:.1f}, {result['ops_per_s']:.0f} ops/s)")
+        elif result["unit"] == "B/s":
+            return (f"{result['median'] / 1048576:10.2f} MiB/s "
+                    f"(max {result['max'] / 1048576:.2f})")
+        else:
+            return f"{result['median']:10.0f} {result['unit']} (max {result['max']:.0f})"
+
+    def save(self):
+        doc = {"meta": self.meta, "results": self.results}
+        out = self.args.output
+        if out is None:
+            return
+        if str(out) == "-":
+            json.dump(doc, sys.stdout, indent=2)
+            print()
+        else:
+            with open(out, "w") as fd:
+                json.dump(doc, fd, indent=2)
+            print(f"Results written to {out}")
+
+def summary(samples, unit):
+    return {
+        "unit": unit,
+        "rounds": len(samples),
+        "median": statistics.median(samples),
+        "mean": statistics.fmean(samples),
+        "min": min(samples),
+        "max": max(samples),
+        "stdev": statistics.stdev(samples) if len(samples) > 1 else 0.0,
+    }
+
+def time_op(fn, count, rounds):
+    '''Time count calls of fn, rounds times. Reports seconds per call.'''
+    fn()
+    samples = []
+    for i in range(rounds):
+        t = time.perf_counter()
+        for j in range(count):
+            fn()
+        samples.append((time.perf_counter() - t) / count)
+    res = summary(samples, "s")
+    res["count"] = count
+    res["ops_per_s"] = 1 / res["median"] if res["median"] else 0.0
+    return res
+
+def time_xfer(fn, size, rounds):
+    '''Time fn() moving size bytes, rounds times. Reports bytes per second.'''
+    samples = []
+    for i in range(rounds):
+        t = time.perf_counter()
+        fn()
+        samples.append(size / (time.perf_counter() - t))
+    res = summary(samples, "B/s")
+    res["bytes"] = size
+    return res
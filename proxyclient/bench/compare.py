@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Compare two or more JSON result files from the benchmark scripts.
+import argparse, json, sys
+
+def speedup(base, new):
+    '''>1 means new is faster'''
+    if not base["median"] or not new["median"]:
+        return None
+    if base["unit"] == "s":
+        return base["median"] / new["median"]
+    return new["median"] / base["median"]
+
+def fmt(result):
+    if result["unit"] == "s":
+        return f"{result['median'] * 1e6:.1f} us"
+    elif result["unit"] == "B/s":
+        return f"{result['median'] / 1048576:.2f} MiB/s"
+    return f"{result['median']:.0f} {result['unit']}"
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare benchmark results')
+    parser.add_argument('-t', '--threshold', type=float, default=0.05,
+                        help="Flag changes larger than this fraction")
+    parser.add_argument('base', type=argparse.FileType("r"))
+    parser.add_argument('new', type=argparse.FileType("r"), nargs="+")
+    args = parser.parse_args()
+
+    base = json.load(args.base)
+    runs = [json.load(fd) for fd in args.new]
+
+    def label(doc, fd):
+        meta = doc["meta"]
+        return meta.get("label") or meta.get("git") or fd.name
+
+    print(f"base: {label(base, args.base)} ({base['meta']['target']})")
+    for doc, fd in zip(runs, args.new):
+        print(f"new:  {label(doc, fd)} ({doc['meta']['target']})")
+    print()
+
+    regressions = 0
+    for name, result in base["results"].items():
+        cols = [f"{fmt(result):>14s}"]
+        for doc in runs:
+            new = doc["results"].get(name)
+            if new is None:
+                cols.append(f"{'-':>14s}        ")
+                continue
+            ratio = speedup(result, new)
+            mark = " "
+            if ratio is not None and ratio < 1 - args.threshold:
+                mark = "!"
+                regressions += 1
+            elif ratio is not None and ratio > 1 + args.threshold:
+                mark = "+"
+            ratio = f"{ratio:5.2f}x" if ratio is not None else "   - "
+            cols.append(f"{fmt(new):>14s} {ratio}{mark}")
+        print(f"{name:40s} " + " ".join(cols))
+
+    if regressions:
+        print(f"\n{regressions} regression(s) beyond {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+# Proxy protocol benchmarks: command latency, memory transfer throughput,
+# compressed uploads, sysreg access and event handling.
+#
+#   bench/proxy_bench.py --sim -o before.json
+#   bench/proxy_bench.py -o after.json          (M1N1DEVICE target)
+#   bench/compare.py before.json after.json
+import sys, pathlib
+sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
+
+import argparse, os, time
+
+from common import *
+from m1n1.hv import HV, EvtMMIOTrace, MMIOTraceFlags, TraceMode
+from m1n1.utils import irange
+from m1n1.proxy import UartInterface, M1N1Proxy, EVENT
+from m1n1.sim import SimTarget
+
+def bench_latency(res, t, n):
+    p, iface = t.p, t.iface
+    buf = t.u.malloc(0x1000)
+    tests = {
+        "latency/iface_nop": iface.nop,
+        "latency/nop": p.nop,
+        "latency/read32": lambda: p.read32(buf),
+        "latency/write32": lambda: p.write32(buf, 0x12345678),
+        "latency/get_exc_count": p.get_exc_count,
+    }
+    for name, fn in tests.items():
+        if res.wanted(name):
+            res.add(name, time_op(fn, n, res.args.rounds))
+
+    def batched(op):
+        def run():
+            with p.batch() as b:
+                for i in range(n):
+                    op(b)
+        return run
+
+    tests = {
+        "latency/nop_batch": batched(lambda b: b.nop()),
+        "latency/read32_batch": batched(lambda b: b.read32(buf)),
+    }
+    for name, fn in tests.items():
+        if res.wanted(name):
+            r = time_op(fn, 1, res.args.rounds)
+            for k in ("median", "mean", "min", "max", "stdev"):
+                r[k] /= n
+            r["count"] = n
+            r["ops_per_s"] = 1 / r["median"] if r["median"] else 0.0
+            res.add(name, r)
+    t.u.free(buf)
+
+def bench_memory(res, t, sizes):
+    iface = t.iface
+    buf = t.u.malloc(max(sizes))
+    for size in sizes:
+        data = os.urandom(size)
+        name = f"writemem/{size}"
+        if res.wanted(name):
+            res.add(name, time_xfer(lambda: iface.writemem(buf, data), size, res.args.rounds))
+        name = f"readmem/{size}"
+        if res.wanted(name):
+            res.add(name, time_xfer(lambda: iface.readmem(buf, size), size, res.args.rounds))
+    t.u.free(buf)
+
+def bench_compressed(res, t, sizes):
+    u = t.u
+    buf = u.malloc(max(sizes))
+    for size in sizes:
+        rnd = os.urandom(size)
+        kinds = {
+            "zero": bytes(size),
+            # A quarter incompressible, roughly like kernel images and firmware
+            "mixed": b"".join(rnd[i:i + 0x1000] + bytes(0x3000)
+                              for i in range(0, size, 0x4000))[:size],
+            "random": rnd,
+        }
+        for kind, data in kinds.items():
+            name = f"compressed_writemem/{kind}/{size}"
+            if res.wanted(name):
+                res.add(name, time_xfer(lambda: u.compressed_writemem(buf, data, False),
+                                        size, res.args.rounds))
+    u.free(buf)
+
+def bench_sysreg(res, t, n):
+    u = t.u
+    if res.wanted("sysreg/mrs"):
+        res.add("sysreg/mrs", time_op(lambda: u.mrs("MIDR_EL1"), n, res.args.rounds))
+    if res.wanted("sysreg/msr"):
+        val = u.mrs("TPIDR_EL0")
+        res.add("sysreg/msr", time_op(lambda: u.msr("TPIDR_EL0", val), n, res.args.rounds))
+
+def bench_events(res, t, n):
+    # The proxy cannot make real hardware emit events on demand, so event
+    # handling is always measured against a stand-in target.
+    sim = t.sim
+    if sim is None:
+        sim = SimTarget()
+        iface = UartInterface(sim.connect())
+    else:
+        iface = t.iface
+
+    handlers = {
+        "events/mmiotrace_raw": lambda data: None,
+        "events/mmiotrace_parse": lambda data: EvtMMIOTrace.parse(data),
+    }
+    for name, handler in handlers.items():
+        if not res.wanted(name):
+            continue
+        iface.set_event_handler(EVENT.MMIOTRACE, handler)
+        samples = []
+        for i in range(res.args.rounds):
+            for j in range(n):
+                sim.mmiotrace(0x200000000 + 4 * j, j, write=bool(j & 1), queue=True)
+            start = time.perf_counter()
+            iface.nop() # Events are delivered ahead of the reply
+            samples.append(n / (time.perf_counter() - start))
+        r = summary(samples, "ev/s")
+        r["count"] = n
+        r["source"] = "sim" if t.sim else "local-sim"
+        res.add(name, r)
+    iface.evt_handlers.pop(EVENT.MMIOTRACE, None)
+
+def bench_hv_dispatch(res, t, n, zones=256):
+    # Host-side cost of routing MMIO trace events to tracers; nothing is
+    # sent to the target, the events are fed to the handlers directly.
+    names = ["events/hv_mmiotrace", "events/hv_dispatch"]
+    if not any(res.wanted(name) for name in names + ["events/hv_mmiotrace_queued"]):
+        return
+    hv = HV(t.iface, t.p, t.u)
+    def handler(evt, **kwargs):
+        pass
+    base = 0x200000000
+    for i in range(zones):
+        zone = irange(base + i * 0x4000, 0x4000)
+        hv.add_tracer(zone, "PrintTracer", TraceMode.ASYNC, handler, handler)
+        if i & 1:
+            hv.add_tracer(zone, f"Tracer{i}", TraceMode.ASYNC, handler, handler, index=i)
+    events = [EvtMMIOTrace.build({
+        "flags": MMIOTraceFlags(WIDTH=2, WRITE=j & 1),
+        "reserved": 0, "pc": 0, "addr": base + (j * 0x4004) % (zones * 0x4000), "data": j,
+    }) for j in range(n)]
+    parsed = [EvtMMIOTrace.parse(data) for data in events]
+
+    for name, func, args in zip(names, (hv.handle_mmiotrace, hv.dispatch_mmiotrace),
+                                (events, parsed)):
+        if not res.wanted(name):
+            continue
+        samples = []
+        for i in range(res.args.rounds):
+            start = time.perf_counter()
+            for arg in args:
+                func(arg)
+            samples.append(n / (time.perf_counter() - start))
+        r = summary(samples, "ev/s")
+        r["count"] = n
+        r["zones"] = zones
+        res.add(name, r)
+
+    # Same events with ASYNC tracers handled on the worker thread, until
+    # the queue has drained
+    name = "events/hv_mmiotrace_queued"
+    if not res.wanted(name):
+        return
+    hv.enable_tracer_queue()
+    samples = []
+    for i in range(res.args.rounds):
+        start = time.perf_counter()
+        for data in events:
+            hv.handle_mmiotrace(data)
+        hv.tracer_queue.wait()
+        samples.append(n / (time.perf_counter() - start))
+    r = summary(samples, "ev/s")
+    r["count"] = n
+    r["zones"] = zones
+    r["max_depth"] = hv.tracer_queue.stats()["max_depth"]
+    res.add(name, r)
+    hv.disable_tracer_queue()
+
+def main():
+    parser = argparse.ArgumentParser(description='m1n1 proxy protocol benchmarks')
+    add_args(parser)
+    args = parser.parse_args()
+
+    t = connect(args)
+    res = Results(args, t)
+    print(f"Target: {res.meta['target']} ({res.meta['device']}), features: {res.meta['features']}")
+
+    if args.quick:
+        n, sizes, csizes, nevents = 100, [0x1000, 0x10000, 0x100000], [0x100000], 1000
+    else:
+        n = 1000
+        sizes = [0x1000, 0x10000, 0x100000, 0x800000]
+        csizes = [0x100000, 0x800000]
+        nevents = 10000
+
+    bench_latency(res, t, n)
+    bench_memory(res, t, sizes)
+    bench_compressed(res, t, csizes)
+    bench_sysreg(res, t, n // 4)
+    bench_events(res, t, nevents)
+    bench_hv_dispatch(res, t, nevents)
+    res.save()
+
+if __name__ == "__main__":
+    main()
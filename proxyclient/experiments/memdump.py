@@ -4,6 +4,9 @@ import sys, pathlib
 sys.path.append(str(pathlib.Path(__file__).resolve().parents[1]))
 
 from m1n1.setup import *
+from m1n1.xfer import TransferEngine
+
+xfer = TransferEngine(iface)
 
 p = 0x800000000
 limit = u.base
@@ -17,6 +20,6 @@ while p < limit:
 
     print("dumping 0x%x..." % p)
 
-    data = iface.readmem(p, block)
+    data = xfer.readmem(p, block)
     open(f, "wb").write(data)
     p += block
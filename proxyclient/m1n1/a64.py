@@ -0,0 +1,1219 @@
+# SPDX-License-Identifier: MIT
+# Pure Python assembler for the small A64 subset the proxyclient generates
+# (stubs, polling loops, trampolines), producing the same bytes as GNU as
+# followed by ld --Ttext=addr would. ARMAsm tries it before the toolchain;
+# anything outside the subset raises Unsupported and the toolchain is used.
+#
+# disassemble() decodes the same subset for quick code dumps.
+#
+#   python -m m1n1.a64            check the corpus below against known encodings
+#   python -m m1n1.a64 -t         also check it against the toolchain
+import re, struct
+
+__all__ = ["Unsupported", "assemble", "disassemble"]
+
+class Unsupported(Exception):
+    pass
+
+NOP = 0xd503201f
+
+CONDS = {
+    "eq": 0, "ne": 1, "cs": 2, "hs": 2, "cc": 3, "lo": 3, "mi": 4, "pl": 5, "vs": 6,
+    "vc": 7, "hi": 8, "ls": 9, "ge": 10, "lt": 11, "gt": 12, "le": 13, "al": 14, "nv": 15,
+}
+
+BARRIER_OPTS = {
+    "sy": 15, "st": 14, "ld": 13, "ish": 11, "ishst": 10, "ishld": 9,
+    "nsh": 7, "nshst": 6, "nshld": 5, "osh": 3, "oshst": 2, "oshld": 1,
+}
+
+HINTS = {
+    "nop": 0xd503201f, "yield": 0xd503203f, "wfe": 0xd503205f, "wfi": 0xd503207f,
+    "sev": 0xd503209f, "sevl": 0xd50320bf, "eret": 0xd69f03e0,
+}
+
+EXCEPTIONS = {"svc": 0xd4000001, "hvc": 0xd4000002, "smc": 0xd4000003,
+              "brk": 0xd4200000, "hlt": 0xd4400000}
+
+# SYS aliases: name -> (op1, CRn, CRm, op2, takes a register)
+SYS_OPS = {
+    "dc": {
+        "ivac": (0, 7, 6, 1, True), "isw": (0, 7, 6, 2, True), "csw": (0, 7, 10, 2, True),
+        "cisw": (0, 7, 14, 2, True), "zva": (3, 7, 4, 1, True), "cvac": (3, 7, 10, 1, True),
+        "cvau": (3, 7, 11, 1, True), "cvap": (3, 7, 12, 1, True), "civac": (3, 7, 14, 1, True),
+    },
+    "ic": {
+        "ialluis": (0, 7, 1, 0, False), "iallu": (0, 7, 5, 0, False), "ivau": (3, 7, 5, 1, True),
+    },
+    "tlbi": {
+        "vmalle1is": (0, 8, 3, 0, False), "vmalle1": (0, 8, 7, 0, False),
+        "alle1is": (4, 8, 3, 4, False), "alle1": (4, 8, 7, 4, False),
+        "alle2is": (4, 8, 3, 0, False), "alle2": (4, 8, 7, 0, False),
+        "vmalls12e1is": (4, 8, 3, 6, False), "vmalls12e1": (4, 8, 7, 6, False),
+        "vae1is": (0, 8, 3, 1, True), "vae1": (0, 8, 7, 1, True),
+        "vae2is": (4, 8, 3, 1, True), "vae2": (4, 8, 7, 1, True),
+        "aside1is": (0, 8, 3, 2, True), "aside1": (0, 8, 7, 2, True),
+    },
+}
+
+# PSTATE fields for msr <field>, #imm: name -> (op1, op2)
+PSTATE = {"spsel": (0, 5), "daifset": (3, 6), "daifclr": (3, 7)}
+
+REG_ALIASES = {"ip0": 16, "ip1": 17, "fp": 29, "lr": 30}
+
+SHIFTS = {"lsl": 0, "lsr": 1, "asr": 2, "ror": 3}
+
+# Load/store: name -> (size, opc for x/w Rt); None entries are invalid
+LDST = {
+    "ldr": (None, 1), "str": (None, 0),
+    "ldrb": (0, 1), "strb": (0, 0), "ldrh": (1, 1), "strh": (1, 0),
+    "ldrsb": (0, None), "ldrsh": (1, None), "ldrsw": (2, 2),
+    "ldur": (None, 1), "stur": (None, 0),
+}
+
+# crc32: name -> (C, sz)
+CRC32 = {f"crc32{c}{w}": (i, sz) for i, c in enumerate(("", "c")) for sz, w in enumerate("bhwx")}
+
+_sysregs = None
+
+def _sysreg(name):
+    global _sysregs
+    if _sysregs is None:
+        from .sysreg import sysreg_fwd
+        _sysregs = {k.lower(): v for k, v in sysreg_fwd.items()}
+    m = re.fullmatch(r"s([0-3])_([0-7])_c(\d+)_c(\d+)_([0-7])", name.lower())
+    if m:
+        enc = tuple(map(int, m.groups()))
+    else:
+        enc = _sysregs.get(name.lower())
+    if enc is None or enc[0] < 2 or enc[2] > 15 or enc[3] > 15:
+        raise Unsupported(f"Unknown system register {name}")
+    return enc
+
+def _field(val, bits, signed=False, what="immediate"):
+    if signed:
+        if not -(1 << (bits - 1)) <= val < (1 << (bits - 1)):
+            raise Unsupported(f"{what} out of range")
+        return val & ((1 << bits) - 1)
+    if not 0 <= val < (1 << bits):
+        raise Unsupported(f"{what} out of range")
+    return val
+
+def _logical_imm(val, sf):
+    '''(N, immr, imms) for a bitmask immediate, or None'''
+    width = 64 if sf else 32
+    val &= (1 << width) - 1
+    if val == 0 or val == (1 << width) - 1:
+        return None
+    size = width
+    while size > 2:
+        half = size // 2
+        mask = (1 << half) - 1
+        if (val & mask) != (val >> half) & mask:
+            break
+        size = half
+    mask = (1 << size) - 1
+    elt = val & mask
+    # Rotate right until the run of ones starts at bit 0
+    for rot in range(size):
+        r = ((elt >> rot) | (elt << (size - rot))) & mask
+        ones = bin(r).count("1")
+        if r == (1 << ones) - 1:
+            immr = (size - rot) % size
+            imms = ((~(size - 1) << 1) & 0x3f) | (ones - 1)
+            return (1 if size == 64 else 0), immr, imms
+    return None
+
+def _wide_imm(val, sf):
+    '''(hw, imm16) if val fits a single shifted 16-bit chunk, or None'''
+    width = 64 if sf else 32
+    val &= (1 << width) - 1
+    for hw in range(width // 16):
+        if val & ~(0xffff << (16 * hw)) == 0:
+            return hw, val >> (16 * hw)
+    return None
+
+class _Expr:
+    '''gas-style integer expressions over labels and .equ symbols'''
+    TOKENS = re.compile(r"\s*(?:(0[xX][0-9a-fA-F]+)|(0[bB][01]+)|(\d+[bf])(?![\w$.])|(\d+)|"
+                        r"([A-Za-z_.$][\w.$]*)|(<<|>>|[-+*/%|&^~()!]))")
+    # Binary operator precedence as in gas (higher binds tighter)
+    PREC = {"*": 3, "/": 3, "%": 3, "<<": 3, ">>": 3, "|": 2, "&": 2, "^": 2, "!": 2,
+            "+": 1, "-": 1}
+
+    def __init__(self, text, resolve):
+        self.toks = []
+        pos = 0
+        text = text.strip()
+        while pos < len(text):
+            m = self.TOKENS.match(text, pos)
+            if not m or m.end() == pos:
+                raise Unsupported(f"Cannot parse expression {text!r}")
+            pos = m.end()
+            hexn, binn, local, num, name, op = m.groups()
+            if hexn:
+                self.toks.append(("n", int(hexn, 16)))
+            elif binn:
+                self.toks.append(("n", int(binn[2:], 2)))
+            elif local:
+                self.toks.append(("n", resolve(local)))
+            elif num:
+                self.toks.append(("n", int(num, 8) if num[0] == "0" else int(num)))
+            elif name:
+                self.toks.append(("n", resolve(name)))
+            else:
+                self.toks.append(("o", op))
+        self.pos = 0
+
+    def _peek(self):
+        return self.toks[self.pos] if self.pos < len(self.toks) else (None, None)
+
+    def _unary(self):
+        kind, val = self._peek()
+        self.pos += 1
+        if kind == "n":
+            return val
+        if val == "-":
+            return -self._unary()
+        if val == "+":
+            return self._unary()
+        if val == "~":
+            return ~self._unary()
+        if val == "!":
+            return int(not self._unary())
+        if val == "(":
+            v = self._binary(0)
+            if self._peek() != ("o", ")"):
+                raise Unsupported("Unbalanced parentheses")
+            self.pos += 1
+            return v
+        raise Unsupported("Bad expression")
+
+    def _binary(self, prec):
+        lhs = self._unary()
+        while True:
+            kind, op = self._peek()
+            if kind != "o" or op not in self.PREC or self.PREC[op] <= prec:
+                return lhs
+            self.pos += 1
+            rhs = self._binary(self.PREC[op])
+            if op in "/%" and rhs == 0:
+                raise Unsupported("Division by zero")
+            lhs = {
+                "*": lambda a, b: a * b, "/": lambda a, b: int(a / b),
+                "%": lambda a, b: a - b * int(a / b), "<<": lambda a, b: a << b,
+                ">>": lambda a, b: a >> b, "|": lambda a, b: a | b, "&": lambda a, b: a & b,
+                "^": lambda a, b: a ^ b, "!": lambda a, b: a | ~b,
+                "+": lambda a, b: a + b, "-": lambda a, b: a - b,
+            }[op](lhs, rhs)
+
+    def value(self):
+        v = self._binary(0)
+        if self.pos != len(self.toks):
+            raise Unsupported("Trailing junk in expression")
+        return v
+
+def _split_operands(text):
+    ops = []
+    depth = 0
+    cur = ""
+    for c in text:
+        if c == "[":
+            depth += 1
+        elif c == "]":
+            depth -= 1
+        if c == "," and depth == 0:
+            ops.append(cur.strip())
+            cur = ""
+        else:
+            cur += c
+    if cur.strip():
+        ops.append(cur.strip())
+    return ops
+
+def _statements(source):
+    source = re.sub(r"/\*.*?\*/", " ", source, flags=re.S)
+    for line in source.split("\n"):
+        line = line.split("//")[0]
+        if line.lstrip().startswith("#"):
+            continue
+        for stmt in line.split(";"):
+            stmt = stmt.strip()
+            while True:
+                m = re.match(r"([A-Za-z_.$][\w.$]*|\d+)\s*:\s*", stmt)
+                if not m:
+                    break
+                yield "label", m.group(1)
+                stmt = stmt[m.end():]
+            if stmt:
+                yield "stmt", stmt
+
+class _Assembler:
+    def __init__(self, addr):
+        self.addr = addr
+        self.pos = 0
+        self.seq = 0
+        self.code = False
+        self.items = [] # (offset, seq, mnemonic, operands)
+        self.labels = {}
+        self.locals = {} # number -> [(seq, offset)]
+        self.equs = {}
+
+    # Pass 1: layout
+
+    def run(self, source):
+        for kind, text in _statements(source):
+            self.seq += 1
+            if kind == "label":
+                self._label(text)
+            else:
+                self._statement(text)
+        if self.pos & 3:
+            # The toolchain would pad the section, not reproduced here
+            raise Unsupported("Section size not a multiple of 4")
+        if self.code and self.addr & 3:
+            raise Unsupported("Load address not aligned for the section")
+        return self._encode()
+
+    def _label(self, name):
+        if name.isdigit():
+            self.locals.setdefault(name, []).append((self.seq, self.pos))
+        elif name in self.labels or name in self.equs:
+            raise Unsupported(f"Duplicate symbol {name}")
+        else:
+            self.labels[name] = self.pos
+
+    def _statement(self, text):
+        parts = text.split(None, 1)
+        mn = parts[0].lower()
+        args = parts[1] if len(parts) > 1 else ""
+
+        if mn.startswith("."):
+            return self._directive(mn, args)
+
+        if self.pos & 3:
+            raise Unsupported("Unaligned instruction")
+        self.code = True
+        ops = _split_operands(args)
+        if mn in ("ldr", "ldrsw") and len(ops) == 2 and ops[1].startswith("="):
+            # Literal pool layout is left to the toolchain
+            raise Unsupported("Literal pools are not supported")
+        self.items.append((self.pos, self.seq, mn, ops))
+        self.pos += 4
+
+    def _directive(self, mn, args):
+        if mn in (".text", ".globl", ".global", ".type", ".size"):
+            return
+        elif mn in (".pool", ".ltorg"):
+            # Nothing to dump without literal loads (ARMAsm always ends with .pool)
+            return
+        elif mn in (".equ", ".set"):
+            name, expr = [v.strip() for v in args.split(",", 1)]
+            self.equs[name] = self._const(expr)
+        else:
+            size = {".inst": 4, ".word": 4, ".long": 4, ".4byte": 4, ".quad": 8,
+                    ".xword": 8, ".dword": 8, ".8byte": 8, ".hword": 2, ".short": 2,
+                    ".2byte": 2, ".byte": 1}.get(mn)
+            if size is None:
+                raise Unsupported(f"Unsupported directive {mn}")
+            for expr in _split_operands(args):
+                self.items.append((self.pos, self.seq, ".lit", (size, expr)))
+                self.pos += size
+
+    # Pass 2: encoding
+
+    def _resolve(self, name, seq=None, allow_labels=True):
+        if name in self.equs:
+            return self.equs[name]
+        if allow_labels:
+            if name in self.labels:
+                return self.addr + self.labels[name]
+            m = re.fullmatch(r"(\d+)([bf])", name)
+            if m and seq is not None:
+                defs = self.locals.get(m.group(1), [])
+                if m.group(2) == "b":
+                    defs = [off for s, off in defs if s < seq]
+                    if defs:
+                        return self.addr + defs[-1]
+                else:
+                    defs = [off for s, off in defs if s > seq]
+                    if defs:
+                        return self.addr + defs[0]
+        raise Unsupported(f"Undefined symbol {name}")
+
+    def _const(self, text):
+        text = text.strip()
+        if text.startswith("#"):
+            text = text[1:]
+        return _Expr(text, lambda n: self._resolve(n, allow_labels=False)).value()
+
+    def _target(self, text, seq):
+        text = text.strip()
+        # Branches to bare numbers need relocations against absolute symbols
+        if re.fullmatch(r"#?[-+]?(0[xX][0-9a-fA-F]+|\d+)", text):
+            raise Unsupported("Branch to absolute address")
+        return _Expr(text, lambda n: self._resolve(n, seq)).value()
+
+    def _encode(self):
+        out = bytearray(self.pos)
+        for off, seq, mn, ops in self.items:
+            if mn == ".lit":
+                size, expr = ops
+                val = _Expr(expr, lambda n: self._resolve(n, seq)).value()
+                if not -(1 << (8 * size - 1)) <= val < (1 << (8 * size)):
+                    raise Unsupported("Value out of range")
+                out[off:off + size] = (val & ((1 << (8 * size)) - 1)).to_bytes(size, "little")
+            else:
+                pc = self.addr + off
+                try:
+                    insn = self._insn(mn, ops, pc, seq)
+                except (ValueError, IndexError, KeyError, TypeError):
+                    raise Unsupported(f"Cannot encode {mn} {', '.join(ops)}")
+                struct.pack_into("<I", out, off, insn)
+        symbols = {name: self.addr + off for name, off in self.labels.items()
+                   if not name.startswith(".L")}
+        symbols.update(self.equs)
+        return bytes(out), symbols
+
+    # Operands
+
+    def _reg(self, text, sp=False, zr=True):
+        '''Returns (number, sf)'''
+        t = text.strip().lower()
+        if t in REG_ALIASES:
+            return REG_ALIASES[t], 1
+        if t in ("sp", "wsp"):
+            if not sp:
+                raise Unsupported("sp not allowed here")
+            return 31, int(t == "sp")
+        if t in ("xzr", "wzr"):
+            if not zr:
+                raise Unsupported("zr not allowed here")
+            return 31, int(t == "xzr")
+        m = re.fullmatch(r"([xw])(\d+)", t)
+        if not m or int(m.group(2)) > 30:
+            raise Unsupported(f"Bad register {text}")
+        return int(m.group(2)), int(m.group(1) == "x")
+
+    def _is_reg(self, text):
+        try:
+            self._reg(text, sp=True)
+            return True
+        except Unsupported:
+            return False
+
+    def _is_sp(self, text):
+        return text.strip().lower() in ("sp", "wsp")
+
+    def _shift(self, ops, idx, allowed="lsl lsr asr"):
+        '''Optional "<shift> #amount" operand at ops[idx]'''
+        if len(ops) <= idx:
+            return 0, 0
+        if len(ops) > idx + 1:
+            raise Unsupported("Too many operands")
+        parts = ops[idx].split(None, 1)
+        kind = parts[0].lower()
+        if kind not in allowed.split() or len(parts) != 2:
+            raise Unsupported(f"Bad shift {ops[idx]}")
+        return SHIFTS[kind], self._const(parts[1])
+
+    def _rel(self, target, pc, bits, what):
+        delta = target - pc
+        if delta & 3:
+            raise Unsupported(f"Misaligned {what} target")
+        return _field(delta >> 2, bits, True, what)
+
+    # Instructions
+
+    def _insn(self, mn, ops, pc, seq):
+        if mn in HINTS and not ops:
+            return HINTS[mn]
+        if mn == "ret":
+            rn = self._reg(ops[0])[0] if ops else 30
+            return 0xd65f0000 | rn << 5
+        if mn in ("br", "blr"):
+            return (0xd61f0000 if mn == "br" else 0xd63f0000) | self._reg(ops[0])[0] << 5
+        if mn in ("b", "bl"):
+            return ((0x14000000 if mn == "b" else 0x94000000) |
+                    self._rel(self._target(ops[0], seq), pc, 26, "branch"))
+        if mn.startswith("b.") and mn[2:] in CONDS:
+            return (0x54000000 | self._rel(self._target(ops[0], seq), pc, 19, "branch") << 5 |
+                    CONDS[mn[2:]])
+        if mn in ("cbz", "cbnz"):
+            rt, sf = self._reg(ops[0])
+            return (sf << 31 | (0x34000000 if mn == "cbz" else 0x35000000) |
+                    self._rel(self._target(ops[1], seq), pc, 19, "branch") << 5 | rt)
+        if mn in ("tbz", "tbnz"):
+            rt, sf = self._reg(ops[0])
+            bit = _field(self._const(ops[1]), 6 if sf else 5, what="bit number")
+            return ((bit >> 5) << 31 | (0x36000000 if mn == "tbz" else 0x37000000) |
+                    (bit & 31) << 19 | self._rel(self._target(ops[2], seq), pc, 14, "branch") << 5 |
+                    rt)
+        if mn in ("adr", "adrp"):
+            rd, sf = self._reg(ops[0])
+            target = self._target(ops[1], seq)
+            if mn == "adr":
+                imm = _field(target - pc, 21, True, "adr offset")
+                return 0x10000000 | (imm & 3) << 29 | (imm >> 2) << 5 | rd
+            imm = _field((target >> 12) - (pc >> 12), 21, True, "adrp offset")
+            return 0x90000000 | (imm & 3) << 29 | (imm >> 2) << 5 | rd
+        if mn in ("isb", "dsb", "dmb"):
+            opt = ops[0].strip().lower() if ops else "sy"
+            if opt.startswith("#"):
+                crm = _field(self._const(opt), 4)
+            else:
+                crm = BARRIER_OPTS[opt]
+            if mn == "isb" and crm != 15:
+                raise Unsupported("isb option")
+            return {"isb": 0xd50330df, "dsb": 0xd503309f, "dmb": 0xd50330bf}[mn] | crm << 8
+        if mn in EXCEPTIONS:
+            return EXCEPTIONS[mn] | _field(self._const(ops[0]), 16) << 5
+        if mn in SYS_OPS:
+            op1, crn, crm, op2, has_reg = SYS_OPS[mn][ops[0].strip().lower()]
+            if has_reg != (len(ops) == 2):
+                raise Unsupported(f"Bad operands for {mn}")
+            rt = self._reg(ops[1])[0] if has_reg else 31
+            if has_reg and not self._reg(ops[1])[1]:
+                raise Unsupported(f"{mn} needs an x register")
+            return 0xd5080000 | op1 << 16 | crn << 12 | crm << 8 | op2 << 5 | rt
+        if mn == "mrs":
+            rt, sf = self._reg(ops[0])
+            return self._sysreg_insn(0xd5300000, ops[1], rt, sf)
+        if mn == "msr":
+            field = ops[0].strip().lower()
+            if field in PSTATE:
+                op1, op2 = PSTATE[field]
+                return 0xd500401f | op1 << 16 | _field(self._const(ops[1]), 4) << 8 | op2 << 5
+            rt, sf = self._reg(ops[1])
+            return self._sysreg_insn(0xd5100000, ops[0], rt, sf)
+        if mn in LDST:
+            return self._ldst(mn, ops, pc, seq)
+        if mn in ("ldp", "stp"):
+            return self._ldp(mn, ops)
+        if mn in ("mov", "movz", "movn", "movk"):
+            return self._mov(mn, ops)
+        if mn in ("add", "adds", "sub", "subs", "cmp", "cmn", "neg", "negs"):
+            return self._addsub(mn, ops)
+        if mn in ("and", "ands", "orr", "eor", "bic", "bics", "orn", "eon", "tst", "mvn"):
+            return self._logical(mn, ops)
+        if mn in ("lsl", "lsr", "asr"):
+            return self._shift_insn(mn, ops)
+        if mn in ("bfm", "ubfm", "sbfm", "bfi", "bfxil", "ubfx", "sbfx", "ubfiz", "sbfiz",
+                  "uxtb", "uxth", "sxtb", "sxth", "sxtw"):
+            return self._bitfield(mn, ops)
+        if mn in ("madd", "msub", "mul", "mneg", "udiv", "sdiv"):
+            return self._muldiv(mn, ops)
+        if mn in ("csel", "csinc", "csinv", "csneg", "cset", "csetm", "cinc"):
+            return self._csel(mn, ops)
+        if mn in CRC32:
+            c, sz = CRC32[mn]
+            rd, sfd = self._reg(ops[0])
+            rn, sfn = self._reg(ops[1])
+            rm, sf = self._reg(ops[2])
+            if sfd or sfn or sf != (sz == 3):
+                raise Unsupported("Bad crc32 operand width")
+            return sf << 31 | 0x1ac04000 | rm << 16 | c << 12 | sz << 10 | rn << 5 | rd
+        if mn in ("clz", "rbit", "rev"):
+            rd, sf = self._reg(ops[0])
+            rn, sfn = self._reg(ops[1])
+            if sf != sfn:
+                raise Unsupported("Register width mismatch")
+            base = {"clz": 0x5ac01000, "rbit": 0x5ac00000,
+                    "rev": 0x5ac00c00 if sf else 0x5ac00800}[mn]
+            return sf << 31 | base | rn << 5 | rd
+        raise Unsupported(f"Unsupported instruction {mn}")
+
+    def _sysreg_insn(self, base, name, rt, sf):
+        if not sf:
+            raise Unsupported("System register access needs an x register")
+        op0, op1, crn, crm, op2 = _sysreg(name.strip())
+        return base | (op0 & 1) << 19 | op1 << 16 | crn << 12 | crm << 8 | op2 << 5 | rt
+
+    def _mem(self, text):
+        '''Parse [xn{, #imm | , xm{, lsl #s}}]{!}: (rn, imm, rm, shift, writeback)'''
+        text = text.strip()
+        wb = text.endswith("!")
+        if wb:
+            text = text[:-1].strip()
+        if not (text.startswith("[") and text.endswith("]")):
+            raise Unsupported(f"Bad address {text}")
+        parts = [p.strip() for p in text[1:-1].split(",")]
+        rn, sf = self._reg(parts[0], sp=True, zr=False)
+        if not sf:
+            raise Unsupported("Base register must be 64-bit")
+        if len(parts) == 1:
+            return rn, 0, None, None, wb
+        if self._is_reg(parts[1]):
+            rm, sfm = self._reg(parts[1])
+            if not sfm or wb:
+                raise Unsupported("Unsupported register offset")
+            shift = None
+            if len(parts) == 3:
+                kind, amount = parts[2].split(None, 1)
+                if kind.lower() != "lsl":
+                    raise Unsupported("Unsupported index extend")
+                shift = self._const(amount)
+            elif len(parts) > 3:
+                raise Unsupported(f"Bad address {text}")
+            return rn, 0, rm, shift, wb
+        if len(parts) != 2:
+            raise Unsupported(f"Bad address {text}")
+        return rn, self._const(parts[1]), None, None, wb
+
+    def _ldst(self, mn, ops, pc, seq):
+        size, opc = LDST[mn]
+        rt, sf = self._reg(ops[0])
+        if mn in ("ldr", "str", "ldur", "stur"):
+            size = 3 if sf else 2
+        elif mn in ("ldrsb", "ldrsh"):
+            opc = 2 if sf else 3
+        elif mn == "ldrsw":
+            if not sf:
+                raise Unsupported("ldrsw needs an x register")
+        elif sf:
+            raise Unsupported(f"{mn} needs a w register")
+
+        if mn in ("ldr", "ldrsw") and not ops[1].strip().startswith("["):
+            base = 0x98000000 if mn == "ldrsw" else (0x58000000 if sf else 0x18000000)
+            target = self._target(ops[1], seq)
+            return base | self._rel(target, pc, 19, "literal") << 5 | rt
+
+        rn, imm, rm, shift, wb = self._mem(ops[1])
+        base = size << 30 | 0x38000000 | opc << 22 | rn << 5 | rt
+        if len(ops) == 3:
+            # Post-index
+            if wb or rm is not None or imm:
+                raise Unsupported("Bad post-index address")
+            return base | _field(self._const(ops[2]), 9, True) << 12 | 0x400
+        if len(ops) != 2:
+            raise Unsupported("Too many operands")
+        if wb:
+            return base | _field(imm, 9, True) << 12 | 0xc00
+        if rm is not None:
+            if shift is None:
+                s = 0
+            elif shift == size and size:
+                s = 1
+            else:
+                raise Unsupported("Unsupported index shift")
+            return base | 0x200800 | rm << 16 | 3 << 13 | s << 12
+        if mn in ("ldur", "stur"):
+            return base | _field(imm, 9, True) << 12
+        if imm >= 0 and not imm & ((1 << size) - 1) and imm >> size < 4096:
+            return base | 0x01000000 | (imm >> size) << 10
+        # Unscaled offsets are assembled as ldur/stur
+        return base | _field(imm, 9, True) << 12
+
+    def _ldp(self, mn, ops):
+        rt, sf = self._reg(ops[0])
+        rt2, sf2 = self._reg(ops[1])
+        if sf != sf2:
+            raise Unsupported("Register width mismatch")
+        scale = 3 if sf else 2
+        rn, imm, rm, shift, wb = self._mem(ops[2])
+        if rm is not None:
+            raise Unsupported("ldp/stp take no index register")
+        if len(ops) == 4:
+            if wb or imm:
+                raise Unsupported("Bad post-index address")
+            mode, imm = 1, self._const(ops[3])
+        elif len(ops) == 3:
+            mode = 3 if wb else 2
+        else:
+            raise Unsupported("Bad operands")
+        if imm & ((1 << scale) - 1):
+            raise Unsupported("Misaligned ldp/stp offset")
+        return ((2 if sf else 0) << 30 | 0x28000000 | mode << 23 | int(mn == "ldp") << 22 |
+                _field(imm >> scale, 7, True) << 15 | rt2 << 10 | rn << 5 | rt)
+
+    def _mov(self, mn, ops):
+        if mn == "mov" and self._is_reg(ops[1]):
+            rd, sf = self._reg(ops[0], sp=True)
+            rm, sfm = self._reg(ops[1], sp=True)
+            if sf != sfm:
+                raise Unsupported("Register width mismatch")
+            if self._is_sp(ops[0]) or self._is_sp(ops[1]):
+                return sf << 31 | 0x11000000 | rm << 5 | rd # add rd, rn, #0
+            return sf << 31 | 0x2a0003e0 | rm << 16 | rd # orr rd, zr, rm
+
+        rd, sf = self._reg(ops[0])
+        imm = self._const(ops[1])
+        width = 64 if sf else 32
+        if mn == "mov":
+            if not -(1 << (width - 1)) <= imm < (1 << width):
+                raise Unsupported("Immediate out of range")
+            mask = (1 << width) - 1
+            wide = _wide_imm(imm, sf)
+            if wide is not None:
+                hw, val = wide
+                return sf << 31 | 0x52800000 | hw << 21 | val << 5 | rd
+            wide = _wide_imm(~imm & mask, sf)
+            if wide is not None:
+                hw, val = wide
+                return sf << 31 | 0x12800000 | hw << 21 | val << 5 | rd
+            logical = _logical_imm(imm, sf)
+            if logical is not None:
+                n, immr, imms = logical
+                return sf << 31 | 0x320003e0 | n << 22 | immr << 16 | imms << 10 | rd
+            raise Unsupported("Immediate cannot be moved in one instruction")
+
+        base = {"movz": 0x52800000, "movn": 0x12800000, "movk": 0x72800000}[mn]
+        kind, shift = self._shift(ops, 2, "lsl")
+        if shift % 16 or shift >= width:
+            raise Unsupported("Bad move shift")
+        return sf << 31 | base | (shift // 16) << 21 | _field(imm, 16) << 5 | rd
+
+    def _addsub(self, mn, ops):
+        if mn in ("cmp", "cmn"):
+            mn = "subs" if mn == "cmp" else "adds"
+            ops = ["xzr" if self._reg(ops[0], sp=True)[1] else "wzr"] + ops
+        elif mn in ("neg", "negs"):
+            mn = "sub" if mn == "neg" else "subs"
+            ops = [ops[0], "xzr" if self._reg(ops[0])[1] else "wzr"] + ops[1:]
+        op = {"add": 0, "adds": 1, "sub": 2, "subs": 3}[mn]
+        setflags = op & 1
+
+        if self._is_reg(ops[2]):
+            if any(self._is_sp(o) for o in ops[:3]):
+                raise Unsupported("Extended register forms are not supported")
+            rd, sf = self._reg(ops[0])
+            rn, sfn = self._reg(ops[1])
+            rm, sfm = self._reg(ops[2])
+            if not sf == sfn == sfm:
+                raise Unsupported("Register width mismatch")
+            kind, amount = self._shift(ops, 3)
+            return (sf << 31 | op << 29 | 0x0b000000 | kind << 22 | rm << 16 |
+                    _field(amount, 6 if sf else 5) << 10 | rn << 5 | rd)
+
+        # Register 31 is sp as the destination of add/sub, zr of adds/subs
+        rd, sf = self._reg(ops[0], sp=not setflags, zr=bool(setflags))
+        rn, sfn = self._reg(ops[1], sp=True, zr=False)
+        if sf != sfn:
+            raise Unsupported("Register width mismatch")
+        imm = self._const(ops[2])
+        kind, shift = self._shift(ops, 3, "lsl")
+        if shift not in (0, 12):
+            raise Unsupported("Bad immediate shift")
+        sh = shift // 12
+        if not sh and not 0 <= imm < 4096:
+            if imm > 0 and not imm & 0xfff and imm >> 12 < 4096:
+                imm >>= 12
+                sh = 1
+            else:
+                raise Unsupported("Immediate out of range")
+        return sf << 31 | op << 29 | 0x11000000 | sh << 22 | _field(imm, 12) << 10 | rn << 5 | rd
+
+    def _logical(self, mn, ops):
+        if mn == "tst":
+            mn = "ands"
+            ops = ["xzr" if self._reg(ops[0])[1] else "wzr"] + ops
+        elif mn == "mvn":
+            mn = "orn"
+            ops = [ops[0], "xzr" if self._reg(ops[0])[1] else "wzr"] + ops[1:]
+        opc, n = {"and": (0, 0), "orr": (1, 0), "eor": (2, 0), "ands": (3, 0),
+                  "bic": (0, 1), "orn": (1, 1), "eon": (2, 1), "bics": (3, 1)}[mn]
+
+        if self._is_reg(ops[2]):
+            rd, sf = self._reg(ops[0])
+            rn, sfn = self._reg(ops[1])
+            rm, sfm = self._reg(ops[2])
+            if not sf == sfn == sfm:
+                raise Unsupported("Register width mismatch")
+            kind, amount = self._shift(ops, 3, "lsl lsr asr ror")
+            return (sf << 31 | opc << 29 | 0x0a000000 | kind << 22 | n << 21 | rm << 16 |
+                    _field(amount, 6 if sf else 5) << 10 | rn << 5 | rd)
+
+        if n or len(ops) != 3:
+            raise Unsupported(f"{mn} takes no immediate")
+        # Likewise sp for and/orr/eor, zr for ands
+        rd, sf = self._reg(ops[0], sp=opc != 3, zr=opc == 3)
+        rn, sfn = self._reg(ops[1])
+        if sf != sfn:
+            raise Unsupported("Register width mismatch")
+        logical = _logical_imm(self._const(ops[2]), sf)
+        if logical is None:
+            raise Unsupported("Not a bitmask immediate")
+        n, immr, imms = logical
+        return (sf << 31 | opc << 29 | 0x12000000 | n << 22 | immr << 16 | imms << 10 |
+                rn << 5 | rd)
+
+    def _shift_insn(self, mn, ops):
+        rd, sf = self._reg(ops[0])
+        rn, sfn = self._reg(ops[1])
+        if sf != sfn:
+            raise Unsupported("Register width mismatch")
+        width = 64 if sf else 32
+        if self._is_reg(ops[2]):
+            rm, sfm = self._reg(ops[2])
+            base = {"lsl": 0x1ac02000, "lsr": 0x1ac02400, "asr": 0x1ac02800}[mn]
+            return sf << 31 | base | rm << 16 | rn << 5 | rd
+        shift = _field(self._const(ops[2]), 6 if sf else 5, what="shift")
+        if mn == "lsl":
+            return self._bfm(0x53000000, sf, rd, rn, (-shift) % width, width - 1 - shift)
+        return self._bfm(0x53000000 if mn == "lsr" else 0x13000000, sf, rd, rn, shift, width - 1)
+
+    def _bfm(self, base, sf, rd, rn, immr, imms):
+        return sf << 31 | base | sf << 22 | immr << 16 | imms << 10 | rn << 5 | rd
+
+    def _bitfield(self, mn, ops):
+        rd, sf = self._reg(ops[0])
+        rn, sfn = self._reg(ops[1])
+        if mn in ("uxtb", "uxth", "sxtb", "sxth", "sxtw"):
+            if sfn or (mn.startswith("u") and sf) or (mn == "sxtw" and not sf):
+                raise Unsupported(f"Bad registers for {mn}")
+            imms = {"b": 7, "h": 15, "w": 31}[mn[-1]]
+            return self._bfm(0x53000000 if mn[0] == "u" else 0x13000000, sf, rd, rn, 0, imms)
+        if sf != sfn:
+            raise Unsupported("Register width mismatch")
+        width = 64 if sf else 32
+        a = _field(self._const(ops[2]), 6 if sf else 5)
+        b = self._const(ops[3])
+        base = {"b": 0x33000000, "u": 0x53000000, "s": 0x13000000}[mn[0]]
+        if mn in ("bfm", "ubfm", "sbfm"):
+            immr, imms = a, _field(b, 6 if sf else 5)
+        elif mn in ("bfi", "ubfiz", "sbfiz"):
+            if not 1 <= b <= width - a:
+                raise Unsupported("Bad bitfield width")
+            immr, imms = (-a) % width, b - 1
+        else: # bfxil, ubfx, sbfx
+            if not 1 <= b <= width - a:
+                raise Unsupported("Bad bitfield width")
+            immr, imms = a, a + b - 1
+        return self._bfm(base, sf, rd, rn, immr, imms)
+
+    def _muldiv(self, mn, ops):
+        regs = [self._reg(o) for o in ops]
+        sf = regs[0][1]
+        if any(r[1] != sf for r in regs):
+            raise Unsupported("Register width mismatch")
+        rd, rn, rm = (r[0] for r in regs[:3])
+        if mn in ("udiv", "sdiv"):
+            return (sf << 31 | (0x1ac00800 if mn == "udiv" else 0x1ac00c00) | rm << 16 |
+                    rn << 5 | rd)
+        ra = regs[3][0] if mn in ("madd", "msub") else 31
+        o0 = int(mn in ("msub", "mneg"))
+        return sf << 31 | 0x1b000000 | rm << 16 | o0 << 15 | ra << 10 | rn << 5 | rd
+
+    def _csel(self, mn, ops):
+        rd, sf = self._reg(ops[0])
+        if mn in ("cset", "csetm"):
+            rn = rm = 31
+            cond = CONDS[ops[1].strip().lower()] ^ 1
+            mn = "csinc" if mn == "cset" else "csinv"
+        elif mn == "cinc":
+            rn, sfn = self._reg(ops[1])
+            rm = rn
+            cond = CONDS[ops[2].strip().lower()] ^ 1
+            mn = "csinc"
+        else:
+            rn, sfn = self._reg(ops[1])
+            rm, sfm = self._reg(ops[2])
+            cond = CONDS[ops[3].strip().lower()]
+        if cond >> 1 == 7 and mn != "csel" and len(ops) < 4:
+            raise Unsupported("al/nv condition in alias")
+        base = {"csel": 0x1a800000, "csinc": 0x1a800400,
+                "csinv": 0x5a800000, "csneg": 0x5a800400}[mn]
+        return sf << 31 | base | rm << 16 | cond << 12 | rn << 5 | rd
+
+def assemble(source, addr=0):
+    '''Assemble source for load address addr. Returns (data, {symbol: value}).
+
+    Literal pools (ldr =imm), alignment directives and sections that need
+    padding raise Unsupported: their layout differs between GNU as and LLVM
+    and is left to the toolchain.'''
+    return _Assembler(addr).run(source)
+
+# Disassembly of the same subset, in objdump-like syntax
+
+_sysreg_names = None
+
+def _sysreg_name(enc):
+    global _sysreg_names
+    if _sysreg_names is None:
+        from .sysreg import sysreg_rev
+        _sysreg_names = sysreg_rev
+    name = _sysreg_names.get(enc)
+    if name is None:
+        name = "s%d_%d_c%d_c%d_%d" % enc
+    return name
+
+_SYS_NAMES = {(op1, crn, crm, op2): (kind, name)
+              for kind, ops in SYS_OPS.items()
+              for name, (op1, crn, crm, op2, has_reg) in ops.items()}
+_HINT_NAMES = {v: k for k, v in HINTS.items()}
+_BARRIER_NAMES = {v: k for k, v in BARRIER_OPTS.items()}
+_COND_NAMES = ["eq", "ne", "hs", "lo", "mi", "pl", "vs", "vc",
+               "hi", "ls", "ge", "lt", "gt", "le", "al", "nv"]
+_EXC_NAMES = {v: k for k, v in EXCEPTIONS.items()}
+_PSTATE_NAMES = {v: k for k, v in PSTATE.items()}
+
+def _sext(val, bits):
+    return val - (1 << bits) if val & (1 << (bits - 1)) else val
+
+def _rn(n, sf, sp=False):
+    if n == 31:
+        if sp:
+            return "sp" if sf else "wsp"
+        return "xzr" if sf else "wzr"
+    return ("x" if sf else "w") + str(n)
+
+def _bitmask(n, immr, imms, sf):
+    '''Value of a logical immediate, or None if the encoding is reserved'''
+    ones = (n << 6 | (~imms & 0x3f)).bit_length() - 1
+    if ones < 1:
+        return None
+    size = 1 << ones
+    s = imms & (size - 1)
+    r = immr
+    if s == size - 1 or r >= size:
+        # Reserved, or not how an assembler would have encoded it
+        return None
+    elt = (1 << (s + 1)) - 1
+    elt = ((elt >> r) | (elt << (size - r))) & ((1 << size) - 1)
+    val = 0
+    for i in range(0, 64 if sf else 32, size):
+        val |= elt << i
+    return val
+
+def _shift_text(kind, amount):
+    return f", {['lsl', 'lsr', 'asr', 'ror'][kind]} #{amount}" if amount or kind else ""
+
+def _target(pc, offset):
+    return (pc + offset) & 0xffffffffffffffff
+
+def disassemble(insn, pc=0):
+    '''Disassemble one instruction at pc. Returns "mnemonic\\toperands", or
+    None for anything outside the supported subset.'''
+    i = insn
+    sf = i >> 31
+    rd = i & 31
+    rn = (i >> 5) & 31
+    rm = (i >> 16) & 31
+
+    if i in _HINT_NAMES:
+        return _HINT_NAMES[i]
+    if i & 0xfffffc1f in (0xd65f0000, 0xd61f0000, 0xd63f0000):
+        mn = {0xd65f0000: "ret", 0xd61f0000: "br", 0xd63f0000: "blr"}[i & 0xfffffc1f]
+        if mn == "ret" and rn == 30:
+            return "ret"
+        return f"{mn}\t{_rn(rn, 1)}"
+    if i & 0xfffff0ff in (0xd503309f, 0xd50330bf, 0xd50330df):
+        mn = {0xd503309f: "dsb", 0xd50330bf: "dmb", 0xd50330df: "isb"}[i & 0xfffff0ff]
+        crm = (i >> 8) & 15
+        if mn == "isb" and crm == 15:
+            return "isb"
+        return f"{mn}\t{_BARRIER_NAMES.get(crm, f'#{crm:#x}')}"
+    if i & 0x7c000000 == 0x14000000:
+        return f"{'bl' if sf else 'b'}\t{_target(pc, 4 * _sext(i & 0x3ffffff, 26)):#x}"
+    if i & 0xff000010 == 0x54000000:
+        return f"b.{_COND_NAMES[i & 15]}\t{_target(pc, 4 * _sext((i >> 5) & 0x7ffff, 19)):#x}"
+    if i & 0x7e000000 == 0x34000000:
+        return (f"{'cbnz' if i & (1 << 24) else 'cbz'}\t{_rn(rd, sf)}, "
+                f"{_target(pc, 4 * _sext((i >> 5) & 0x7ffff, 19)):#x}")
+    if i & 0x7e000000 == 0x36000000:
+        bit = (sf << 5) | ((i >> 19) & 31)
+        return (f"{'tbnz' if i & (1 << 24) else 'tbz'}\t{_rn(rd, sf)}, #{bit}, "
+                f"{_target(pc, 4 * _sext((i >> 5) & 0x3fff, 14)):#x}")
+    if i & 0x1f000000 == 0x10000000:
+        imm = _sext(((i >> 5) & 0x7ffff) << 2 | ((i >> 29) & 3), 21)
+        if sf:
+            return f"adrp\t{_rn(rd, 1)}, {_target(pc & ~0xfff, imm << 12):#x}"
+        return f"adr\t{_rn(rd, 1)}, {_target(pc, imm):#x}"
+    if i & 0xffe0001f in _EXC_NAMES:
+        return f"{_EXC_NAMES[i & 0xffe0001f]}\t#{(i >> 5) & 0xffff:#x}"
+    if i & 0xfff8f01f == 0xd500401f:
+        field = _PSTATE_NAMES.get(((i >> 16) & 7, (i >> 5) & 7))
+        if field is None:
+            return None
+        return f"msr\t{field}, #{(i >> 8) & 15:#x}"
+    if i & 0xfff80000 == 0xd5080000:
+        op1, crn, crm, op2 = (i >> 16) & 7, (i >> 12) & 15, (i >> 8) & 15, (i >> 5) & 7
+        reg = f", {_rn(rd, 1)}" if rd != 31 else ""
+        name = _SYS_NAMES.get((op1, crn, crm, op2))
+        if name is not None:
+            return f"{name[0]}\t{name[1]}{reg}"
+        return f"sys\t#{op1}, C{crn}, C{crm}, #{op2}{reg}"
+    if i & 0xffd00000 in (0xd5100000, 0xd5300000):
+        reg = _sysreg_name((2 | (i >> 19) & 1, (i >> 16) & 7, (i >> 12) & 15,
+                            (i >> 8) & 15, (i >> 5) & 7))
+        if i & (1 << 21):
+            return f"mrs\t{_rn(rd, 1)}, {reg}"
+        return f"msr\t{reg}, {_rn(rd, 1)}"
+
+    # Data processing, immediate
+    if i & 0x1f800000 == 0x12800000:
+        opc, hw, imm = (i >> 29) & 3, (i >> 21) & 3, (i >> 5) & 0xffff
+        if opc == 1 or (not sf and hw > 1):
+            return None
+        if opc == 2 and (imm or not hw):
+            return f"mov\t{_rn(rd, sf)}, #{imm << (16 * hw):#x}"
+        if opc == 0 and (imm or not hw) and (sf or imm != 0xffff):
+            val = ~(imm << (16 * hw)) & ((1 << (64 if sf else 32)) - 1)
+            return f"mov\t{_rn(rd, sf)}, #{val:#x}"
+        mn = ["movn", None, "movz", "movk"][opc]
+        return f"{mn}\t{_rn(rd, sf)}, #{imm:#x}" + (f", lsl #{16 * hw}" if hw else "")
+    if i & 0x1f000000 == 0x11000000:
+        if i & (1 << 23):
+            return None
+        sub, setflags, sh = (i >> 30) & 1, (i >> 29) & 1, (i >> 22) & 1
+        imm = (i >> 10) & 0xfff
+        shift = ", lsl #12" if sh else ""
+        if not sub and not setflags and not imm and not sh and (rd == 31 or rn == 31):
+            return f"mov\t{_rn(rd, sf, True)}, {_rn(rn, sf, True)}"
+        if setflags and rd == 31:
+            return f"{'cmp' if sub else 'cmn'}\t{_rn(rn, sf, True)}, #{imm:#x}{shift}"
+        mn = ("sub" if sub else "add") + ("s" if setflags else "")
+        return f"{mn}\t{_rn(rd, sf, not setflags)}, {_rn(rn, sf, True)}, #{imm:#x}{shift}"
+    if i & 0x1f800000 == 0x12000000:
+        opc, n = (i >> 29) & 3, (i >> 22) & 1
+        if n and not sf:
+            return None
+        val = _bitmask(n, (i >> 16) & 0x3f, (i >> 10) & 0x3f, sf)
+        if val is None:
+            return None
+        if opc == 3 and rd == 31:
+            return f"tst\t{_rn(rn, sf)}, #{val:#x}"
+        if opc == 1 and rn == 31 and _wide_imm(val, sf) is None and _wide_imm(~val, sf) is None:
+            return f"mov\t{_rn(rd, sf, True)}, #{val:#x}"
+        mn = ["and", "orr", "eor", "ands"][opc]
+        return f"{mn}\t{_rn(rd, sf, opc != 3)}, {_rn(rn, sf)}, #{val:#x}"
+    if i & 0x1f800000 == 0x13000000:
+        opc, n = (i >> 29) & 3, (i >> 22) & 1
+        immr, imms = (i >> 16) & 0x3f, (i >> 10) & 0x3f
+        width = 64 if sf else 32
+        if opc == 3 or n != sf or immr >= width or imms >= width:
+            return None
+        d, s = _rn(rd, sf), _rn(rn, sf)
+        if opc == 2:
+            if imms == width - 1:
+                return f"lsr\t{d}, {s}, #{immr}"
+            if imms + 1 == immr:
+                return f"lsl\t{d}, {s}, #{width - 1 - imms}"
+            if not sf and immr == 0 and imms in (7, 15):
+                return f"uxt{'b' if imms == 7 else 'h'}\t{d}, {s}"
+            if imms < immr:
+                return f"ubfiz\t{d}, {s}, #{width - immr}, #{imms + 1}"
+            return f"ubfx\t{d}, {s}, #{immr}, #{imms - immr + 1}"
+        if opc == 0:
+            if imms == width - 1:
+                return f"asr\t{d}, {s}, #{immr}"
+            if immr == 0 and imms in (7, 15, 31):
+                return f"sxt{ {7: 'b', 15: 'h', 31: 'w'}[imms]}\t{d}, {_rn(rn, 0)}"
+            if imms < immr:
+                return f"sbfiz\t{d}, {s}, #{width - immr}, #{imms + 1}"
+            return f"sbfx\t{d}, {s}, #{immr}, #{imms - immr + 1}"
+        if imms < immr:
+            return f"bfi\t{d}, {s}, #{width - immr}, #{imms + 1}"
+        return f"bfxil\t{d}, {s}, #{immr}, #{imms - immr + 1}"
+
+    # Data processing, register
+    if i & 0x1f000000 == 0x0a000000:
+        opc, n = (i >> 29) & 3, (i >> 21) & 1
+        kind, amount = (i >> 22) & 3, (i >> 10) & 0x3f
+        if not sf and amount > 31:
+            return None
+        shift = _shift_text(kind, amount)
+        if opc == 1 and rn == 31 and not shift:
+            return f"{'mvn' if n else 'mov'}\t{_rn(rd, sf)}, {_rn(rm, sf)}"
+        if opc == 3 and rd == 31 and not n:
+            return f"tst\t{_rn(rn, sf)}, {_rn(rm, sf)}{shift}"
+        mn = [["and", "orr", "eor", "ands"], ["bic", "orn", "eon", "bics"]][n][opc]
+        return f"{mn}\t{_rn(rd, sf)}, {_rn(rn, sf)}, {_rn(rm, sf)}{shift}"
+    if i & 0x1f200000 == 0x0b000000:
+        sub, setflags = (i >> 30) & 1, (i >> 29) & 1
+        kind, amount = (i >> 22) & 3, (i >> 10) & 0x3f
+        if kind == 3 or (not sf and amount > 31):
+            return None
+        shift = _shift_text(kind, amount)
+        if setflags and rd == 31:
+            return f"{'cmp' if sub else 'cmn'}\t{_rn(rn, sf)}, {_rn(rm, sf)}{shift}"
+        if sub and rn == 31:
+            return f"neg{'s' if setflags else ''}\t{_rn(rd, sf)}, {_rn(rm, sf)}{shift}"
+        mn = ("sub" if sub else "add") + ("s" if setflags else "")
+        return f"{mn}\t{_rn(rd, sf)}, {_rn(rn, sf)}, {_rn(rm, sf)}{shift}"
+    if i & 0x7fe00000 == 0x1b000000:
+        ra, neg = (i >> 10) & 31, (i >> 15) & 1
+        regs = f"{_rn(rd, sf)}, {_rn(rn, sf)}, {_rn(rm, sf)}"
+        if ra == 31:
+            return f"{'mneg' if neg else 'mul'}\t{regs}"
+        return f"{'msub' if neg else 'madd'}\t{regs}, {_rn(ra, sf)}"
+    if i & 0x7fe0e000 == 0x1ac04000:
+        c, sz = (i >> 12) & 1, (i >> 10) & 3
+        if sf != (sz == 3):
+            return None
+        return f"crc32{'c' if c else ''}{'bhwx'[sz]}\t{_rn(rd, 0)}, {_rn(rn, 0)}, {_rn(rm, sf)}"
+    if i & 0x7fe00000 == 0x1ac00000:
+        mn = {2: "udiv", 3: "sdiv", 8: "lsl", 9: "lsr", 10: "asr", 11: "ror"}.get((i >> 10) & 0x3f)
+        if mn is None:
+            return None
+        return f"{mn}\t{_rn(rd, sf)}, {_rn(rn, sf)}, {_rn(rm, sf)}"
+    if i & 0x7fff0000 == 0x5ac00000:
+        mn = {0: "rbit", 4: "clz", 2 + sf: "rev"}.get((i >> 10) & 0x3f)
+        if mn is None:
+            return None
+        return f"{mn}\t{_rn(rd, sf)}, {_rn(rn, sf)}"
+    if i & 0x3fe00800 == 0x1a800000:
+        op, o2, cond = (i >> 30) & 1, (i >> 10) & 1, (i >> 12) & 15
+        if rn == rm and cond >> 1 != 7 and (op, o2) in ((0, 1), (1, 0)):
+            if rn == 31:
+                return f"{'cset' if o2 else 'csetm'}\t{_rn(rd, sf)}, {_COND_NAMES[cond ^ 1]}"
+            if o2:
+                return f"cinc\t{_rn(rd, sf)}, {_rn(rn, sf)}, {_COND_NAMES[cond ^ 1]}"
+        mn = [["csel", "csinc"], ["csinv", "csneg"]][op][o2]
+        return f"{mn}\t{_rn(rd, sf)}, {_rn(rn, sf)}, {_rn(rm, sf)}, {_COND_NAMES[cond]}"
+
+    # Loads and stores of general purpose registers
+    if i & (1 << 26):
+        return None
+    if i & 0x3b000000 == 0x18000000:
+        opc = i >> 30
+        if opc == 3:
+            return None
+        mn = "ldrsw" if opc == 2 else "ldr"
+        return f"{mn}\t{_rn(rd, opc != 0)}, {_target(pc, 4 * _sext((i >> 5) & 0x7ffff, 19)):#x}"
+    if i & 0x3a000000 == 0x28000000:
+        opc, mode, load = i >> 30, (i >> 23) & 3, (i >> 22) & 1
+        if opc == 3 or (opc == 1 and not load) or mode == 0:
+            return None
+        mn = ("ldp" if load else "stp") + ("sw" if opc == 1 else "")
+        imm = _sext((i >> 15) & 0x7f, 7) << (3 if opc == 2 else 2)
+        regs = f"{_rn(rd, opc != 0)}, {_rn((i >> 10) & 31, opc != 0)}"
+        base = _rn(rn, 1, True)
+        if mode == 1:
+            return f"{mn}\t{regs}, [{base}], #{imm}"
+        addr = f"[{base}, #{imm}]" if imm else f"[{base}]"
+        return f"{mn}\t{regs}, {addr}" + ("!" if mode == 3 else "")
+    if i & 0x3a000000 == 0x38000000:
+        size, opc = i >> 30, (i >> 22) & 3
+        if (size == 3 and opc >= 2) or (size == 2 and opc == 3):
+            return None
+        sfx = ["b", "h", "w" if opc == 2 else "", ""][size]
+        rt = _rn(rd, size == 3 if opc < 2 else opc == 2)
+        base = _rn(rn, 1, True)
+        name = lambda kind: ("st" if opc == 0 else "ld") + kind + ("s" if opc >= 2 else "") + sfx
+        if i & (1 << 24):
+            imm = ((i >> 10) & 0xfff) << size
+            addr = f"[{base}, #{imm}]" if imm else f"[{base}]"
+            return f"{name('r')}\t{rt}, {addr}"
+        if i & (1 << 21):
+            option, s = (i >> 13) & 7, (i >> 12) & 1
+            if i & 0xc00 != 0x800 or option not in (2, 3, 6, 7):
+                return None
+            ext = {2: "uxtw", 3: "lsl", 6: "sxtw", 7: "sxtx"}[option]
+            if s:
+                ext = f", {ext} #{size}"
+            elif option == 3:
+                ext = ""
+            else:
+                ext = f", {ext}"
+            return f"{name('r')}\t{rt}, [{base}, {_rn(rm, option & 1)}{ext}]"
+        imm = _sext((i >> 12) & 0x1ff, 9)
+        mode = (i >> 10) & 3
+        if mode == 0:
+            addr = f"[{base}, #{imm}]" if imm else f"[{base}]"
+            return f"{name('ur')}\t{rt}, {addr}"
+        if mode == 1:
+            return f"{name('r')}\t{rt}, [{base}], #{imm}"
+        if mode == 3:
+            return f"{name('r')}\t{rt}, [{base}, #{imm}]!"
+    return None
+
+# (source, load address, expected little-endian words, or None if it must
+# raise Unsupported), checked by -t against the toolchain as well.
+CORPUS = [
+    ("ret", 0, [0xd65f03c0]),
+    ("nop; isb; dsb sy; dmb ish; wfe; sev; wfi; eret",
+     0, [0xd503201f, 0xd5033fdf, 0xd5033f9f, 0xd5033bbf, 0xd503205f, 0xd503209f,
+         0xd503207f, 0xd69f03e0]),
+    ("ldr x1, [x0]; str x1, [x0]; ldr x1, [x0, #8]; str x2, [x1], #8; str x2, [x1, #8]!",
+     0, [0xf9400001, 0xf9000001, 0xf9400401, 0xf8008422, 0xf8008c22]),
+    ("ldr x0, [x1, #-8]; ldr w9, [x8, #4]; strb w0, [x1, #1]; ldrh w2, [x3, #2]",
+     0, [0xf85f8020, 0xb9400509, 0x39000420, 0x79400462]),
+    ("ldp x4, x5, [x1], #16; stp x4, x5, [x2]; stp x29, x30, [sp, #-16]!; ldp x29, x30, [sp], #16",
+     0, [0xa8c11424, 0xa9001444, 0xa9bf7bfd, 0xa8c17bfd]),
+    ("mov x2, x0; mov x0, #0; mov x0, #0x10000; mov x2, #0xffffffffffffffff; mov w0, #-1; "
+     "mov x0, sp; mov sp, x1; mov x0, #0xff00ff00ff00ff00",
+     0, [0xaa0003e2, 0xd2800000, 0xd2a00020, 0x92800002, 0x12800000, 0x910003e0, 0x9100003f,
+         0xb2089fe0]),
+    ("movz x0, #0x1234, lsl #16; movk x0, #0x5678; movk x0, #0xdead, lsl #48",
+     0, [0xd2a24680, 0xf28acf00, 0xf2fbd5a0]),
+    ("add x2, x2, #0x800; sub x0, x0, #1; sub x0, x2, x1; add x2, x2, #16, lsl #12; "
+     "add x0, x1, #0x10000; cmp x2, x3; cmp x0, #4; subs x1, x1, #1",
+     0, [0x91200042, 0xd1000400, 0xcb010040, 0x91404042, 0x91404020, 0xeb03005f, 0xf100101f,
+         0xf1000421]),
+    ("orr x2, x2, #1; and x0, x0, #0xff; bfi x7, x9, #3, #1; lsl x0, x1, #4; lsr x0, x1, #4; "
+     "ubfx x0, x1, #8, #8; tst x0, #1",
+     0, [0xb2400042, 0x92401c00, 0xb37d0127, 0xd37cec20, 0xd344fc20, 0xd3483c20, 0xf240001f]),
+    ("mrs x2, CNTPCT_EL0; mrs x2, s3_1_c15_c0_0; msr s3_1_c15_c0_0, x2; mrs x0, s3_0_c0_c0_0; "
+     "msr daifset, #2",
+     0, [0xd53be022, 0xd539f002, 0xd519f002, 0xd5380000, 0xd50342df]),
+    ("dc cvau, x2; ic ivau, x2; dc civac, x0; ic iallu; tlbi vmalls12e1is",
+     0, [0xd50b7b22, 0xd50b7522, 0xd50b7e20, 0xd508751f, 0xd50c83df]),
+    ("1: sub x0, x0, #1; cbnz x0, 1b; b.eq 2f; b 1b; 2: ret",
+     0, [0xd1000400, 0xb5ffffe0, 0x54000040, 0x17fffffd, 0xd65f03c0]),
+    ("mul x0, x1, x2; udiv x0, x1, x2; madd x0, x1, x2, x3; cset x0, eq; csel x0, x1, x2, ne",
+     0, [0x9b027c20, 0x9ac20820, 0x9b020c20, 0x9a9f17e0, 0x9a821020]),
+    ("crc32x w2, w2, x4; crc32b w2, w2, w4; crc32cw w0, w1, w2",
+     0, [0x9ac44c42, 0x1ac44042, 0x1ac25820]),
+    ("svc 1; hvc #0; brk #0x1234", 0, [0xd4000021, 0xd4000002, 0xd4224680]),
+    # ARMAsm HEADER/FOOTER around the asm.py self-test, without the literal
+    (".text\n.globl _start\n_start:\nmov x0, #0xbeef\nb test\nmrs x0, spsel\nsvc 1\n"
+     "test:\nb test\nret\n.pool\n",
+     0x1238, [0xd297dde0, 0x14000003, 0xd5384200, 0xd4000021, 0x14000000, 0xd65f03c0]),
+    # Rejected, left to the toolchain: register 31 would be sp, and layouts
+    # that differ between assemblers
+    ("add xzr, x0, #1", 0, None),
+    ("sub wzr, w0, #1", 0, None),
+    ("orr xzr, x0, #1", 0, None),
+    ("ldr x0, =0xdeadbeef; .pool", 0, None),
+    ("nop; .align 3; ret", 0, None),
+    ("ret; .byte 1", 0, None),
+]
+
+def _check(use_toolchain=False):
+    from .asm import ARMAsm
+    fails = 0
+    for source, addr, expect in CORPUS:
+        if expect is None:
+            try:
+                assemble(source, addr)
+            except Unsupported:
+                continue
+            fails += 1
+            print(f"MISMATCH (accepted): {source!r}")
+            continue
+        data, symbols = assemble(source, addr)
+        words = list(struct.unpack(f"<{len(data) // 4}I", data))
+        results = [("expected", expect)]
+        if use_toolchain:
+            ref = ARMAsm(source, addr, builtin=False)
+            results.append(("toolchain", list(struct.unpack(f"<{len(ref.data) // 4}I", ref.data))))
+        for what, ref in results:
+            if words != ref:
+                fails += 1
+                print(f"MISMATCH ({what}): {source!r}")
+                print("  builtin: " + " ".join(f"{i:08x}" for i in words))
+                print("  " + f"{what}:".ljust(9) + " " + " ".join(f"{i:08x}" for i in ref))
+        # Disassembly must assemble back to the same word, where the text
+        # is assemblable on its own (not e.g. branches to absolute targets)
+        for idx, word in enumerate(words):
+            text = disassemble(word, addr + 4 * idx)
+            if text is None:
+                continue
+            try:
+                again, = struct.unpack("<I", assemble(text.replace("\t", " "), addr + 4 * idx)[0])
+            except Unsupported:
+                continue
+            if again != word:
+                fails += 1
+                print(f"MISMATCH (disassembly): {word:08x} -> {text!r} -> {again:08x}")
+    print(f"{len(CORPUS)} cases, {fails} mismatches")
+    return fails
+
+if __name__ == "__main__":
+    import argparse, sys
+    parser = argparse.ArgumentParser(description='Check the built-in A64 assembler')
+    parser.add_argument('-t', '--toolchain', action="store_true",
+                        help="Also compare against the cross toolchain")
+    args = parser.parse_args()
+    sys.exit(1 if _check(args.toolchain) else 0)
@@ -1,7 +1,10 @@
 # SPDX-License-Identifier: MIT
-import os, tempfile, shutil, subprocess
+import os, tempfile, shutil, subprocess, hashlib, json, functools
+from collections import OrderedDict
 
-__all__ = ["AsmException", "ARMAsm"]
+from . import a64
+
+__all__ = ["AsmException", "ARMAsm", "disassemble"]
 
 uname = os.uname()
 
@@ -32,23 +35,158 @@ else:
     OBJDUMP = toolchain + "%ARCHobjdump"
     NM = toolchain + "%ARCHnm"
 
+# Assembly results are cached on disk, keyed by source, flags and toolchain
+# version. Set M1N1ASMCACHE to another directory, or to "off" to disable.
+CACHE_DIR = os.environ.get("M1N1ASMCACHE",
+    os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "m1n1", "asm"))
+CACHE_VERSION = 1
+
+# Set M1N1BUILTINASM=0 to always use the toolchain instead of m1n1.a64
+USE_BUILTIN = os.environ.get("M1N1BUILTINASM", "1").strip() == "1"
+
+# Bits flipped in the link address to tell whether code is position
+# independent. High bits only, so alignments and adrp page offsets are kept;
+# between them they change every 16-bit group above the lowest, so absolute
+# uses that only see some of the address (e.g. movz/movk #:abs_g2:) differ.
+RELOC_PROBES = (1 << 24, 1 << 40 | 1 << 56)
+
 class AsmException(Exception):
     pass
 
+@functools.lru_cache(None)
+def _toolchain_version(arch):
+    ver = []
+    for program in (CC, LD):
+        try:
+            out = subprocess.check_output(program.replace("%ARCH", arch) + " --version",
+                                          shell=True, stderr=subprocess.DEVNULL)
+            ver.append(out.decode("ascii", "replace").split("\n")[0])
+        except (OSError, subprocess.CalledProcessError):
+            ver.append(None)
+    return ver
+
 class BaseAsm(object):
-    def __init__(self, source, addr = 0):
+    BUILTIN = False
+
+    def __init__(self, source, addr = 0, builtin = True, quiet = False):
         self.source = source
-        self._tmp = tempfile.mkdtemp() + os.sep
+        self.quiet = quiet
+        self._tmp = None
+        self.elffile = None
         self.addr = addr
-        self.compile(source)
+        if builtin and self._load_builtin():
+            return
+        if not self._load_cached():
+            self.compile(source)
+            self._save_cached()
 
     def _call(self, program, args):
-        subprocess.check_call(program.replace("%ARCH", self.ARCH) + " " + args, shell=True)
+        subprocess.check_call(program.replace("%ARCH", self.ARCH) + " " + args, shell=True,
+                              stderr=subprocess.DEVNULL if self.quiet else None)
 
     def _get(self, program, args):
-        return subprocess.check_output(program.replace("%ARCH", self.ARCH) + " " + args, shell=True).decode("ascii")
+        return subprocess.check_output(program.replace("%ARCH", self.ARCH) + " " + args, shell=True,
+                                       stderr=subprocess.DEVNULL if self.quiet else None).decode("ascii")
+
+    def _load_builtin(self):
+        if not (USE_BUILTIN and self.BUILTIN):
+            return False
+        try:
+            data, symbols = a64.assemble("\n".join((self.HEADER, self.source, self.FOOTER)),
+                                         self.addr)
+        except a64.Unsupported:
+            return False
+        self._set_result(data, symbols.items())
+        return True
+
+    def _cache_key(self, addr):
+        key = json.dumps([CACHE_VERSION, self.ARCH, self.CFLAGS, self.LDFLAGS, self.HEADER,
+                          self.FOOTER, _toolchain_version(self.ARCH), self.source, addr])
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _cache_path(self, key):
+        return os.path.join(CACHE_DIR, key[:2], key + ".json")
+
+    def _load_cached(self):
+        if CACHE_DIR == "off":
+            return False
+        # Position independent code is stored without an address and relocated
+        for key in (self._cache_key(None), self._cache_key(self.addr)):
+            try:
+                with open(self._cache_path(key)) as fd:
+                    ent = json.load(fd)
+                data = bytes.fromhex(ent["data"])
+            except (OSError, ValueError, KeyError):
+                continue
+            delta = self.addr - ent["addr"]
+            self._set_result(data, [(name, addr + delta if reloc else addr)
+                                    for name, addr, reloc in ent["symbols"]])
+            return True
+        return False
+
+    def _save_cached(self):
+        if CACHE_DIR == "off":
+            return
+        symbols = [(name, addr, type not in "aA") for name, type, addr in self._symbols]
+        try:
+            # Link again elsewhere: if nothing but the symbols moved, the
+            # result can be reused at any address
+            pic = True
+            for bits in RELOC_PROBES:
+                probe = self.addr ^ bits
+                data, probe_symbols = self._link(probe)
+                pic = data == self.data and all(
+                    a2 - a1 == (probe - self.addr if reloc else 0)
+                    for (n1, a1, reloc), (n2, t2, a2) in zip(symbols, probe_symbols))
+                if not pic:
+                    break
+        except (OSError, ValueError, subprocess.CalledProcessError):
+            pic = False
+        ent = {
+            "addr": self.addr,
+            "data": self.data.hex(),
+            "symbols": symbols,
+        }
+        path = self._cache_path(self._cache_key(None if pic else self.addr))
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+            with os.fdopen(fd, "w") as fd:
+                json.dump(ent, fd)
+            os.replace(tmp, path)
+        except OSError:
+            pass
+
+    def _set_result(self, data, symbols):
+        self.data = data
+        for name, addr in symbols:
+            setattr(self, name, addr)
+        self.start = self._start
+        self.len = len(self.data)
+        self.end = self.start + self.len
 
-    def compile(self, source):
+    def _link(self, addr):
+        elffile = self._tmp + f"b_{addr:x}.elf"
+        bfile = self._tmp + f"b_{addr:x}.b"
+        self._call(LD, f"{self.LDFLAGS} --Ttext={addr:#x} -o {elffile} {self.ofile}")
+        self._call(OBJCOPY, f"-j.text -O binary {elffile} {bfile}")
+
+        with open(bfile, "rb") as fd:
+            data = fd.read()
+
+        symbols = []
+        for line in self._get(NM, elffile).split("\n"):
+            if not line:
+                continue
+            addr, type, name = line.split()
+            symbols.append((name, type, int(addr, 16)))
+        return data, symbols
+
+    def compile(self, source=None):
+        if source is None:
+            source = self.source
+        if self._tmp is None:
+            self._tmp = tempfile.mkdtemp() + os.sep
         self.sfile = self._tmp + "b.S"
         with open(self.sfile, "w") as fd:
             fd.write(self.HEADER + "\n")
@@ -56,33 +194,23 @@ class BaseAsm(object):
             fd.write(self.FOOTER + "\n")
 
         self.ofile = self._tmp + "b.o"
-        self.elffile = self._tmp + "b.elf"
-        self.bfile = self._tmp + "b.b"
-        self.nfile = self._tmp + "b.n"
-
         self._call(CC, f"{self.CFLAGS} -c -o {self.ofile} {self.sfile}")
-        self._call(LD, f"{self.LDFLAGS} --Ttext={self.addr:#x} -o {self.elffile} {self.ofile}")
-        self._call(OBJCOPY, f"-j.text -O binary {self.elffile} {self.bfile}")
-        self._call(NM, f"{self.elffile} > {self.nfile}")
-
-        with open(self.bfile, "rb") as fd:
-            self.data = fd.read()
-
-        with open(self.nfile) as fd:
-            for line in fd:
-                line = line.replace("\n", "")
-                addr, type, name = line.split()
-                addr = int(addr, 16)
-                setattr(self, name, addr)
-        self.start = self._start
-        self.len = len(self.data)
-        self.end = self.start + self.len
+
+        self.data, self._symbols = self._link(self.addr)
+        self.elffile = self._tmp + f"b_{self.addr:x}.elf"
+        self._set_result(self.data, [(name, addr) for name, type, addr in self._symbols])
+
+    def _elf(self):
+        # Cache hits have no ELF, build one on demand
+        if self.elffile is None:
+            self.compile()
+        return self.elffile
 
     def objdump(self):
-        self._call(OBJDUMP, f"-rd {self.elffile}")
+        self._call(OBJDUMP, f"-rd {self._elf()}")
 
     def disassemble(self):
-        output = self._get(OBJDUMP, f"-zd {self.elffile}")
+        output = self._get(OBJDUMP, f"-zd {self._elf()}")
 
         for line in output.split("\n"):
             if not line or line[0] != " ":
@@ -96,6 +224,7 @@ class BaseAsm(object):
 
 class ARMAsm(BaseAsm):
     ARCH = os.path.join(os.environ.get("ARCH", "aarch64-linux-gnu-"))
+    BUILTIN = True
     CFLAGS = "-pipe -Wall -march=armv8.2-a"
     LDFLAGS = "-maarch64elf"
     HEADER = """
@@ -107,6 +236,68 @@ _start:
     .pool
     """
 
+# (pc, instruction) -> disassembly text, in LRU order
+DISASM_CACHE_SIZE = 65536
+_disasm_cache = OrderedDict()
+
+def _objdump(code, addr):
+    '''Disassemble with the toolchain. Returns {pc: text}, empty if the
+    toolchain is not available.'''
+    try:
+        c = ARMAsm(".inst " + ",".join(str(i) for i in code), addr, quiet=True)
+        lines = list(c.disassemble())
+    except (OSError, subprocess.CalledProcessError):
+        return {}
+    texts = {}
+    for line in lines:
+        parts = line.split("\t", 2)
+        try:
+            pc = int(parts[0].strip().rstrip(":"), 16)
+        except ValueError:
+            continue
+        texts[pc] = parts[2] if len(parts) > 2 else ""
+    return texts
+
+def disassemble(code, addr):
+    '''Disassemble a sequence of instruction words starting at addr, as
+    objdump-style lines. Instructions m1n1.a64 cannot decode go through
+    objdump in one batch; results are cached per address and opcode.'''
+    texts = []
+    missing = []
+    cache = []
+    for i, insn in enumerate(code):
+        pc = addr + 4 * i
+        key = (pc, insn)
+        text = _disasm_cache.get(key)
+        if text is None:
+            text = a64.disassemble(insn, pc)
+            if text is None:
+                missing.append(i)
+            else:
+                cache.append(i)
+        else:
+            _disasm_cache.move_to_end(key)
+        texts.append(text)
+
+    if missing:
+        first, last = missing[0], missing[-1]
+        dumped = _objdump(code[first:last + 1], addr + 4 * first)
+        for i in missing:
+            text = dumped.get(addr + 4 * i)
+            if text is None:
+                # Not cached, so it is retried once objdump works
+                text = f".inst\t{code[i]:#010x}"
+            else:
+                cache.append(i)
+            texts[i] = text
+
+    for i in cache:
+        _disasm_cache[(addr + 4 * i, code[i])] = texts[i]
+    while len(_disasm_cache) > DISASM_CACHE_SIZE:
+        _disasm_cache.popitem(last=False)
+
+    return [f"{addr + 4 * i:>12x}:\t{insn:08x} \t{text}" for i, (insn, text) in enumerate(zip(code, texts))]
+
 if __name__ == "__main__":
     import sys
     code = """
@@ -0,0 +1,510 @@
+# SPDX-License-Identifier: MIT
+# asyncio flavour of the proxy client. A reader thread feeds everything the
+# target sends into the event loop, where frames are parsed continuously:
+# replies complete the futures of outstanding requests, events go to
+# handlers and subscriber queues whether or not a request is in flight.
+#
+#   async with AsyncUartInterface() as iface:
+#       p = AsyncM1N1Proxy(iface)
+#       a, b = p.read32(addr_a), p.read32(addr_b)   # both sent right away
+#       print(await a, await b)
+#       async for evt_type, data in iface.events():
+#           ...
+import asyncio, functools, inspect, struct, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .checksum import checksum
+from .proxy import *
+from .proxy import open_device
+from .utils import hexdump, chexdump
+
+__all__ = ["AsyncUartInterface", "AsyncM1N1Proxy"]
+
+_STATUS_ERRORS = {
+    UartInterface.ST_BADCMD: "Bad Command",
+    UartInterface.ST_INVAL: "Invalid argument",
+    UartInterface.ST_XFERERR: "Data transfer failed",
+    UartInterface.ST_CSUMERR: "Data checksum failed",
+}
+
+class _Pending:
+    __slots__ = ("cmd", "future", "size", "checksum", "data")
+
+    def __init__(self, cmd, future, size=0):
+        self.cmd = cmd
+        self.future = future
+        self.size = size
+        self.checksum = None
+        self.data = None
+
+def _settle(fut, value=None, exc=None):
+    if fut.done():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(value)
+
+class AsyncUartInterface:
+    '''asyncio proxy link.
+
+    Requests are written in call order and their replies are matched in the
+    same order, so any number of them may be outstanding. Must be started
+    (start() or async with) from within the event loop that uses it.'''
+    REQ_NOP = UartInterface.REQ_NOP
+    REQ_PROXY = UartInterface.REQ_PROXY
+    REQ_MEMREAD = UartInterface.REQ_MEMREAD
+    REQ_MEMWRITE = UartInterface.REQ_MEMWRITE
+    REQ_BOOT = UartInterface.REQ_BOOT
+    REQ_EVENT = UartInterface.REQ_EVENT
+
+    PREAMBLE = UartInterface.PREAMBLE
+    CMD_LEN = UartInterface.CMD_LEN
+    REPLY_LEN = UartInterface.REPLY_LEN
+    EVENT_HDR_LEN = UartInterface.EVENT_HDR_LEN
+    READ_TIMEOUT = 0.1
+
+    def __init__(self, device=None, debug=False):
+        self.debug = debug
+        self.dev, self.devpath, self.baudrate = open_device(device)
+        self.dev.timeout = 0
+        self.dev.flushOutput()
+        self.dev.flushInput()
+        self.tty_enable = True
+        self.pted = False
+        self.handlers = {}
+        self.evt_handlers = {}
+        self.enabled_features = Feature(0)
+        self.metrics = None
+        self.loop = None
+        self.pending = deque()
+        self.boot_waiters = []
+        self.subscribers = []
+        self._buf = bytearray()
+        self._rx = None
+        self._error = None
+        self._stop = threading.Event()
+        self._reader = None
+        self._writer = None
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.dev.timeout = self.READ_TIMEOUT
+        self._writer = ThreadPoolExecutor(1, "m1n1-writer")
+        self._reader = threading.Thread(target=self._read_thread, name="m1n1-reader",
+                                        daemon=True)
+        self._reader.start()
+
+    async def close(self):
+        self._stop.set()
+        if self._reader is not None:
+            await self.loop.run_in_executor(None, self._reader.join)
+            self._reader = None
+        if self._writer is not None:
+            self._writer.shutdown()
+            self._writer = None
+        self._fail_all(UartError("Interface closed"))
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+        return False
+
+    # Link I/O
+
+    def _read_thread(self):
+        dev = self.dev
+        while not self._stop.is_set():
+            try:
+                data = dev.read(max(1, min(getattr(dev, "in_waiting", 0), 1 << 20)))
+            except Exception as e:
+                self.loop.call_soon_threadsafe(self._fail_all, e)
+                return
+            if data:
+                self.loop.call_soon_threadsafe(self._feed, data)
+
+    def _write(self, data):
+        if self._error is not None:
+            raise self._error
+        fut = self._writer.submit(self.dev.write, data)
+        fut.add_done_callback(self._write_done)
+
+    def _write_done(self, fut):
+        exc = fut.exception()
+        if exc is not None:
+            self.loop.call_soon_threadsafe(self._fail_all, exc)
+
+    def _fail_all(self, exc):
+        if self._error is None:
+            self._error = exc
+        pending, self.pending = self.pending, deque()
+        if self._rx is not None:
+            _settle(self._rx.future, exc=exc)
+            self._rx = None
+        for entry in pending:
+            _settle(entry.future, exc=exc)
+        for fut in self.boot_waiters:
+            _settle(fut, exc=exc)
+        self.boot_waiters = []
+
+    def checksum(self, data):
+        return checksum(data)
+
+    def data_checksum(self, data):
+        if self.enabled_features & Feature.DISABLE_DATA_CSUMS:
+            return UartInterface.CHECKSUM_SENTINEL
+        return checksum(data)
+
+    def cmd(self, cmd, payload=b"", data=None, size=0, reply=True):
+        '''Send a command; returns a future for its reply (the 24 reply data
+        bytes, or for MEMREAD the data read)'''
+        if len(payload) > self.CMD_LEN:
+            raise ValueError("Incorrect payload size %d"%len(payload))
+        payload = payload.ljust(self.CMD_LEN, b"\x00")
+        command = struct.pack("<I", cmd) + payload
+        command += struct.pack("<I", self.checksum(command))
+        if self.debug:
+            print("<<", hexdump(command))
+        if data is not None:
+            command += data
+            if self.enabled_features & Feature.DISABLE_DATA_CSUMS:
+                command += struct.pack("<I", UartInterface.DATA_END_SENTINEL)
+        self._write(command)
+        if not reply:
+            return None
+        fut = self.loop.create_future()
+        self.pending.append(_Pending(cmd, fut, size))
+        return fut
+
+    # Frame parsing
+
+    def unkhandler(self, s):
+        UartInterface.unkhandler(self, s)
+
+    def _feed(self, data):
+        self._buf += data
+        buf = self._buf
+        pos = 0
+        dsums = not (self.enabled_features & Feature.DISABLE_DATA_CSUMS)
+        while pos < len(buf):
+            if self._rx is not None:
+                # Bulk data following a MEMREAD reply
+                entry = self._rx
+                want = entry.size + (0 if dsums else 4) - len(entry.data)
+                take = min(want, len(buf) - pos)
+                entry.data += buf[pos:pos + take]
+                pos += take
+                if take < want:
+                    break
+                self._rx = None
+                self._finish_memread(entry, dsums)
+                continue
+
+            idx = buf.find(self.PREAMBLE, pos)
+            if idx < 0:
+                # Keep a partial preamble at the end of the buffer
+                keep = 0
+                for i in range(min(len(self.PREAMBLE) - 1, len(buf) - pos), 0, -1):
+                    if buf.endswith(self.PREAMBLE[:i]):
+                        keep = i
+                        break
+                if len(buf) - keep > pos:
+                    self.unkhandler(bytes(buf[pos:len(buf) - keep]))
+                pos = len(buf) - keep
+                break
+            if idx > pos:
+                self.unkhandler(bytes(buf[pos:idx]))
+                pos = idx
+
+            avail = len(buf) - pos
+            if avail < 4:
+                break
+            cmdin, = struct.unpack_from("<I", buf, pos)
+            if cmdin == self.REQ_EVENT:
+                if avail < self.EVENT_HDR_LEN:
+                    break
+                data_len, event_type = struct.unpack_from("<HH", buf, pos + 4)
+                frame_len = self.EVENT_HDR_LEN + data_len + 4
+                if avail < frame_len:
+                    break
+                frame = bytes(buf[pos:pos + frame_len])
+                pos += frame_len
+                self._handle_event_frame(frame, event_type)
+                continue
+
+            if avail < self.REPLY_LEN:
+                break
+            frame = bytes(buf[pos:pos + self.REPLY_LEN])
+            pos += self.REPLY_LEN
+            self._handle_reply(cmdin, frame)
+
+        del buf[:pos]
+
+    def _handle_event_frame(self, frame, event_type):
+        if self.debug:
+            print(">>", hexdump(frame))
+        csum, = struct.unpack_from("<I", frame, len(frame) - 4)
+        ccsum = self.data_checksum(frame[:-4])
+        if csum != ccsum:
+            print("Event checksum error: Expected 0x%08x, got 0x%08x"%(csum, ccsum))
+            # Events are not tied to a request, so only the event is lost
+            if self.metrics is not None:
+                self.metrics.add("csum_errors")
+            return
+        self.handle_event(EVENT(event_type), frame[self.EVENT_HDR_LEN:-4])
+
+    def _handle_reply(self, cmdin, frame):
+        if self.debug:
+            print(">>", hexdump(frame))
+        status, data, csum = struct.unpack_from("<i24sI", frame, 4)
+        ccsum = self.checksum(frame[:-4])
+        if csum != ccsum:
+            print("Reply checksum error: Expected 0x%08x, got 0x%08x"%(csum, ccsum))
+            if self.pending:
+                _settle(self.pending.popleft().future, exc=UartChecksumError())
+            return
+
+        if cmdin == self.REQ_BOOT and status == UartInterface.ST_OK:
+            self.handle_boot(data)
+            return
+        if not self.pending:
+            print(f"Unexpected reply 0x{cmdin:08x} with no request outstanding")
+            return
+
+        entry = self.pending.popleft()
+        if cmdin != entry.cmd:
+            _settle(entry.future, exc=UartCMDError(
+                "Reply command mismatch: Expected 0x%08x, got 0x%08x"%(entry.cmd, cmdin)))
+        elif status != UartInterface.ST_OK:
+            msg = _STATUS_ERRORS.get(status, f"Unknown error ({status})")
+            _settle(entry.future, exc=UartRemoteError("Reply error: " + msg))
+        elif entry.cmd == self.REQ_MEMREAD and entry.size:
+            entry.checksum, = struct.unpack_from("<I", data)
+            entry.data = bytearray()
+            self._rx = entry
+        else:
+            _settle(entry.future, data)
+
+    def _finish_memread(self, entry, dsums):
+        data = bytes(entry.data[:entry.size])
+        if self.debug:
+            print(">> DATA:")
+            chexdump(data)
+        ccsum = self.data_checksum(data)
+        if entry.checksum != ccsum:
+            _settle(entry.future, exc=UartChecksumError(
+                "Reply data checksum error: Expected 0x%08x, got 0x%08x"%(entry.checksum, ccsum)))
+            return
+        if not dsums:
+            sentinel, = struct.unpack_from("<I", entry.data, entry.size)
+            if sentinel != UartInterface.DATA_END_SENTINEL:
+                _settle(entry.future, exc=UartChecksumError(
+                    f"Reply data sentinel error: Expected "
+                    f"{UartInterface.DATA_END_SENTINEL:#x}, got {sentinel:#x}"))
+                return
+        _settle(entry.future, data)
+
+    # Boot and event dispatch
+
+    def handle_boot(self, data):
+        waiters, self.boot_waiters = self.boot_waiters, []
+        for fut in waiters:
+            _settle(fut, data)
+        UartInterface.handle_boot(self, data)
+
+    def set_handler(self, reason, code, handler):
+        self.handlers[(reason, code)] = handler
+
+    def wait_boot(self):
+        '''Future for the data of the next BOOT frame'''
+        fut = self.loop.create_future()
+        self.boot_waiters.append(fut)
+        return fut
+
+    def handle_event(self, event_id, data):
+        handler = self.evt_handlers.get(event_id, None)
+        if handler is not None:
+            ret = handler(data)
+            if inspect.isawaitable(ret):
+                self.loop.create_task(ret)
+        for queue in self.subscribers:
+            try:
+                queue.put_nowait((event_id, data))
+            except asyncio.QueueFull:
+                pass
+
+    def set_event_handler(self, event_id, handler):
+        '''handler(data) is called from the event loop for each event of
+        this type; it may be a coroutine function.'''
+        self.evt_handlers[event_id] = handler
+
+    def subscribe(self, maxsize=0):
+        '''Returns a queue receiving (event_id, data) for every event.
+        Events are dropped for a full queue.'''
+        queue = asyncio.Queue(maxsize)
+        self.subscribers.append(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.remove(queue)
+
+    async def events(self, maxsize=0):
+        '''Async iterator over (event_id, data) for all events from now on'''
+        queue = self.subscribe(maxsize)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            self.unsubscribe(queue)
+
+    # Requests
+
+    async def nop(self):
+        features = Feature.get_all()
+        result = await self.cmd(self.REQ_NOP, struct.pack("<Q", features.value))
+        self.enabled_features = Feature(struct.unpack("<QQQ", result)[0])
+        if self.debug:
+            print(f"Enabled features: {self.enabled_features}")
+
+    def proxyreq(self, req, no_reply=False):
+        '''Future for the reply data of a proxy request'''
+        return self.cmd(self.REQ_PROXY, req, reply=not no_reply)
+
+    def writemem(self, addr, data):
+        '''Sends the data right away, so it is written before any later
+        request; returns a future for completion'''
+        data = bytes(data)
+        req = struct.pack("<QQI", addr, len(data), self.data_checksum(data))
+        if self.debug:
+            print("<< DATA:")
+            chexdump(data)
+        return self.cmd(self.REQ_MEMWRITE, req, data=data)
+
+    async def readmem(self, addr, size):
+        if size == 0:
+            return b""
+        return await self.cmd(self.REQ_MEMREAD, struct.pack("<QQ", addr, size), size=size)
+
+    async def readstruct(self, addr, stype):
+        return stype.parse(await self.readmem(addr, stype.sizeof()))
+
+async def _gather(ret, issued):
+    results = await asyncio.gather(*issued, return_exceptions=True)
+    for r in results:
+        if isinstance(r, BaseException):
+            raise r
+    if inspect.isawaitable(ret):
+        return await ret
+    if ret is None and len(issued) == 1:
+        return results[0]
+    return ret
+
+def _awaitable(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        prev, self._issued = self._issued, []
+        try:
+            ret = func(self, *args, **kwargs)
+            issued = self._issued
+        finally:
+            self._issued = prev
+        return _gather(ret, issued)
+    return wrapper
+
+class AsyncM1N1Proxy(M1N1Proxy):
+    '''M1N1Proxy over an AsyncUartInterface.
+
+    Every proxy method sends its request(s) right away and returns an
+    awaitable for the result, so several requests can be outstanding at
+    once. Requests that reboot the target or reconfigure the link
+    (reload, set_baud, call(reboot=True)) are not supported.'''
+
+    def __init__(self, iface, debug=False):
+        super().__init__(iface, debug)
+        self._issued = None
+
+    def _request(self, opcode, *args, reboot=False, signed=False, no_reply=False, pre_reply=None):
+        if reboot or pre_reply:
+            raise ProxyError("Reboots and link changes are not supported by the async proxy")
+        if len(args) > 6:
+            raise ValueError("Too many arguments")
+        args = list(args) + [0] * (6 - len(args))
+        req = struct.pack("<7Q", opcode, *args)
+        if self.debug:
+            print("<<<< %08x: %08x %08x %08x %08x %08x %08x"%tuple([opcode] + args))
+        fut = self.iface.proxyreq(req, no_reply=no_reply)
+        if no_reply:
+            return None
+
+        result = self.iface.loop.create_future()
+
+        def done(f):
+            if f.cancelled():
+                result.cancel()
+            elif f.exception() is not None:
+                _settle(result, exc=f.exception())
+            else:
+                try:
+                    _settle(result, self._parse_reply(opcode, f.result(), signed))
+                except ProxyError as e:
+                    _settle(result, exc=e)
+
+        fut.add_done_callback(done)
+        if self._issued is not None:
+            self._issued.append(result)
+        return result
+
+    def request(self, opcode, *args, **kwargs):
+        args2, free, uploads = self._stage_args(args)
+        try:
+            ret = self._request(opcode, *args2, **kwargs)
+        except:
+            for i in free:
+                self.heap.free(i)
+            raise
+        if not free:
+            return ret
+
+        # The uploads were sent ahead of the request; buffers are freed
+        # once the target is done with them
+        async def finish():
+            try:
+                for fut in uploads:
+                    await fut
+                if ret is not None:
+                    return await ret
+            finally:
+                for i in free:
+                    self.heap.free(i)
+
+        task = self.iface.loop.create_task(finish())
+        if self._issued is not None:
+            self._issued.append(task)
+        return task
+
+    async def iodev_whoami(self):
+        return IODEV(await self.request(self.P_IODEV_WHOAMI))
+
+# Methods that do not issue requests stay synchronous
+_SYNC_METHODS = {"request", "batch", "opcode_name", "enable_stats", "stats", "measure",
+                 "iodev_whoami"}
+
+for _name, _func in list(M1N1Proxy.__dict__.items()):
+    if (inspect.isfunction(_func) and not _name.startswith("_")
+        and _name not in _SYNC_METHODS):
+        setattr(AsyncM1N1Proxy, _name, _awaitable(_func))
+
+if __name__ == "__main__":
+    async def main():
+        async with AsyncUartInterface() as iface:
+            await iface.nop()
+            print(f"Enabled features: {iface.enabled_features}")
+            p = AsyncM1N1Proxy(iface)
+            bootargs, base = p.get_bootargs(), p.get_base()
+            print("Boot args: 0x%x, base: 0x%x" % (await bootargs, await base))
+
+    asyncio.run(main())
@@ -0,0 +1,130 @@
+# SPDX-License-Identifier: MIT
+# Fast implementations of the m1n1 proxy checksum (see checksum_block() in
+# src/uartproxy.c). The checksum is a linear recurrence:
+#
+#   sum = sum * 31337 + (byte ^ 0x5a)   (mod 2**32)
+#
+# so a block of L bytes contributes sum_i (b_i ^ 0x5a) * 31337**(L-1-i), and
+# the running sum is scaled by 31337**L. That dot product vectorizes nicely.
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__all__ = ["checksum", "checksum_ref", "IMPLEMENTATIONS"]
+
+CHECKSUM_INIT = 0xDEADBEEF
+CHECKSUM_FINAL = 0xADDEDBAD
+CHECKSUM_MULT = 31337
+MASK = 0xffffffff
+
+# Below these sizes the setup cost of the faster paths is not worth it
+TABLE_THRESHOLD = 64
+NUMPY_THRESHOLD = 4096
+
+def _update_ref(sum, data):
+    for c in data:
+        sum *= CHECKSUM_MULT
+        sum += c ^ 0x5a
+        sum &= MASK
+    return sum
+
+def checksum_ref(data):
+    '''Reference implementation, byte by byte'''
+    return _update_ref(CHECKSUM_INIT, data) ^ CHECKSUM_FINAL
+
+_MULT2 = CHECKSUM_MULT ** 2 & MASK
+_table = None
+
+def _update_table(sum, data):
+    # Consume two bytes per step using a 64K-entry table of pair contributions
+    global _table
+    if _table is None:
+        _table = [(((h & 0xff) ^ 0x5a) * CHECKSUM_MULT + ((h >> 8) ^ 0x5a)) & MASK
+                  for h in range(0x10000)]
+
+    table, mult2 = _table, _MULT2
+    data = memoryview(data).cast("B")
+    n = len(data) & ~1
+    for h in data[:n].cast("H"):
+        sum = (sum * mult2 + table[h]) & MASK
+    return _update_ref(sum, data[n:])
+
+if np is not None:
+    NUMPY_CHUNK = 1 << 20
+    _powers = None
+
+    def _get_powers():
+        # _powers[k] = 31337**k mod 2**32, built by doubling (uint32 arithmetic wraps)
+        global _powers
+        if _powers is None:
+            p = np.empty(NUMPY_CHUNK, dtype=np.uint32)
+            p[0] = 1
+            n = 1
+            while n < NUMPY_CHUNK:
+                m = min(n, NUMPY_CHUNK - n)
+                p[n:n + m] = p[:m] * np.uint32(pow(CHECKSUM_MULT, n, 1 << 32))
+                n += m
+            _powers = p
+        return _powers
+
+    def _update_numpy(sum, data):
+        powers = _get_powers()
+        a = np.frombuffer(data, dtype=np.uint8)
+        for off in range(0, len(a), NUMPY_CHUNK):
+            block = a[off:off + NUMPY_CHUNK]
+            size = len(block)
+            v = (block ^ np.uint8(0x5a)).astype(np.uint32)
+            v *= powers[size - 1::-1]
+            # Each product is < 2**32, so the 64-bit sum cannot overflow
+            dot = int(v.sum(dtype=np.uint64))
+            sum = (sum * pow(CHECKSUM_MULT, size, 1 << 32) + dot) & MASK
+        return sum
+else:
+    _update_numpy = None
+
+IMPLEMENTATIONS = {
+    "ref": _update_ref,
+    "table": _update_table,
+}
+if _update_numpy is not None:
+    IMPLEMENTATIONS["numpy"] = _update_numpy
+
+def checksum(data):
+    '''Compute the proxy checksum of data, picking the fastest implementation'''
+    size = len(data)
+    if size >= NUMPY_THRESHOLD and _update_numpy is not None:
+        sum = _update_numpy(CHECKSUM_INIT, data)
+    elif size >= TABLE_THRESHOLD:
+        sum = _update_table(CHECKSUM_INIT, data)
+    else:
+        sum = _update_ref(CHECKSUM_INIT, data)
+    return sum ^ CHECKSUM_FINAL
+
+if __name__ == "__main__":
+    import os, random, time
+
+    # Bit-exactness against the reference loop
+    rnd = random.Random(1234)
+    sizes = [0, 1, 2, 3, 31, 32, 63, 64, 65, 4095, 4096, 4097, 100000]
+    if _update_numpy is not None:
+        sizes += [NUMPY_CHUNK - 1, NUMPY_CHUNK, NUMPY_CHUNK + 3]
+    for size in sizes:
+        data = bytes(rnd.getrandbits(8) for i in range(size))
+        expect = checksum_ref(data)
+        assert checksum(data) == expect, size
+        assert checksum(bytearray(data)) == expect, size
+        assert checksum(memoryview(data)) == expect, size
+        for name, update in IMPLEMENTATIONS.items():
+            assert update(CHECKSUM_INIT, data) ^ CHECKSUM_FINAL == expect, (name, size)
+    print("checksum: all implementations match the reference")
+
+    # Micro-benchmark
+    data = os.urandom(4 << 20)
+    for name, update in IMPLEMENTATIONS.items():
+        size = len(data) if name != "ref" else len(data) // 16
+        t = time.perf_counter()
+        update(CHECKSUM_INIT, data[:size])
+        dt = time.perf_counter() - t
+        print(f"  {name:6s} {size / dt / 1048576:10.2f} MiB/s")
@@ -1,15 +1,18 @@
 # SPDX-License-Identifier: MIT
-import sys, traceback, struct, array, bisect, os, signal, runpy
+import sys, traceback, struct, array, bisect, os, signal, runpy, functools, threading, time
+from collections import deque
+from contextlib import contextmanager
 from construct import *
 from enum import Enum, IntEnum, IntFlag
 
-from .asm import ARMAsm
+from .asm import ARMAsm, disassemble
 from .tgtypes import *
 from .proxy import IODEV, START, EVENT, EXC, EXC_RET, ExcInfo
 from .utils import *
 from .sysreg import *
 from .macho import MachO
 from .adt import load_adt
+from .metrics import Histogram
 from . import xnutools, shell
 
 __all__ = ["HV"]
@@ -20,19 +23,20 @@ class MMIOTraceFlags(Register32):
     WRITE = 5
     MULTI = 6
 
-EvtMMIOTrace = Struct(
+# Event and hook structures are decoded per trace event, so precompiled
+EvtMMIOTrace = CompiledStruct(Struct(
     "flags" / RegAdapter(MMIOTraceFlags),
     "reserved" / Int32ul,
     "pc" / Hex(Int64ul),
     "addr" / Hex(Int64ul),
     "data" / Hex(Int64ul),
-)
+))
 
-EvtIRQTrace = Struct(
+EvtIRQTrace = CompiledStruct(Struct(
     "flags" / Int32ul,
     "type" / Hex(Int16ul),
     "num" / Int16ul,
-)
+))
 
 class HV_EVENT(IntEnum):
     HOOK_VM = 1
@@ -40,12 +44,12 @@ class HV_EVENT(IntEnum):
     USER_INTERRUPT = 3
     WDT_BARK = 4
 
-VMProxyHookData = Struct(
+VMProxyHookData = CompiledStruct(Struct(
     "flags" / RegAdapter(MMIOTraceFlags),
     "id" / Int32ul,
     "addr" / Hex(Int64ul),
     "data" / Array(2, Hex(Int64ul)),
-)
+))
 
 class TraceMode(IntEnum):
     '''
@@ -59,6 +63,193 @@ Different types of Tracing '''
     HOOK = 5
     RESERVED = 6
 
+class TracerQueue:
+    '''Runs ASYNC-mode tracer handlers on a worker thread, so that slow
+    handlers do not hold up draining the link. See HV.enable_tracer_queue().
+
+    Events are handled in arrival order, one at a time, and never while a
+    handler runs inline on the main thread. When the queue is full, policy
+    decides what happens to a new event: "drop" discards it, "coalesce"
+    replaces the tracer's last queued event if it is for the same address
+    and direction (and drops it otherwise), "block" stops reading the link
+    until there is room. Blocking is not possible while a handler runs
+    inline, events are dropped instead.
+
+    A handler that raises pauses the worker until the main thread has dealt
+    with the failure (see poll()), so later events are not handled out of
+    order.'''
+    POLICIES = ("drop", "coalesce", "block")
+
+    def __init__(self, on_failure, depth=4096, policy="block"):
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown overflow policy {policy!r}")
+        self.on_failure = on_failure
+        self.depth = depth
+        self.policy = policy
+        self.queue = deque()    # [ident, mode, func, evt, write, time queued]
+        self.last = {}          # ident -> its last entry, while still queued
+        self.pending = {}       # ident -> number of queued or running events
+        self.busy = 0
+        self.failures = deque()
+        self.paused = False
+        self.stopping = False
+        self.inline_depth = 0
+        self.cond = threading.Condition()
+        # Held while any tracer handler runs
+        self.gate = threading.RLock()
+        self.reset_stats()
+        self.thread = threading.Thread(target=self._worker, name="hv-tracers", daemon=True)
+        self.thread.start()
+        self.worker_ident = self.thread.ident
+
+    def reset_stats(self):
+        self.enqueued = 0
+        self.handled = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.blocked = 0
+        self.blocked_time = 0.0
+        self.failed = 0
+        self.max_depth = 0
+        # Time from queueing to handling
+        self.latency = Histogram()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "policy": self.policy,
+                "capacity": self.depth,
+                "depth": len(self.queue),
+                "max_depth": self.max_depth,
+                "enqueued": self.enqueued,
+                "handled": self.handled,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "blocked": self.blocked,
+                "blocked_time": self.blocked_time,
+                "failed": self.failed,
+                "pending": {ident: n for ident, n in self.pending.items() if n},
+                "latency": self.latency.snapshot(),
+            }
+
+    def put(self, ident, mode, func, evt, write):
+        '''Queue func(evt) for the tracer ident (main thread only)'''
+        with self.cond:
+            if len(self.queue) >= self.depth:
+                if self.policy == "coalesce":
+                    last = self.last.get(ident)
+                    if last is not None and last[4] == write and last[3].addr == evt.addr:
+                        last[3] = evt
+                        self.coalesced += 1
+                        return
+                elif self.policy == "block" and not self.inline_depth:
+                    self._block()
+                if len(self.queue) >= self.depth:
+                    self.dropped += 1
+                    return
+
+            entry = [ident, mode, func, evt, write, time.perf_counter()]
+            self.queue.append(entry)
+            self.last[ident] = entry
+            self.pending[ident] = self.pending.get(ident, 0) + 1
+            self.busy += 1
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self.queue))
+            self.cond.notify_all()
+
+    def _block(self):
+        start = time.perf_counter()
+        self.blocked += 1
+        while len(self.queue) >= self.depth and not self.stopping:
+            if self.failures:
+                self._poll_locked()
+            else:
+                self.cond.wait()
+        self.blocked_time += time.perf_counter() - start
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while (self.paused or not self.queue) and not self.stopping:
+                    self.cond.wait()
+                if self.stopping:
+                    return
+                entry = self.queue.popleft()
+                ident, mode, func, evt, write, queued = entry
+                if self.last.get(ident) is entry:
+                    del self.last[ident]
+                self.cond.notify_all()
+
+            self.latency.add(time.perf_counter() - queued)
+            exc = None
+            with self.gate:
+                try:
+                    func(evt)
+                except:
+                    exc = sys.exc_info()[1]
+
+            with self.cond:
+                if exc is not None:
+                    self.failures.append((ident, mode, evt, write, exc))
+                    self.failed += 1
+                    self.paused = True
+                else:
+                    self.handled += 1
+                self.pending[ident] -= 1
+                self.busy -= 1
+                self.cond.notify_all()
+
+    def poll(self):
+        '''Report handler failures through on_failure (main thread only)'''
+        with self.cond:
+            self._poll_locked()
+
+    def _poll_locked(self):
+        while self.failures:
+            failure = self.failures.popleft()
+            self.cond.release()
+            try:
+                self.on_failure(*failure)
+            finally:
+                self.cond.acquire()
+        self.paused = False
+        self.cond.notify_all()
+
+    def wait(self, ident=None):
+        '''Wait until the events queued for ident (or all events) have been
+        handled. Does nothing while a handler runs inline, as the worker
+        cannot make progress then.'''
+        if self.inline_depth or threading.get_ident() == self.worker_ident:
+            return
+        with self.cond:
+            while True:
+                if self.failures:
+                    self._poll_locked()
+                    continue
+                if not (self.busy if ident is None else self.pending.get(ident, 0)):
+                    return
+                self.cond.wait()
+
+    @contextmanager
+    def inline(self, idents):
+        '''Run tracer handlers inline, after the events already queued for
+        the same tracers and with the worker held off'''
+        for ident in idents:
+            self.wait(ident)
+        with self.gate:
+            self.inline_depth += 1
+            try:
+                yield
+            finally:
+                self.inline_depth -= 1
+
+    def stop(self):
+        self.wait()
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
+
 class HV(Reloadable):
     PAC_MASK = 0xfffff00000000000
 
@@ -136,7 +327,15 @@ class HV(Reloadable):
         self.vm_hooks = [None]
         self.interrupt_map = {}
         self.mmio_maps = DictRangeMap()
+        self.mmio_dispatch = None
+        self.tracer_queue = None
+        self.ctx = None
         self.dirty_maps = BoolRangeMap()
+        # What pt_update last programmed for each zone, to skip unchanged ones
+        self.pt_programmed = ScalarRangeMap()
+        self._pt_batch = None
+        # 0: quiet, 1: one summary line per pt_update, 2: one line per zone
+        self.pt_verbose = 1
         self.tracer_caches = {}
         self.shell_locals = {}
         self.xnu_mode = False
@@ -146,7 +345,6 @@ class HV(Reloadable):
         self.hook_exceptions = False
         self.started_cpus = set()
         self.started = False
-        self.ctx = None
 
     def _reloadme(self):
         super()._reloadme()
@@ -167,6 +365,18 @@ class HV(Reloadable):
             if callable(a):
                 self.shell_locals[attr] = getattr(self, attr)
 
+    @property
+    def ctx(self):
+        # Queued tracers always run in asynchronous context
+        q = self.tracer_queue
+        if q is not None and threading.get_ident() == q.worker_ident:
+            return None
+        return self._ctx
+
+    @ctx.setter
+    def ctx(self, ctx):
+        self._ctx = ctx
+
     def log(self, s, *args, show_cpu=True, **kwargs):
         if self.ctx is not None and show_cpu:
             print(f"[cpu{self.ctx.cpu_id}] " + s, *args, **kwargs)
@@ -177,8 +387,17 @@ class HV(Reloadable):
             if self.print_tracer.log_file:
                 print("# " + s, *args, file=self.print_tracer.log_file, **kwargs)
 
+    def _hv_map(self, ipa, pte, size, incr):
+        # Anything mapped outside of pt_update invalidates what it programmed
+        self.pt_programmed.clear(irange(ipa, size))
+        if self._pt_batch is not None:
+            batch, futures = self._pt_batch
+            futures.append((ipa, batch.hv_map(ipa, pte, size, incr)))
+        else:
+            assert self.p.hv_map(ipa, pte, size, incr) >= 0
+
     def unmap(self, ipa, size):
-        assert self.p.hv_map(ipa, 0, size, 0) >= 0
+        self._hv_map(ipa, 0, size, 0)
 
     def map_hw(self, ipa, pa, size):
         '''map IPA (Intermediate Physical Address) to actual PA'''
@@ -199,14 +418,14 @@ class HV(Reloadable):
         size_p = align_down(size)
         if size_p > 0:
             #print(f"map_hw real {ipa_p:#x} -> {pa:#x} [{size_p:#x}]")
-            assert self.p.hv_map(ipa_p, pa | self.PTE_ATTRIBUTES | self.PTE_VALID, size_p, 1) >= 0
+            self._hv_map(ipa_p, pa | self.PTE_ATTRIBUTES | self.PTE_VALID, size_p, 1)
 
         if size_p != size:
             self.map_sw(ipa_p + size_p, pa + size_p, size - size_p)
 
     def map_sw(self, ipa, pa, size):
         #print(f"map_sw {ipa:#x} -> {pa:#x} [{size:#x}]")
-        assert self.p.hv_map(ipa, pa | self.SPTE_MAP, size, 1) >= 0
+        self._hv_map(ipa, pa | self.SPTE_MAP, size, 1)
 
     def map_hook(self, ipa, size, read=None, write=None, **kwargs):
         index = len(self.vm_hooks)
@@ -224,7 +443,7 @@ class HV(Reloadable):
         else:
             assert False
 
-        assert self.p.hv_map(ipa, (index << 2) | flags | t, size, 0) >= 0
+        self._hv_map(ipa, (index << 2) | flags | t, size, 0)
 
     def trace_irq(self, device, num, count, flags):
         for n in range(num, num + count):
@@ -246,16 +465,87 @@ class HV(Reloadable):
         assert mode in (TraceMode.RESERVED, TraceMode.OFF) or read or write
         self.mmio_maps[zone, ident] = (mode, ident, read, write, kwargs)
         self.dirty_maps.set(zone)
+        self.mmio_dispatch = None
 
     def del_tracer(self, zone, ident):
         del self.mmio_maps[zone, ident]
         self.dirty_maps.set(zone)
+        self.mmio_dispatch = None
 
     def clear_tracers(self, ident):
         for r, v in self.mmio_maps.items():
             if ident in v:
                 v.pop(ident)
                 self.dirty_maps.set(r)
+        self.mmio_dispatch = None
+
+    def _build_mmio_dispatch(self):
+        '''Compile mmio_maps into a (mode, ident, read, write) tuple per zone,
+        in priority order and with the tracer kwargs bound to the handlers'''
+        def bind(func, kwargs):
+            if func and kwargs:
+                return functools.partial(func, **kwargs)
+            return func
+
+        table = ScalarRangeMap()
+        for zone, maps in self.mmio_maps.items():
+            if maps:
+                table[zone] = tuple((mode, ident, bind(read, kwargs), bind(write, kwargs))
+                                    for mode, ident, read, write, kwargs
+                                    in sorted(maps.values(), reverse=True))
+        self.mmio_dispatch = table
+        return table
+
+    def _mmio_tracers(self, addr):
+        table = self.mmio_dispatch
+        if table is None:
+            table = self._build_mmio_dispatch()
+        return table.lookup(addr, ())
+
+    def _tracer_failed(self, addr, ident, write, description, *args, needs_ret=False):
+        '''Called from the except block when a tracer raised: enter the
+        debug shell and retry with the tracer as currently registered'''
+        def retry():
+            m = self.mmio_maps[addr].get(ident, None)
+            func = m and (m[3] if write else m[2])
+            if not func:
+                return None
+            return func(*args, **m[4])
+
+        return self.shellwrap(retry, description, needs_ret=needs_ret, failed=True)
+
+    def enable_tracer_queue(self, depth=4096, policy="block"):
+        '''Handle ASYNC-mode tracer events on a worker thread instead of
+        inline while reading the link, so that slow tracers do not make
+        m1n1's trace buffer overflow. Other modes still run inline. See
+        TracerQueue for the overflow policies; tracer_queue.stats() has the
+        queue metrics.
+
+        Queued handlers run in asynchronous context (hv.ctx is None) and
+        must not access the target: any proxy request or memory access from
+        the worker raises UartError. Tracers that need to (e.g. reading
+        shared memory through hv.iface or a DART) should be registered with
+        a mode that runs inline, such as UNBUF or SYNC.'''
+        self.disable_tracer_queue()
+        q = TracerQueue(self._tracer_queue_failed, depth, policy)
+        self.iface.denied_threads.add(q.worker_ident)
+        self.tracer_queue = q
+
+    def disable_tracer_queue(self):
+        '''Handle the queued events and go back to inline ASYNC tracers'''
+        q = self.tracer_queue
+        if q is not None:
+            q.stop()
+            self.iface.denied_threads.discard(q.worker_ident)
+            self.tracer_queue = None
+
+    def _tracer_queue_failed(self, ident, mode, evt, write, exc):
+        try:
+            raise exc
+        except:
+            self._tracer_failed(evt.addr, ident, write,
+                                f"Tracer {ident}:{'write' if write else 'read'} ({mode.name}, queued)",
+                                evt)
 
     def trace_device(self, path, mode=TraceMode.ASYNC, ranges=None):
         node = self.adt[path]
@@ -275,6 +565,11 @@ class HV(Reloadable):
         else:
             self.del_tracer(zone, "PrintTracer")
 
+    def _pt_unchanged(self, zone, spec):
+        for r, prev in self.pt_programmed.overlaps(zone):
+            return prev == spec and r.start <= zone.start and r.stop >= zone.stop
+        return False
+
     def pt_update(self):
         if not self.dirty_maps:
             return
@@ -283,69 +578,109 @@ class HV(Reloadable):
         self.mmio_maps.compact()
 
         top = 0
+        updated = []
+        unchanged = 0
+        verbose = self.pt_verbose
 
-        for zone in self.dirty_maps:
-            if zone.stop <= top:
-                continue
-            for mzone, maps in self.mmio_maps.overlaps(zone):
-                if mzone.stop <= top:
-                    continue
-                top = mzone.stop
-                if not maps:
-                    continue
-                maps = sorted(maps.values(), reverse=True)
-                mode, ident, read, write, kwargs = maps[0]
-
-                need_read = any(m[2] for m in maps)
-                need_write = any(m[3] for m in maps)
-
-                if mode == TraceMode.RESERVED:
-                    print(f"PT[{mzone.start:09x}:{mzone.stop:09x}] -> RESERVED {ident}")
-                    continue
-                elif mode in (TraceMode.HOOK, TraceMode.SYNC):
-                    self.map_hook_idx(mzone.start, mzone.stop - mzone.start, 0,
-                                      need_read, need_write)
-                    if mode == TraceMode.HOOK:
-                        for m2, i2, r2, w2, k2 in maps[1:]:
-                            if m2 == TraceMode.HOOK:
-                                print(f"!! Conflict: HOOK {i2}")
-                elif mode == TraceMode.WSYNC:
-                    flags = self.SPTE_TRACE_READ if need_read else 0
-                    self.map_hook_idx(mzone.start, mzone.stop - mzone.start, 0,
-                                      False, need_write, flags=flags)
-                elif mode in (TraceMode.UNBUF, TraceMode.ASYNC):
-                    pa = mzone.start
-                    if mode == TraceMode.UNBUF:
-                        pa |= self.SPTE_TRACE_UNBUF
-                    if need_read:
-                        pa |= self.SPTE_TRACE_READ
-                    if need_write:
-                        pa |= self.SPTE_TRACE_WRITE
-                    self.map_sw(mzone.start, pa, mzone.stop - mzone.start)
-                elif mode == TraceMode.OFF:
-                    self.map_hw(mzone.start, mzone.start, mzone.stop - mzone.start)
-                    print(f"PT[{mzone.start:09x}:{mzone.stop:09x}] -> HW")
+        batch = self.p.batch()
+        self._pt_batch = batch, []
+        try:
+            for zone in self.dirty_maps:
+                if zone.stop <= top:
                     continue
-
-                rest = [m[1] for m in maps[1:] if m[0] != TraceMode.OFF]
-                if rest:
-                    rest = " (+ " + ", ".join(rest) + ")"
-                else:
-                    rest = ""
-
-                print(f"PT[{mzone.start:09x}:{mzone.stop:09x}] -> {mode.name}.{'R' if read else ''}{'W' if read else ''} {ident}{rest}")
-
-        self.u.inst(0xd50c83df) # tlbi vmalls12e1is
+                for mzone, maps in self.mmio_maps.overlaps(zone):
+                    if mzone.stop <= top:
+                        continue
+                    top = mzone.stop
+                    if not maps:
+                        continue
+                    maps = sorted(maps.values(), reverse=True)
+                    mode, ident, read, write, kwargs = maps[0]
+
+                    need_read = any(m[2] for m in maps)
+                    need_write = any(m[3] for m in maps)
+
+                    if mode == TraceMode.RESERVED:
+                        if verbose >= 2:
+                            print(f"PT[{mzone.start:09x}:{mzone.stop:09x}] -> RESERVED {ident}")
+                        continue
+
+                    spec = (mode, need_read, need_write)
+                    if self._pt_unchanged(mzone, spec):
+                        unchanged += 1
+                        continue
+
+                    if mode in (TraceMode.HOOK, TraceMode.SYNC):
+                        self.map_hook_idx(mzone.start, mzone.stop - mzone.start, 0,
+                                          need_read, need_write)
+                        if mode == TraceMode.HOOK:
+                            for m2, i2, r2, w2, k2 in maps[1:]:
+                                if m2 == TraceMode.HOOK:
+                                    print(f"!! Conflict: HOOK {i2}")
+                    elif mode == TraceMode.WSYNC:
+                        flags = self.SPTE_TRACE_READ if need_read else 0
+                        self.map_hook_idx(mzone.start, mzone.stop - mzone.start, 0,
+                                          False, need_write, flags=flags)
+                    elif mode in (TraceMode.UNBUF, TraceMode.ASYNC):
+                        pa = mzone.start
+                        if mode == TraceMode.UNBUF:
+                            pa |= self.SPTE_TRACE_UNBUF
+                        if need_read:
+                            pa |= self.SPTE_TRACE_READ
+                        if need_write:
+                            pa |= self.SPTE_TRACE_WRITE
+                        self.map_sw(mzone.start, pa, mzone.stop - mzone.start)
+                    elif mode == TraceMode.OFF:
+                        self.map_hw(mzone.start, mzone.start, mzone.stop - mzone.start)
+
+                    self.pt_programmed[mzone] = spec
+                    updated.append(mzone)
+
+                    if verbose < 2:
+                        continue
+                    if mode == TraceMode.OFF:
+                        print(f"PT[{mzone.start:09x}:{mzone.stop:09x}] -> HW")
+                        continue
+
+                    rest = [m[1] for m in maps[1:] if m[0] != TraceMode.OFF]
+                    if rest:
+                        rest = " (+ " + ", ".join(rest) + ")"
+                    else:
+                        rest = ""
+
+                    print(f"PT[{mzone.start:09x}:{mzone.stop:09x}] -> {mode.name}.{'R' if read else ''}{'W' if read else ''} {ident}{rest}")
+        finally:
+            futures = self._pt_batch[1]
+            self._pt_batch = None
+            batch.flush()
+
+        for ipa, fut in futures:
+            if fut.result() < 0:
+                self.pt_programmed.clear()
+                raise Exception(f"hv_map failed at {ipa:#x}")
+
+        if updated:
+            self.u.inst(0xd50c83df) # tlbi vmalls12e1is
+        if verbose == 1 and updated:
+            print(f"PT: {len(updated)} zones updated, {unchanged} unchanged")
         self.dirty_maps.clear()
+        self._build_mmio_dispatch()
 
-    def shellwrap(self, func, description, update=None, needs_ret=False):
+    def shellwrap(self, func, description, update=None, needs_ret=False, failed=False):
+        '''Call func, dropping into the debug shell on exceptions. With failed
+        set, this is being called from the except block of a first attempt.'''
 
         while True:
-            try:
-                return func()
-            except:
+            if failed:
+                failed = False
                 print(f"Exception in {description}")
                 traceback.print_exc()
+            else:
+                try:
+                    return func()
+                except:
+                    print(f"Exception in {description}")
+                    traceback.print_exc()
 
             if not self.ctx:
                 print("Running in asynchronous context. Target operations are not available.")
@@ -372,57 +707,54 @@ class HV(Reloadable):
         return shell.run_shell(self.shell_locals, entry_msg, exit_msg)
 
     def handle_mmiotrace(self, data):
-        evt = EvtMMIOTrace.parse(data)
+        q = self.tracer_queue
+        if q is not None and q.failures:
+            q.poll()
+        self.dispatch_mmiotrace(EvtMMIOTrace.parse(data))
 
-        def do_update():
-            nonlocal mode, ident, read, write, kwargs
-            read = lambda *args, **kwargs: None
-            write = lambda *args, **kwargs: None
-
-            m = self.mmio_maps[evt.addr].get(ident, None)
-            if not m:
-                return
+    def dispatch_mmiotrace(self, evt):
+        write = evt.flags.WRITE
+        q = self.tracer_queue
 
-            mode, ident, read_, write_, kwargs = m
-            read = read_ or read
-            write = write_ or write
-
-        maps = sorted(self.mmio_maps[evt.addr].values(), reverse=True)
-        for mode, ident, read, write, kwargs in maps:
-            if mode > TraceMode.WSYNC or (evt.flags.WRITE and mode > TraceMode.UNBUF):
+        for mode, ident, read_func, write_func in self._mmio_tracers(evt.addr):
+            if mode > TraceMode.WSYNC or (write and mode > TraceMode.UNBUF):
                 print(f"ERROR: mmiotrace event but expected {mode.name} mapping")
                 continue
             if mode == TraceMode.OFF:
                 continue
-            if evt.flags.WRITE:
-                if write:
-                    self.shellwrap(lambda: write(evt, **kwargs),
-                                   f"Tracer {ident}:write ({mode.name})", update=do_update)
+            func = write_func if write else read_func
+            if not func:
+                continue
+            if q is None:
+                self._run_tracer(mode, ident, func, evt, write)
+            elif mode == TraceMode.ASYNC:
+                q.put(ident, mode, func, evt, write)
             else:
-                if read:
-                    self.shellwrap(lambda: read(evt, **kwargs),
-                                   f"Tracer {ident}:read ({mode.name})", update=do_update)
+                with q.inline((ident,)):
+                    self._run_tracer(mode, ident, func, evt, write)
 
-    def handle_vm_hook_mapped(self, ctx, data):
-        maps = sorted(self.mmio_maps[data.addr].values(), reverse=True)
+    def _run_tracer(self, mode, ident, func, evt, write):
+        try:
+            func(evt)
+        except:
+            self._tracer_failed(evt.addr, ident, write,
+                                f"Tracer {ident}:{'write' if write else 'read'} ({mode.name})",
+                                evt)
 
+    def handle_vm_hook_mapped(self, ctx, data):
+        maps = self._mmio_tracers(data.addr)
+        q = self.tracer_queue
+        if q is None or not maps:
+            return self._handle_vm_hook_mapped(ctx, data, maps)
+        # All tracers on the zone run inline here, after their queued events
+        with q.inline(m[1] for m in maps):
+            return self._handle_vm_hook_mapped(ctx, data, maps)
+
+    def _handle_vm_hook_mapped(self, ctx, data, maps):
         if not maps:
             raise Exception(f"VM hook without a mapping at {data.addr:#x}")
 
-        def do_update():
-            nonlocal mode, ident, read, write, kwargs
-            read = lambda *args, **kwargs: None
-            write = lambda *args, **kwargs: None
-
-            m = self.mmio_maps[data.addr].get(ident, None)
-            if not m:
-                return
-
-            mode, ident, read_, write_, kwargs = m
-            read = read_ or read
-            write = write_ or write
-
-        mode, ident, read, write, kwargs = maps[0]
+        mode, ident, read, write = maps[0]
 
         first = 0
 
@@ -433,8 +765,11 @@ class HV(Reloadable):
 
         if not data.flags.WRITE:
             if mode == TraceMode.HOOK:
-                val = self.shellwrap(lambda: read(data.addr, 8 << data.flags.WIDTH, **kwargs),
-                                     f"Tracer {ident}:read (HOOK)", update=do_update, needs_ret=True)
+                try:
+                    val = read(data.addr, 8 << data.flags.WIDTH)
+                except:
+                    val = self._tracer_failed(data.addr, ident, False, f"Tracer {ident}:read (HOOK)",
+                                              data.addr, 8 << data.flags.WIDTH, needs_ret=True)
 
                 if not isinstance(val, list) and not isinstance(val, tuple):
                     val = [val]
@@ -473,27 +808,28 @@ class HV(Reloadable):
                 data = val[i]
             )
 
-            for mode, ident, read, write, kwargs in maps[first:]:
-                if flags.WRITE:
-                    if write:
-                        self.shellwrap(lambda: write(evt, **kwargs),
-                                       f"Tracer {ident}:write ({mode.name})", update=do_update)
-                else:
-                    if read:
-                        self.shellwrap(lambda: read(evt, **kwargs),
-                                       f"Tracer {ident}:read ({mode.name})", update=do_update)
+            for mode_, ident_, read_, write_ in maps[first:]:
+                func = write_ if flags.WRITE else read_
+                if func:
+                    try:
+                        func(evt)
+                    except:
+                        self._tracer_failed(data.addr, ident_, flags.WRITE,
+                                            f"Tracer {ident_}:{'write' if flags.WRITE else 'read'} ({mode_.name})",
+                                            evt)
 
         if data.flags.WRITE:
-            mode, ident, read, write, kwargs = maps[0]
-
             if data.flags.WIDTH <= 3:
                 wval = val[0]
             else:
                 wval = val
 
             if mode == TraceMode.HOOK:
-                self.shellwrap(lambda: write(data.addr, wval, 8 << data.flags.WIDTH, **kwargs),
-                            f"Tracer {ident}:write (HOOK)", update=do_update)
+                try:
+                    write(data.addr, wval, 8 << data.flags.WIDTH)
+                except:
+                    self._tracer_failed(data.addr, ident, True, f"Tracer {ident}:write (HOOK)",
+                                        data.addr, wval, 8 << data.flags.WIDTH)
             elif mode in (TraceMode.SYNC, TraceMode.WSYNC):
                 try:
                     self.u.write(data.addr, wval, 8 << data.flags.WIDTH)
@@ -631,8 +967,7 @@ class HV(Reloadable):
             return self.handle_msr(ctx, ctx.afsr1)
 
         code = struct.unpack("<I", self.iface.readmem(ctx.elr_phys, 4))
-        c = ARMAsm(".inst " + ",".join(str(i) for i in code), ctx.elr_phys)
-        insn = "; ".join(c.disassemble())
+        insn = "; ".join(disassemble(code, ctx.elr_phys))
 
         self.log(f"IMPDEF exception on: {insn}")
 
@@ -757,6 +1092,10 @@ class HV(Reloadable):
         self.exc_code = code
         self.ctx = ctx = ExcInfo.parse(info_data)
 
+        q = self.tracer_queue
+        if q is not None and q.failures:
+            q.poll()
+
         handled = False
         user_interrupt = False
 
@@ -791,6 +1130,8 @@ class HV(Reloadable):
 
         if self._sigint_pending or not handled or user_interrupt:
             self._sigint_pending = False
+            if self.tracer_queue is not None:
+                self.tracer_queue.wait()
 
             signal.signal(signal.SIGINT, self.default_sigint)
             ret = shell.run_shell(self.shell_locals, "Entering hypervisor shell", "Returning from exception")
@@ -801,9 +1142,9 @@ class HV(Reloadable):
 
         self.pt_update()
 
-        new_info = ExcInfo.build(self.ctx)
-        if new_info != info_data:
-            self.iface.writemem(info, new_info)
+        # Only write the context back if a handler modified it
+        if not isinstance(self.ctx, StructView) or self.ctx.changed():
+            self.iface.writemem(info, ExcInfo.build(self.ctx))
 
         self.ctx = None
         self.p.exit(ret)
@@ -1284,7 +1625,7 @@ class HV(Reloadable):
             return a.tobytes()
 
         #image = macho.prepare_image(load_hook)
-        image = macho.prepare_image()
+        extents, image_len = macho.prepare_extents()
         sepfw_start, sepfw_length = self.u.adt["chosen"]["memory-map"].SEPFW
         tc_start, tc_size = self.u.adt["chosen"]["memory-map"].TrustCache
         if hasattr(self.u.adt["chosen"]["memory-map"], "preoslog"):
@@ -1292,7 +1633,7 @@ class HV(Reloadable):
         else:
             preoslog_size = 0
 
-        image_size = align(len(image))
+        image_size = align(image_len)
         sepfw_off = image_size
         image_size += align(sepfw_length)
         preoslog_off = image_size
@@ -1324,10 +1665,10 @@ class HV(Reloadable):
         self.map_hw(phys_base, phys_base, self.u.ba.mem_size_actual - phys_base + ram_base)
         self.p.mcc_hv_unmap_carveouts()
 
-        print(f"Loading kernel image (0x{len(image):x} bytes)...")
-        self.u.compressed_writemem(guest_base, image, True)
-        self.p.dc_cvau(guest_base, len(image))
-        self.p.ic_ivau(guest_base, len(image))
+        print(f"Loading kernel image (0x{image_len:x} bytes)...")
+        self.u.write_extents(guest_base, extents, True)
+        self.p.dc_cvau(guest_base, image_len)
+        self.p.ic_ivau(guest_base, image_len)
 
         print(f"Copying SEPFW (0x{sepfw_length:x} bytes)...")
         self.p.memcpy8(guest_base + sepfw_off, sepfw_start, sepfw_length)
@@ -145,10 +145,13 @@ class MachO:
             elif cmd.cmd == MachOLoadCmdType.UNIXTHREAD:
                 self.entry = cmd.args[0].data.pc
 
-    def prepare_image(self, load_hook=None):
+    def prepare_extents(self, load_hook=None):
+        '''Lay out the image as a sorted list of (offset, data) extents, where
+        data is either bytes read from the file or an int giving the size of
+        a zero filled region. Returns (extents, image size).'''
         memory_size = self.vmax - self.vmin
 
-        image = bytearray(memory_size)
+        extents = []
 
         for cmd in self.get_cmds(MachOLoadCmdType.SEGMENT_64):
             dest = cmd.args.vmaddr - self.vmin
@@ -159,16 +162,53 @@ class MachO:
             data = self.io.read(size)
             if load_hook is not None:
                 data = load_hook(data, cmd.args.segname, size, cmd.args.fileoff, dest)
-            image[dest:dest + size] = data
+            if size:
+                extents.append((dest, data))
             if cmd.args.vmsize > size:
                 clearsize = cmd.args.vmsize - size
                 if cmd.args.segname == "PYLD":
                     print("SKIP: %d bytes from 0x%x to 0x%x" % (clearsize, dest + size, dest + size + clearsize))
                     memory_size -= clearsize - 4 # leave a payload end marker
-                    image = image[:memory_size]
                 else:
                     print("ZERO: %d bytes from 0x%x to 0x%x" % (clearsize, dest + size, dest + size + clearsize))
-                    image[dest + size:dest + cmd.args.vmsize] = bytes(clearsize)
+                    extents.append((dest + size, clearsize))
+
+        # Clip to the image and zero fill any holes between segments
+        extents.sort(key=lambda e: e[0])
+        out = []
+        pos = 0
+
+        def add_zero(dest, size):
+            if out and isinstance(out[-1][1], int) and sum(out[-1]) == dest:
+                out[-1] = (out[-1][0], out[-1][1] + size)
+            else:
+                out.append((dest, size))
+
+        for dest, data in extents:
+            if dest >= memory_size:
+                continue
+            if dest > pos:
+                add_zero(pos, dest - pos)
+            if isinstance(data, int):
+                size = min(data, memory_size - dest)
+                add_zero(dest, size)
+            else:
+                data = data[:memory_size - dest]
+                size = len(data)
+                out.append((dest, data))
+            pos = max(pos, dest + size)
+        if pos < memory_size:
+            add_zero(pos, memory_size - pos)
+
+        return out, memory_size
+
+    def prepare_image(self, load_hook=None):
+        extents, memory_size = self.prepare_extents(load_hook)
+
+        image = bytearray(memory_size)
+        for dest, data in extents:
+            if not isinstance(data, int):
+                image[dest:dest + len(data)] = data
 
         return image
 
@@ -1,9 +1,21 @@
 # SPDX-License-Identifier: MIT
+import heapq
 from contextlib import contextmanager
 
 __all__ = ["Heap"]
 
 class Heap(object):
+    '''Host-side allocator for a range of target (or IOVA) addresses.
+
+    Free blocks are kept in size-segregated bins as in TLSF (each power of
+    two range split into SL_SPLIT bins), each bin a heap ordered by address,
+    with a bitmap of non-empty bins. Allocation takes the lowest block from
+    the first bin whose blocks are all large enough; blocks are coalesced on
+    free through start/end maps. Operations are O(log n) in the number of
+    blocks.'''
+    SL_BITS = 3
+    SL_SPLIT = 1 << SL_BITS
+
     def __init__(self, start, end, block=64):
         if start%block:
             raise ValueError("heap start not aligned")
@@ -11,41 +23,127 @@ class Heap(object):
             raise ValueError("heap end not aligned")
         self.offset = start
         self.count = (end - start) // block
-        self.blocks = [(self.count,False)]
         self.block = block
 
+        self.used = {}      # start -> size, allocated blocks
+        self.free_start = {} # start -> size, free blocks
+        self.free_end = {}  # end -> start, free blocks
+        self.bins = []      # per bin: heap of (start, size), may hold stale entries
+        self.bin_count = [] # per bin: number of live entries
+        self.bitmap = 0     # bit i set if bin i is not empty
+
+        self.inuse = 0
+        self.peak = 0
+        self.allocs = 0
+        self.frees = 0
+
+        if self.count:
+            self._add_free(0, self.count)
+
+    # Free block bookkeeping (positions and sizes in blocks)
+
+    def _bin_index(self, size):
+        if size < self.SL_SPLIT:
+            return size
+        shift = size.bit_length() - 1 - self.SL_BITS
+        return ((shift + 1) << self.SL_BITS) | ((size >> shift) & (self.SL_SPLIT - 1))
+
+    def _bin(self, size):
+        idx = self._bin_index(size)
+        while len(self.bins) <= idx:
+            self.bins.append([])
+            self.bin_count.append(0)
+        return idx
+
+    def _add_free(self, start, size):
+        self.free_start[start] = size
+        self.free_end[start + size] = start
+        idx = self._bin(size)
+        heapq.heappush(self.bins[idx], (start, size))
+        self.bin_count[idx] += 1
+        self.bitmap |= 1 << idx
+
+    def _remove_free(self, start):
+        size = self.free_start.pop(start)
+        del self.free_end[start + size]
+        # The heap entry goes stale and is dropped when it reaches the top
+        idx = self._bin(size)
+        self.bin_count[idx] -= 1
+        if not self.bin_count[idx]:
+            self.bins[idx] = []
+            self.bitmap &= ~(1 << idx)
+        elif len(self.bins[idx]) > 2 * self.bin_count[idx] + 32:
+            # Too many stale entries, rebuild (amortized O(1))
+            bin = list({i for i in self.bins[idx] if self.free_start.get(i[0]) == i[1]})
+            heapq.heapify(bin)
+            self.bins[idx] = bin
+        return size
+
+    def _live(self, idx):
+        '''Heap of bin idx with stale entries removed from the top'''
+        bin = self.bins[idx]
+        while bin and self.free_start.get(bin[0][0]) != bin[0][1]:
+            heapq.heappop(bin)
+        return bin
+
+    def _find(self, need, minimum, fits):
+        '''Start of a free block that fits(start, size). Any block of at
+        least need blocks fits, none smaller than minimum does.'''
+        # Every block in a bin at or above this one is large enough
+        if need >= self.SL_SPLIT:
+            need += (1 << (need.bit_length() - 1 - self.SL_BITS)) - 1
+        idx = self._bin_index(need)
+        mask = self.bitmap >> idx
+        if mask:
+            idx += (mask & -mask).bit_length() - 1
+            return self._live(idx)[0][0]
+        # Smaller bins may hold blocks that happen to fit; this is only
+        # reached when the heap is nearly full or fragmented
+        for idx in range(self._bin_index(minimum), min(idx, len(self.bins))):
+            for start, size in sorted(self.bins[idx]):
+                if self.free_start.get(start) == size and fits(start, size):
+                    return start
+        return None
+
+    def _take(self, start, pos, size):
+        '''Allocate [pos, pos + size) out of the free block at start'''
+        bsize = self._remove_free(start)
+        if pos > start:
+            self._add_free(start, pos - start)
+        end = start + bsize
+        if pos + size < end:
+            self._add_free(pos + size, end - pos - size)
+        self.used[pos] = size
+        self.inuse += size
+        self.peak = max(self.peak, self.inuse)
+        self.allocs += 1
+        return self.offset + self.block * pos
+
+    # Public API
+
     def malloc(self, size):
-        size = (size + self.block - 1) // self.block
-        pos = 0
-        for i, (bsize, full) in enumerate(self.blocks):
-            if not full and bsize >= size:
-                self.blocks[i] = (size, True)
-                if bsize > size:
-                    self.blocks.insert(i+1, (bsize - size, False))
-                return self.offset + self.block * pos
-            pos += bsize
-        raise Exception("Out of memory")
+        size = max(1, (size + self.block - 1) // self.block)
+        start = self._find(size, size, lambda start, bsize: bsize >= size)
+        if start is None:
+            raise Exception("Out of memory")
+        return self._take(start, start, size)
 
     def memalign(self, align, size):
         assert (align & (align - 1)) == 0
         align = max(align, self.block) // self.block
-        size = (size + self.block - 1) // self.block
-        pos = self.offset // self.block
-        for i, (bsize, full) in enumerate(self.blocks):
-            if not full:
-                offset = 0
-                if pos % align:
-                    offset = align - (pos % align)
-                if bsize >= (size + offset):
-                    if offset:
-                        self.blocks.insert(i, (offset, False))
-                        i += 1
-                    self.blocks[i] = (size, True)
-                    if bsize > (size + offset):
-                        self.blocks.insert(i+1, (bsize - size - offset, False))
-                    return self.block * (pos + offset)
-            pos += bsize
-        raise Exception("Out of memory")
+        size = max(1, (size + self.block - 1) // self.block)
+        base = self.offset // self.block
+
+        def aligned(start):
+            return start + (-(base + start) % align)
+
+        def fits(start, bsize):
+            return aligned(start) + size <= start + bsize
+
+        start = self._find(size + align - 1, size, fits)
+        if start is None:
+            raise Exception("Out of memory")
+        return self._take(start, aligned(start), size)
 
     def free(self, addr):
         if addr%self.block:
@@ -56,38 +154,72 @@ class Heap(object):
         addr //= self.block
         if addr>=self.count:
             raise ValueError("free address after heap")
-        pos = 0
-        for i, (bsize, used) in enumerate(self.blocks):
-            if pos > addr:
-                raise ValueError("bad free address")
-            if pos == addr:
-                if used == False:
-                    raise ValueError("block already free")
-                if i!=0 and self.blocks[i-1][1] == False:
-                    bsize += self.blocks[i-1][0]
-                    del self.blocks[i]
-                    i -= 1
-                if i!=(len(self.blocks)-1) and self.blocks[i+1][1] == False:
-                    bsize += self.blocks[i+1][0]
-                    del self.blocks[i]
-                self.blocks[i] = (bsize, False)
-                return
-            pos += bsize
-        raise ValueError("bad free address")
+        size = self.used.pop(addr, None)
+        if size is None:
+            if addr in self.free_start:
+                raise ValueError("block already free")
+            raise ValueError("bad free address")
+        self.inuse -= size
+        self.frees += 1
+
+        start, end = addr, addr + size
+        prev = self.free_end.get(start)
+        if prev is not None:
+            self._remove_free(prev)
+            start = prev
+        if end in self.free_start:
+            end += self._remove_free(end)
+        self._add_free(start, end - start)
+
+    def stats(self):
+        '''Usage and fragmentation figures, in bytes'''
+        free = self.count - self.inuse
+        largest = 0
+        if self.bitmap:
+            top = self.bitmap.bit_length() - 1
+            largest = max(size for start, size in self.bins[top]
+                          if self.free_start.get(start) == size)
+        return {
+            "size": self.count * self.block,
+            "used": self.inuse * self.block,
+            "free": free * self.block,
+            "peak": self.peak * self.block,
+            "allocations": len(self.used),
+            "free_blocks": len(self.free_start),
+            "largest_free": largest * self.block,
+            # Share of free space not usable by the largest possible allocation
+            "fragmentation": 1 - largest / free if free else 0.0,
+            "total_allocs": self.allocs,
+            "total_frees": self.frees,
+        }
 
     def check(self):
-        free = 0
-        inuse = 0
-        for i, (bsize, used) in enumerate(self.blocks):
-            if used:
-                inuse += bsize
-            else:
-                free += bsize
-        if free + inuse != self.count:
+        free = sum(self.free_start.values())
+        inuse = sum(self.used.values())
+        if free + inuse != self.count or inuse != self.inuse:
             raise Exception("Total block size is inconsistent")
+        blocks = sorted([(s, n, False) for s, n in self.free_start.items()] +
+                        [(s, n, True) for s, n in self.used.items()])
+        pos = 0
+        last_used = True
+        for start, size, used in blocks:
+            if start != pos:
+                raise Exception("Heap blocks overlap or leave gaps")
+            if not used and not last_used:
+                raise Exception("Adjacent free blocks were not merged")
+            pos += size
+            last_used = used
+        for idx, bin in enumerate(self.bins):
+            live = len({(s, n) for s, n in bin if self.free_start.get(s) == n})
+            if live != self.bin_count[idx] or bool(live) != bool((self.bitmap >> idx) & 1):
+                raise Exception("Free bins are inconsistent")
+        stats = self.stats()
         print("Heap stats:")
-        print(" In use: %8dkB"%(inuse * self.block // 1024))
-        print(" Free:   %8dkB"%(free * self.block // 1024))
+        print(" In use: %8dkB (%d allocations)"%(stats["used"] // 1024, stats["allocations"]))
+        print(" Free:   %8dkB (%d blocks, largest %dkB)"%(
+            stats["free"] // 1024, stats["free_blocks"], stats["largest_free"] // 1024))
+        print(" Peak:   %8dkB"%(stats["peak"] // 1024))
+        print(" Fragmentation: %.1f%%"%(stats["fragmentation"] * 100))
 
     @contextmanager
     def guarded_malloc(self, size):
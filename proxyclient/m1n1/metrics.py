@@ -0,0 +1,153 @@
+# SPDX-License-Identifier: MIT
+# Opt-in instrumentation for UartInterface/M1N1Proxy: per-opcode counts and
+# latency histograms, link byte counters and time spent waiting for replies.
+import time
+
+__all__ = ["ProxyMetrics", "Histogram"]
+
+class Histogram:
+    '''Latency histogram with power-of-two microsecond buckets.
+
+    Bucket i counts samples in [2**(i-1), 2**i) us, bucket 0 those under 1us.'''
+    BUCKETS = 40
+
+    def __init__(self):
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, dt):
+        idx = min(int(dt * 1e6).bit_length(), self.BUCKETS - 1)
+        self.buckets[idx] += 1
+        self.count += 1
+        self.total += dt
+        if self.min is None or dt < self.min:
+            self.min = dt
+        if self.max is None or dt > self.max:
+            self.max = dt
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, q):
+        '''Upper bound (in seconds) of the bucket holding the q-th percentile'''
+        if not self.count:
+            return 0.0
+        want = q / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= want:
+                return min((1 << i) * 1e-6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.mean,
+            "min": self.min or 0.0,
+            "max": self.max or 0.0,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            # Keyed by bucket upper bound in us
+            "hist": {1 << i: n for i, n in enumerate(self.buckets) if n},
+        }
+
+class OpMetrics(Histogram):
+    def __init__(self):
+        super().__init__()
+        self.errors = 0
+
+    def snapshot(self):
+        snap = super().snapshot()
+        snap["errors"] = self.errors
+        return snap
+
+class _Timed:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.record(self.name, time.perf_counter() - self.start, exc_type is not None)
+        return False
+
+class ProxyMetrics:
+    '''Counters and latency histograms for a proxy link.
+
+    A scope (see M1N1Proxy.measure()) is a ProxyMetrics whose parent is the
+    enclosing one; everything recorded in a scope also goes to its parents.'''
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.reset()
+
+    def reset(self):
+        self.start = time.perf_counter()
+        self.counters = {}
+        self.ops = {}
+        self.wait = Histogram()
+
+    def add(self, key, n=1):
+        m = self
+        while m is not None:
+            m.counters[key] = m.counters.get(key, 0) + n
+            m = m.parent
+
+    def record(self, name, dt, error=False):
+        m = self
+        while m is not None:
+            op = m.ops.get(name, None)
+            if op is None:
+                op = m.ops[name] = OpMetrics()
+            op.add(dt)
+            if error:
+                op.errors += 1
+            m = m.parent
+
+    def record_wait(self, dt):
+        m = self
+        while m is not None:
+            m.wait.add(dt)
+            m = m.parent
+
+    def timed(self, name):
+        '''Context manager recording the duration of the block as op name'''
+        return _Timed(self, name)
+
+    def snapshot(self):
+        return {
+            "elapsed": time.perf_counter() - self.start,
+            "counters": dict(self.counters),
+            "reply_wait": self.wait.snapshot(),
+            "ops": {name: op.snapshot() for name, op in self.ops.items()},
+        }
+
+    def report(self, top=None):
+        '''Human readable summary, ops sorted by total time'''
+        snap = self.snapshot()
+        lines = []
+        elapsed = snap["elapsed"]
+        wait = snap["reply_wait"]
+        lines.append(f"Elapsed {elapsed:.3f}s, {wait['total']:.3f}s blocked in reply() "
+                     f"({wait['total'] / elapsed * 100 if elapsed else 0:.1f}%)")
+        if snap["counters"]:
+            lines.append("  " + ", ".join(f"{k}={v}" for k, v in sorted(snap["counters"].items())))
+        lines.append(f"  {'op':<24s} {'count':>8s} {'err':>5s} {'total':>9s} {'mean':>9s} "
+                     f"{'p50':>9s} {'p99':>9s} {'max':>9s}")
+        ops = sorted(snap["ops"].items(), key=lambda i: -i[1]["total"])
+        for name, op in ops[:top]:
+            us = lambda v: f"{v * 1e6:7.1f}us"
+            lines.append(f"  {name:<24s} {op['count']:8d} {op['errors']:5d} {op['total']:8.3f}s "
+                         f"{us(op['mean'])} {us(op['p50'])} {us(op['p99'])} {us(op['max'])}")
+        return "\n".join(lines)
@@ -1,11 +1,16 @@
 # SPDX-License-Identifier: MIT
-import os, sys, struct, serial, time
+import os, sys, struct, serial, time, functools, threading
+from collections import deque
+from contextlib import contextmanager
 from construct import *
 from enum import IntEnum, IntFlag
 from serial.tools.miniterm import Miniterm
 
 from .utils import *
 from .sysreg import *
+from .checksum import checksum
+from .transport import open_transport
+from .metrics import ProxyMetrics
 
 __all__ = ["REGION_RWX_EL0", "REGION_RW_EL0", "REGION_RX_EL1"]
 
@@ -66,7 +71,8 @@ class EXC_RET(IntEnum):
     EXIT_GUEST = 3
     STEP = 4
 
-ExcInfo = Struct(
+# Decoded on every guest exception, so precompiled
+ExcInfo = CompiledStruct(Struct(
     "regs" / Array(32, Int64ul),
     "spsr" / RegAdapter(SPSR),
     "elr" / Int64ul,
@@ -80,7 +86,7 @@ ExcInfo = Struct(
     "far_phys" / Int64ul,
     "sp_phys" / Int64ul,
     "data" / Int64ul,
-)
+))
 # Sends 56+ byte Commands and Expects 36 Byte Responses
 # Commands are format <I48sI
 #   4 byte command, 48 byte null padded data + 4 byte checksum
@@ -96,6 +102,129 @@ ExcInfo = Struct(
 #  If the status is ST_OK returns the data field to caller
 #     Otherwise reports a remote Error
 
+class UartReader:
+    '''Buffered reader for the proxy link.
+
+    Pulls data from the device in large chunks (whatever is already waiting,
+    up to CHUNK_SIZE) instead of one byte at a time. Frames are located with
+    bytes.find and decoded in place from the buffer.'''
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, dev):
+        self.dev = dev
+        self.reset()
+
+    def reset(self):
+        self.buf = bytearray()
+        self.pos = 0
+
+    def __len__(self):
+        return len(self.buf) - self.pos
+
+    def pull(self, size=1):
+        '''Read at least one byte from the device, raising UartTimeout if none arrive'''
+        waiting = getattr(self.dev, "in_waiting", 0)
+        block = self.dev.read(max(size, min(waiting, self.CHUNK_SIZE)))
+        if not block:
+            raise UartTimeout("Expected %d bytes, got 0 bytes" % size)
+        if self.pos and self.pos >= len(self.buf) // 2:
+            del self.buf[:self.pos]
+            self.pos = 0
+        self.buf += block
+
+    def fill(self, size):
+        '''Make sure at least size bytes are buffered'''
+        while len(self) < size:
+            avail = len(self)
+            try:
+                self.pull(size - avail)
+            except UartTimeout:
+                raise UartTimeout("Expected %d bytes, got %d bytes" % (size, avail))
+
+    def find(self, pattern):
+        idx = self.buf.find(pattern, self.pos)
+        return idx - self.pos if idx >= 0 else -1
+
+    def partial_suffix(self, pattern):
+        '''Length of the longest prefix of pattern that ends the buffer'''
+        for i in range(min(len(pattern) - 1, len(self)), 0, -1):
+            if self.buf.endswith(pattern[:i]):
+                return i
+        return 0
+
+    def unpack(self, fmt, offset=0):
+        return struct.unpack_from(fmt, self.buf, self.pos + offset)
+
+    def view(self, size):
+        '''memoryview of the next size buffered bytes, only valid until the next read'''
+        return memoryview(self.buf)[self.pos:self.pos + size]
+
+    def skip(self, size):
+        self.pos += size
+
+    def read(self, size):
+        avail = len(self)
+        if size <= avail:
+            with self.view(size) as v:
+                data = bytes(v)
+            self.pos += size
+            return data
+
+        # Large reads go straight from the device, bypassing the buffer
+        with self.view(avail) as v:
+            parts = [bytes(v)]
+        self.reset()
+        got = avail
+        while got < size:
+            block = self.dev.read(size - got)
+            if not block:
+                raise UartTimeout("Expected %d bytes, got %d bytes" % (size, got))
+            parts.append(block)
+            got += len(block)
+        return b"".join(parts)
+
+def open_device(device=None):
+    '''Open the link device described by device (default: $M1N1DEVICE).
+
+    device may be a serial port path (with optional :baud), a transport URL
+    or an already open serial-like object. Returns (dev, devpath, baud).'''
+    devpath = baud = None
+    if device is None:
+        device = os.environ.get("M1N1DEVICE", "/dev/ttyACM0:115200")
+    if isinstance(device, str) and "://" in device:
+        devpath = device
+        transport = open_transport(device)
+        if transport is not None:
+            device = transport
+        else:
+            device = device.split("://", 1)[1]
+    if isinstance(device, str):
+        baud = 115200
+        if ":" in device:
+            device, baud = device.rsplit(":", 1)
+            baud = int(baud)
+        devpath = device
+
+        device = Serial(devpath, baud)
+
+    if os.environ.get("M1N1RECORD"):
+        from .record import RecordingDevice
+        device = RecordingDevice(device, os.environ["M1N1RECORD"])
+
+    return device, devpath, baud
+
+def _metered(name):
+    '''Record calls to a UartInterface method as op name, if metrics are enabled'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.metrics is None:
+                return func(self, *args, **kwargs)
+            with self.metrics.timed(name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
 class UartInterface(Reloadable):
     REQ_NOP = 0x00AA55FF
     REQ_PROXY = 0x01AA55FF
@@ -113,26 +242,24 @@ class UartInterface(Reloadable):
     ST_XFERERR = -3
     ST_CSUMERR = -4
 
+    PREAMBLE = b"\xff\x55\xaa"
+
     CMD_LEN = 56
     REPLY_LEN = 36
     EVENT_HDR_LEN = 8
 
+    # Max number of proxy requests in flight when pipelining. The USB CDC
+    # receive buffer on the target is 1MB, so this only bounds host latency.
+    PIPELINE_DEPTH = 64
+
     def __init__(self, device=None, debug=False):
         self.debug = debug
-        self.devpath = None
-        if device is None:
-            device = os.environ.get("M1N1DEVICE", "/dev/ttyACM0:115200")
-        if isinstance(device, str):
-            baud = 115200
-            if ":" in device:
-                device, baud = device.rsplit(":", 1)
-                baud = int(baud)
-            self.devpath = device
+        device, self.devpath, baud = open_device(device)
+        if baud is not None:
             self.baudrate = baud
 
-            device = Serial(self.devpath, baud)
-
         self.dev = device
+        self.reader = UartReader(device)
         self.dev.timeout = 0
         self.dev.flushOutput()
         self.dev.flushInput()
@@ -145,15 +272,17 @@ class UartInterface(Reloadable):
         self.handlers = {}
         self.evt_handlers = {}
         self.enabled_features = Feature(0)
+        self.pending = deque()
+        # While receiving a pipelined reply, events and callbacks are queued
+        # here and run once the reply has been matched to its request
+        self.deferred = None
+        # Threads that must not use the link (e.g. HV tracer workers)
+        self.denied_threads = set()
+        # Set to a ProxyMetrics to collect statistics (see M1N1Proxy.stats())
+        self.metrics = ProxyMetrics() if os.environ.get("M1N1STATS") else None
 
     def checksum(self, data):
-        sum = 0xDEADBEEF;
-        for c in data:
-            sum *= 31337
-            sum += c ^ 0x5a
-            sum &= 0xFFFFFFFF
-
-        return (sum ^ 0xADDEDBAD) & 0xFFFFFFFF
+        return checksum(data)
 
     def data_checksum(self, data):
         if self.enabled_features & Feature.DISABLE_DATA_CSUMS:
@@ -162,15 +291,30 @@ class UartInterface(Reloadable):
         return self.checksum(data)
 
     def readfull(self, size):
-        d = b''
-        while len(d) < size:
-            block = self.dev.read(size - len(d))
-            if not block:
-                raise UartTimeout("Expected %d bytes, got %d bytes"%(size,len(d)))
-            d += block
-        return d
+        return self.reader.read(size)
+
+    def record(self, path):
+        '''Log all traffic on the link to path (see m1n1.record), until
+        stop_recording() is called. Also enabled by M1N1RECORD=path.'''
+        from .record import RecordingDevice
+        self.stop_recording()
+        with self.reader.view(len(self.reader)) as v:
+            buffered = bytes(v)
+        self.dev = self.reader.dev = RecordingDevice(self.dev, path, buffered)
+
+    def stop_recording(self):
+        from .record import RecordingDevice
+        if isinstance(self.dev, RecordingDevice):
+            self.dev.close_log()
+            self.dev = self.reader.dev = self.dev.dev
+
+    def cmd(self, cmd, payload=b"", pipelined=False):
+        if self.denied_threads and threading.get_ident() in self.denied_threads:
+            raise UartError(f"Link access from thread {threading.current_thread().name!r} is not allowed")
+        if self.pending and not pipelined:
+            # Synchronous commands must not interleave with in-flight replies
+            self.complete_pending()
 
-    def cmd(self, cmd, payload=b""):
         if len(payload) > self.CMD_LEN:
             raise ValueError("Incorrect payload size %d"%len(payload))
 
@@ -180,6 +324,8 @@ class UartInterface(Reloadable):
         if self.debug:
             print("<<", hexdump(command))
         self.dev.write(command)
+        if self.metrics is not None:
+            self.metrics.add("bytes_out", len(command))
 
     def unkhandler(self, s):
         if not self.tty_enable:
@@ -201,6 +347,11 @@ class UartInterface(Reloadable):
         self.tty_enable = True
         dev.timeout = None
 
+        if dev is self.dev and len(self.reader):
+            # Flush out whatever was already read ahead from the device
+            sys.stdout.buffer.write(self.reader.read(len(self.reader)))
+            sys.stdout.flush()
+
         term = Miniterm(dev, eol='cr')
         term.exit_character = chr(0x1d)  # GS/CTRL+]
         term.menu_character = chr(0x14)  # Menu: CTRL+T
@@ -223,57 +374,91 @@ class UartInterface(Reloadable):
         self.tty_enable = False
 
     def reply(self, cmd):
-        reply = b''
+        m = self.metrics
+        if m is None:
+            return self._reply(cmd)
+        t = time.perf_counter()
+        try:
+            return self._reply(cmd)
+        except UartTimeout:
+            m.add("timeouts")
+            raise
+        finally:
+            m.record_wait(time.perf_counter() - t)
+
+    def _reply(self, cmd):
+        rd = self.reader
+        m = self.metrics
         while True:
-            if not reply or reply[-1] != 255:
-                reply = b''
-                reply += self.readfull(1)
-                if reply != b"\xff":
-                    self.unkhandler(reply)
-                    continue
-            else:
-                reply = b'\xff'
-            reply += self.readfull(1)
-            if reply != b"\xff\x55":
-                self.unkhandler(reply)
-                continue
-            reply += self.readfull(1)
-            if reply != b"\xff\x55\xaa":
-                self.unkhandler(reply)
+            # Sync on the ff 55 aa preamble, everything else is TTY output
+            idx = rd.find(self.PREAMBLE)
+            if idx < 0:
+                keep = rd.partial_suffix(self.PREAMBLE)
+                if len(rd) > keep:
+                    if m is not None:
+                        m.add("tty_bytes", len(rd) - keep)
+                    self.unkhandler(rd.read(len(rd) - keep))
+                rd.pull()
                 continue
-            reply += self.readfull(1)
-            cmdin = struct.unpack("<I", reply)[0]
+            if idx:
+                if m is not None:
+                    m.add("tty_bytes", idx)
+                self.unkhandler(rd.read(idx))
+
+            rd.fill(4)
+            cmdin = rd.unpack("<I")[0]
             if cmdin == self.REQ_EVENT:
-                reply += self.readfull(self.EVENT_HDR_LEN - 4)
-                data_len, event_type = struct.unpack("<HH", reply[4:])
-                reply += self.readfull(data_len + 4)
-                if self.debug:
-                    print(">>", hexdump(reply))
-                checksum = struct.unpack("<I", reply[-4:])[0]
-                ccsum = self.data_checksum(reply[:-4])
+                rd.fill(self.EVENT_HDR_LEN)
+                data_len, event_type = rd.unpack("<HH", 4)
+                frame_len = self.EVENT_HDR_LEN + data_len + 4
+                rd.fill(frame_len)
+                with rd.view(frame_len) as frame:
+                    if self.debug:
+                        print(">>", hexdump(frame))
+                    checksum = struct.unpack_from("<I", frame, frame_len - 4)[0]
+                    ccsum = self.data_checksum(frame[:-4])
+                    data = bytes(frame[self.EVENT_HDR_LEN:-4])
+                rd.skip(frame_len)
+                if m is not None:
+                    m.add("bytes_in", frame_len)
+                    m.add(f"events.{EVENT(event_type).name}")
                 if checksum != ccsum:
                     print("Event checksum error: Expected 0x%08x, got 0x%08x"%(checksum, ccsum))
+                    if m is not None:
+                        m.add("csum_errors")
                     raise UartChecksumError()
-                self.handle_event(EVENT(event_type), reply[self.EVENT_HDR_LEN:-4])
-                reply = b''
+                if self.deferred is not None:
+                    self.deferred.append((self.handle_event, (EVENT(event_type), data)))
+                else:
+                    self.handle_event(EVENT(event_type), data)
                 continue
 
-            reply += self.readfull(self.REPLY_LEN - 4)
-            if self.debug:
-                print(">>", hexdump(reply))
-            status, data, checksum = struct.unpack("<i24sI", reply[4:])
-            ccsum = self.checksum(reply[:-4])
+            rd.fill(self.REPLY_LEN)
+            with rd.view(self.REPLY_LEN) as frame:
+                if self.debug:
+                    print(">>", hexdump(frame))
+                status, data, checksum = struct.unpack_from("<i24sI", frame, 4)
+                ccsum = self.checksum(frame[:-4])
+            rd.skip(self.REPLY_LEN)
+            if m is not None:
+                m.add("bytes_in", self.REPLY_LEN)
             if checksum != ccsum:
                 print("Reply checksum error: Expected 0x%08x, got 0x%08x"%(checksum, ccsum))
+                if m is not None:
+                    m.add("csum_errors")
                 raise UartChecksumError()
 
             if cmdin != cmd:
                 if cmdin == self.REQ_BOOT and status == self.ST_OK:
-                    self.handle_boot(data)
-                    reply = b''
+                    if self.deferred is not None:
+                        self.deferred.append((self.handle_boot, (data,)))
+                    else:
+                        self.handle_boot(data)
                     continue
                 raise UartCMDError("Reply command mismatch: Expected 0x%08x, got 0x%08x"%(cmd, cmdin))
             if status != self.ST_OK:
+                if m is not None:
+                    m.add("remote_errors")
                 if status == self.ST_BADCMD:
                     raise UartRemoteError("Reply error: Bad Command")
                 elif status == self.ST_INVAL:
@@ -312,6 +497,7 @@ class UartInterface(Reloadable):
         except:
             # Over USB, reboots cause a reconnect
             self.dev.close()
+            self.reader.reset()
             print("Waiting for reconnection... ", end="")
             sys.stdout.flush()
             for i in range(100):
@@ -319,7 +505,7 @@ class UartInterface(Reloadable):
                 sys.stdout.flush()
                 try:
                     self.dev.open()
-                except serial.serialutil.SerialException:
+                except (serial.serialutil.SerialException, OSError):
                     time.sleep(0.1)
                 else:
                     break
@@ -327,6 +513,7 @@ class UartInterface(Reloadable):
                 raise UartTimeout("Reconnection timed out")
             print(" Connected")
 
+    @_metered("NOP")
     def nop(self):
         features = Feature.get_all()
 
@@ -355,6 +542,49 @@ class UartInterface(Reloadable):
         else:
             return self.reply(self.REQ_PROXY)
 
+    def proxyreq_submit(self, req, complete, depth=None):
+        '''Send a proxy request without waiting for its reply.
+
+        complete(data, exc) is called with the reply data (or the error)
+        once the reply has been received. Replies are matched in order.'''
+        if depth is None:
+            depth = self.PIPELINE_DEPTH
+        while len(self.pending) >= depth:
+            self.complete_pending(1)
+        self.cmd(self.REQ_PROXY, req, pipelined=True)
+        self.pending.append(complete)
+
+    def complete_pending(self, count=None):
+        '''Receive replies for in-flight proxy requests (all of them by default)
+
+        Event and callback handlers may issue requests of their own, which
+        drain the remaining in-flight replies first. To keep replies matched
+        to the right requests, handlers for frames received ahead of a
+        reply only run after that reply has been completed.'''
+        while self.pending and (count is None or count > 0):
+            if count is not None:
+                count -= 1
+            prev, self.deferred = self.deferred, []
+            deferred = self.deferred
+            try:
+                data = self.reply(self.REQ_PROXY)
+            except (UartRemoteError, UartChecksumError, UartCMDError) as e:
+                # The whole reply frame was consumed, so the link is still in sync
+                self.pending.popleft()(None, e)
+            except BaseException as e:
+                # Link failure, nothing after this point can be matched up
+                pending, self.pending = self.pending, deque()
+                for complete in pending:
+                    complete(None, e)
+                raise
+            else:
+                self.pending.popleft()(data, None)
+            finally:
+                self.deferred = prev
+            for func, args in deferred:
+                func(*args)
+
+    @_metered("MEMWRITE")
     def writemem(self, addr, data, progress=False):
         checksum = self.data_checksum(data)
         size = len(data)
@@ -373,10 +603,13 @@ class UartInterface(Reloadable):
         if self.enabled_features & Feature.DISABLE_DATA_CSUMS:
             # Extra sentinel after the data to make sure no data is lost
             self.dev.write(struct.pack("<I", self.DATA_END_SENTINEL))
+        if self.metrics is not None:
+            self.metrics.add("bytes_out", size)
 
         # should automatically report a CRC failure
         self.reply(self.REQ_MEMWRITE)
 
+    @_metered("MEMREAD")
     def readmem(self, addr, size):
         if size == 0:
             return b""
@@ -389,14 +622,20 @@ class UartInterface(Reloadable):
         if self.debug:
             print(">> DATA:")
             chexdump(data)
+        if self.metrics is not None:
+            self.metrics.add("bytes_in", size)
         ccsum = self.data_checksum(data)
         if checksum != ccsum:
+            if self.metrics is not None:
+                self.metrics.add("csum_errors")
             raise UartChecksumError("Reply data checksum error: Expected 0x%08x, got 0x%08x"%(checksum, ccsum))
 
         if self.enabled_features & Feature.DISABLE_DATA_CSUMS:
             # Extra sentinel after the data to make sure no data was lost
             sentinel = struct.unpack("<I", self.readfull(4))[0]
             if sentinel != self.DATA_END_SENTINEL:
+                if self.metrics is not None:
+                    self.metrics.add("csum_errors")
                 raise UartChecksumError(f"Reply data sentinel error: Expected "
                     f"{self.DATA_END_SENTINEL:#x}, got {sentinel:#x}")
 
@@ -448,6 +687,128 @@ REGION_RWX_EL0 = 0x80000000000
 REGION_RW_EL0 = 0xa0000000000
 REGION_RX_EL1 = 0xc0000000000
 
+class ProxyFuture:
+    '''Pending result of a pipelined proxy request'''
+    def __init__(self, iface):
+        self.iface = iface
+        self._done = False
+        self._value = None
+        self._exc = None
+        self._callbacks = []
+
+    def _complete(self, value, exc):
+        self._value = value
+        self._exc = exc
+        self._done = True
+        for cb in self._callbacks:
+            cb(self)
+        self._callbacks = []
+
+    def add_done_callback(self, cb):
+        if self._done:
+            cb(self)
+        else:
+            self._callbacks.append(cb)
+
+    def done(self):
+        return self._done
+
+    def wait(self):
+        while not self._done:
+            if not self.iface.pending:
+                raise ProxyError("Future was never submitted")
+            self.iface.complete_pending(1)
+
+    def exception(self):
+        self.wait()
+        return self._exc
+
+    def result(self):
+        self.wait()
+        if self._exc is not None:
+            raise self._exc
+        return self._value
+
+    def __repr__(self):
+        if not self._done:
+            return "<ProxyFuture pending>"
+        elif self._exc is not None:
+            return f"<ProxyFuture error={self._exc!r}>"
+        else:
+            return f"<ProxyFuture result={self._value!r}>"
+
+class ProxyBatch:
+    '''Wraps M1N1Proxy so that requests are streamed without waiting for replies'''
+    def __init__(self, proxy, depth=None, check=True):
+        self.proxy = proxy
+        self.depth = depth
+        self.check = check
+        self.futures = []
+
+    def submit(self, opcode, req, signed=False):
+        fut = ProxyFuture(self.proxy.iface)
+        metrics = self.proxy.iface.metrics
+        if metrics is not None:
+            start = time.perf_counter()
+
+        def complete(reply, exc):
+            if exc is None:
+                try:
+                    value = self.proxy._parse_reply(opcode, reply, signed)
+                except ProxyError as e:
+                    exc = e
+            if metrics is not None:
+                # Pipelined latency: from submission until the reply was parsed
+                metrics.record(self.proxy.opcode_name(opcode), time.perf_counter() - start,
+                               exc is not None)
+            if exc is not None:
+                fut._complete(None, exc)
+            else:
+                fut._complete(value, None)
+
+        self.proxy.iface.proxyreq_submit(req, complete, self.depth)
+        self.futures.append(fut)
+        return fut
+
+    def run(self, func, *args, **kwargs):
+        '''Call func (e.g. a proxy method passed around as a callable) with
+        its requests going to this batch'''
+        start = len(self.futures)
+        prev, self.proxy._batch = self.proxy._batch, self
+        try:
+            ret = func(*args, **kwargs)
+        finally:
+            self.proxy._batch = prev
+        if ret is None and len(self.futures) == start + 1:
+            # Methods that discard the result (write32, ...) still get a future
+            return self.futures[start]
+        return ret
+
+    def __getattr__(self, attr):
+        func = getattr(self.proxy, attr)
+        if not callable(func):
+            return func
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.run(func, *args, **kwargs)
+
+        return wrapper
+
+    def flush(self):
+        self.proxy.iface.complete_pending()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.flush()
+        if exc_type is None and self.check:
+            for fut in self.futures:
+                if fut.exception() is not None:
+                    raise fut.exception()
+        return False
+
 # Uses UartInterface.proxyreq() to send requests to M1N1 and process
 # reponses sent back.
 class M1N1Proxy(Reloadable):
@@ -598,6 +959,7 @@ class M1N1Proxy(Reloadable):
         self.debug = debug
         self.iface = iface
         self.heap = None
+        self._batch = None
 
     def _request(self, opcode, *args, reboot=False, signed=False, no_reply=False, pre_reply=None):
         if len(args) > 6:
@@ -606,9 +968,20 @@ class M1N1Proxy(Reloadable):
         req = struct.pack("<7Q", opcode, *args)
         if self.debug:
             print("<<<< %08x: %08x %08x %08x %08x %08x %08x"%tuple([opcode] + args))
+        if self._batch is not None and not (reboot or no_reply or pre_reply):
+            return self._batch.submit(opcode, req, signed)
+        if self.iface.metrics is not None:
+            with self.iface.metrics.timed(self.opcode_name(opcode)):
+                return self._do_request(opcode, req, reboot, signed, no_reply)
+        return self._do_request(opcode, req, reboot, signed, no_reply)
+
+    def _do_request(self, opcode, req, reboot, signed, no_reply):
         reply = self.iface.proxyreq(req, reboot=reboot, no_reply=no_reply, pre_reply=None)
         if no_reply or reboot and reply is None:
             return
+        return self._parse_reply(opcode, reply, signed, reboot)
+
+    def _parse_reply(self, opcode, reply, signed=False, reboot=False):
         ret_fmt = "q" if signed else "Q"
         rop, status, retval = struct.unpack("<Qq" + ret_fmt, reply)
         if self.debug:
@@ -624,8 +997,11 @@ class M1N1Proxy(Reloadable):
                 raise ProxyRemoteError("Reply error: Unknown error (%d)"%status)
         return retval
 
-    def request(self, opcode, *args, **kwargs):
+    def _stage_args(self, args):
+        '''Copy str and bytes arguments to heap buffers. Returns the new
+        arguments, the buffers and what the uploads returned.'''
         free = []
+        uploads = []
         args = list(args)
         args2 = []
         for i, arg in enumerate(args):
@@ -634,16 +1010,91 @@ class M1N1Proxy(Reloadable):
             if isinstance(arg, bytes) and self.heap:
                 p = self.heap.malloc(len(arg))
                 free.append(p)
-                self.iface.writemem(p, arg)
+                uploads.append(self.iface.writemem(p, arg))
                 if (i < (len(args) - 1)) and args[i + 1] is None:
                     args[i + 1] = len(arg)
                 arg = p
             args2.append(arg)
+        return args2, free, uploads
+
+    def request(self, opcode, *args, **kwargs):
+        args2, free, uploads = self._stage_args(args)
         try:
-            return self._request(opcode, *args2, **kwargs)
-        finally:
+            ret = self._request(opcode, *args2, **kwargs)
+        except:
             for i in free:
                 self.heap.free(i)
+            raise
+        if isinstance(ret, ProxyFuture):
+            # Buffers must stay alive until the target has executed the request
+            ret.add_done_callback(lambda f: [self.heap.free(i) for i in free])
+        else:
+            for i in free:
+                self.heap.free(i)
+        return ret
+
+    def batch(self, depth=None, check=True):
+        '''Pipeline proxy requests issued through the returned object.
+
+        Calls return ProxyFuture objects instead of blocking on each reply:
+
+            with p.batch() as b:
+                vals = [b.read32(base + 4 * i) for i in range(256)]
+            vals = [v.result() for v in vals]
+
+        All replies have been received when the block exits. If check is set,
+        the first failed request raises its error there.'''
+        return ProxyBatch(self, depth, check)
+
+    @classmethod
+    def opcode_name(cls, opcode):
+        names = cls.__dict__.get("_opcode_names", None)
+        if names is None:
+            names = {}
+            for k, v in cls.__dict__.items():
+                if k.startswith("P_"):
+                    names.setdefault(v, k)
+            cls._opcode_names = names
+        return names.get(opcode, f"P_{opcode:#x}")
+
+    def enable_stats(self, enable=True):
+        '''Start (or stop) collecting per-opcode and link statistics'''
+        if not enable:
+            self.iface.metrics = None
+        elif self.iface.metrics is None:
+            self.iface.metrics = ProxyMetrics()
+
+    def stats(self, reset=False):
+        '''Snapshot of the statistics collected since enable_stats() (or the
+        last reset), or None if they are disabled. Also enabled by setting
+        M1N1STATS=1 in the environment.'''
+        metrics = self.iface.metrics
+        if metrics is None:
+            return None
+        snap = metrics.snapshot()
+        if reset:
+            metrics.reset()
+        return snap
+
+    @contextmanager
+    def measure(self, report=False):
+        '''Collect statistics for the duration of a with block:
+
+            with p.measure() as m:
+                ...
+            print(m.report())
+
+        This works whether or not enable_stats() was called; anything
+        measured is also added to the global statistics if they are enabled.'''
+        parent = self.iface.metrics
+        scope = ProxyMetrics(parent)
+        self.iface.metrics = scope
+        try:
+            yield scope
+        finally:
+            self.iface.metrics = parent
+            if report:
+                print(scope.report())
 
     def nop(self):
         self.request(self.P_NOP)
@@ -947,7 +1398,10 @@ class M1N1Proxy(Reloadable):
     def iodev_write(self, iodev, buf, size=None):
         return self.request(self.P_IODEV_WRITE, iodev, buf, size)
     def iodev_whoami(self):
-        return IODEV(self.request(self.P_IODEV_WHOAMI))
+        ret = self.request(self.P_IODEV_WHOAMI)
+        if isinstance(ret, ProxyFuture):
+            return ret
+        return IODEV(ret)
     def usb_iodev_vuart_setup(self, iodev):
         return self.request(self.P_USB_IODEV_VUART_SETUP, iodev)
 
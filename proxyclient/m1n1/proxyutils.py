@@ -1,17 +1,19 @@
 # SPDX-License-Identifier: MIT
-import serial, os, struct, sys, time, json, os.path, gzip, functools
+import serial, os, struct, sys, time, json, os.path, gzip, zlib, functools
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from construct import *
 
-from .asm import ARMAsm
+from .asm import ARMAsm, disassemble
 from .proxy import *
-from .utils import Reloadable, _ascii
+from .utils import Reloadable, _ascii, align_up
 from .tgtypes import *
 from .sysreg import *
 from .malloc import Heap
 from . import adt
 
-__all__ = ["ProxyUtils", "RegMonitor", "GuardedHeap", "bootstrap_port"]
+__all__ = ["ProxyUtils", "CodeCache", "RegionHash", "RegMonitor", "GuardedHeap", "bootstrap_port"]
 
 SIMD_B = Array(32, Array(16, Int8ul))
 SIMD_H = Array(32, Array(8, Int16ul))
@@ -21,6 +23,54 @@ SIMD_Q = Array(32, BytesInteger(16, swapped=True))
 
 class ProxyUtils(Reloadable):
     CODE_BUFFER_SIZE = 0x10000
+    CODE_CACHE_SIZE = 0x10000
+    SYSREG_BUFFER_SIZE = 0x8000
+    CACHE_LINE_SIZE = 64
+    # compressed_writemem works in chunks of this size, each compressed on a
+    # worker thread and decompressed by its own gzdec call
+    COMPRESS_CHUNK = 0x100000
+    # Chunks whose sample compresses worse than this are sent uncompressed
+    COMPRESS_MIN_RATIO = 0.9
+    # Rough per-thread gzip throughput (bytes/s) by level, refined as chunks
+    # are compressed
+    COMPRESS_RATES = {9: 10e6, 6: 25e6, 1: 80e6}
+    # Upload shadow file, see enable_shadow(). M1N1SHADOW=1 enables it at the
+    # default path, any other value is taken as the path.
+    SHADOW_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                               "m1n1", "shadow.json")
+    SHADOW_MAX_ENTRIES = 0x10000
+    # Per-chunk digest of [x0, x0 + x1) in chunks of x2 bytes, stored as
+    # words at x3. Each chunk continues from the seed held by the first word
+    # on entry, like zlib.crc32(chunk, seed). {op} is crc32 or crc32c.
+    HASH_STUB = """
+        ldr w4, [x3]
+    5:  cbz x1, 6f
+        cmp x1, x2
+        csel x6, x1, x2, lo
+        sub x1, x1, x6
+        mvn w7, w4
+        lsr x8, x6, #3
+        cbz x8, 2f
+    1:  ldr x9, [x0], #8
+        {op}x w7, w7, x9
+        subs x8, x8, #1
+        b.ne 1b
+    2:  and x6, x6, #7
+        cbz x6, 4f
+    3:  ldrb w9, [x0], #1
+        {op}b w7, w7, w9
+        subs x6, x6, #1
+        b.ne 3b
+    4:  mvn w7, w7
+        str w7, [x3], #4
+        b 5b
+    6:
+    """
+    # Host side implementations, where available
+    HASH_ALGOS = {"crc32": zlib.crc32, "crc32c": None}
+    HASH_CHUNK = 0x4000
+    # Value GUARD.MARK leaves in the destination register of a faulting instruction
+    EXC_MARK = 0xacce5515abad1dea
     def __init__(self, p, heap_size=1024 * 1024 * 1024):
         self.iface = p.iface
         self.proxy = p
@@ -52,6 +102,7 @@ class ProxyUtils(Reloadable):
         self.free = self.heap.free
 
         self.code_buffer = self.malloc(self.CODE_BUFFER_SIZE)
+        self.code_buffer_func = None
 
         self.adt_data = None
         self.adt = LazyADT(self)
@@ -60,6 +111,19 @@ class ProxyUtils(Reloadable):
         self.simd_type = None
         self.simd = None
 
+        self.code_cache = CodeCache(self, self.CODE_CACHE_SIZE)
+        self.sysreg_buf = self.malloc(self.SYSREG_BUFFER_SIZE)
+
+        self.compress_rates = dict(self.COMPRESS_RATES)
+        self.link_rate = None
+
+        self.shadow = None
+        self.shadow_path = None
+        self.shadow_skipped = 0
+        shadow = os.environ.get("M1N1SHADOW", "0").strip()
+        if shadow != "0":
+            self.enable_shadow(None if shadow == "1" else shadow)
+
         self.exec_modes = {
             None: (self.proxy.call, REGION_RX_EL1),
             "el2": (self.proxy.call, REGION_RX_EL1),
@@ -100,79 +164,383 @@ class ProxyUtils(Reloadable):
         if self.proxy.get_exc_count():
             raise ProxyError("Exception occurred")
 
-    def mrs(self, reg, *, silent=False, call=None):
-        '''read system register reg'''
+    @staticmethod
+    def sysreg_op(reg, base, rt=0):
+        '''Encode mrs (base=0xd5300000) or msr (base=0xd5100000) of reg with register xrt'''
         op0, op1, CRn, CRm, op2 = sysreg_parse(reg)
 
-        op =  (((op0 & 1) << 19) | (op1 << 16) | (CRn << 12) |
-               (CRm << 8) | (op2 << 5) | 0xd5300000)
+        return (((op0 & 1) << 19) | (op1 << 16) | (CRn << 12) |
+                (CRm << 8) | (op2 << 5) | base | rt)
 
-        return self.exec(op, call=call, silent=silent)
+    def mrs(self, reg, *, silent=False, call=None):
+        '''read system register reg'''
+        return self.exec(self.sysreg_op(reg, 0xd5300000), call=call, silent=silent)
 
     def msr(self, reg, val, *, silent=False, call=None):
         '''Write val to system register reg'''
-        op0, op1, CRn, CRm, op2 = sysreg_parse(reg)
-
-        op =  (((op0 & 1) << 19) | (op1 << 16) | (CRn << 12) |
-               (CRm << 8) | (op2 << 5) | 0xd5100000)
-
-        self.exec(op, val, call=call, silent=silent)
-
-    def exec(self, op, r0=0, r1=0, r2=0, r3=0, *, silent=False, call=None, ignore_exceptions=False):
+        self.exec(self.sysreg_op(reg, 0xd5100000), val, call=call, silent=silent)
+
+    def mrs_many(self, regs, *, silent=False, call=None):
+        '''Read several system registers with a single call. Returns a list
+        of values, with None for registers whose read faulted.'''
+        regs = list(regs)
+        if not regs:
+            return []
+        if len(regs) > self.SYSREG_BUFFER_SIZE // 8:
+            raise ValueError("Too many registers")
+        code = []
+        for i, reg in enumerate(regs):
+            code.append(self.sysreg_op(reg, 0xd5300000, 1)) # mrs x1, reg
+            code.append(0xf9000001 | (i << 10))             # str x1, [x0, #8 * i]
+        call, region = self._exec_mode(call)
+        addr = self.code_cache.load(struct.pack(f"<{len(code)}II", *code, 0xd65f03c0))
+        ret, cnt = self._guarded_call(call, addr | region, (self.sysreg_buf,),
+                                      GUARD.MARK, silent, True)
+        vals = list(struct.unpack(f"<{len(regs)}Q",
+                                  self.iface.readmem(self.sysreg_buf, 8 * len(regs))))
+        if cnt:
+            vals = [None if v == self.EXC_MARK else v for v in vals]
+        return vals
+
+    def msr_many(self, values, *, silent=False, call=None, ignore_exceptions=False):
+        '''Write several system registers with a single call. values is a
+        dict or a sequence of (reg, value) pairs, written in order.'''
+        if isinstance(values, dict):
+            values = values.items()
+        values = list(values)
+        if not values:
+            return
+        if len(values) > self.SYSREG_BUFFER_SIZE // 8:
+            raise ValueError("Too many registers")
+        code = []
+        for i, (reg, val) in enumerate(values):
+            code.append(0xf9400001 | (i << 10))             # ldr x1, [x0, #8 * i]
+            code.append(self.sysreg_op(reg, 0xd5100000, 1)) # msr reg, x1
+        self.iface.writemem(self.sysreg_buf,
+                            struct.pack(f"<{len(values)}Q", *(v for r, v in values)))
+        call, region = self._exec_mode(call)
+        addr = self.code_cache.load(struct.pack(f"<{len(code)}II", *code, 0xd65f03c0))
+        ret, cnt = self._guarded_call(call, addr | region, (self.sysreg_buf,),
+                                      GUARD.SKIP, silent, not ignore_exceptions)
+        if cnt:
+            raise ProxyError(f"{cnt} exception(s) occurred")
+
+    def _exec_mode(self, call):
         if callable(call):
-            region = REGION_RX_EL1
+            return call, REGION_RX_EL1
         elif isinstance(call, tuple):
-            call, region = call
+            return call
         else:
-            call, region = self.exec_modes[call]
+            return self.exec_modes[call]
+
+    def _guarded_call(self, call, addr, args, guard, silent, count):
+        '''Run call(addr, *args) under an exception guard, as one pipelined
+        batch. Returns the call result and the exception count (0 if count
+        is not set).'''
+        with self.proxy.batch() as b:
+            b.set_exc_guard(guard | (GUARD.SILENT if silent else 0))
+            ret = b.run(call, addr, *args)
+            if count:
+                cnt = b.get_exc_count()
+            b.set_exc_guard(GUARD.OFF)
+        if isinstance(ret, ProxyFuture):
+            ret = ret.result()
+        return ret, cnt.result() if count else 0
+
+    def exec(self, op, r0=0, r1=0, r2=0, r3=0, *, silent=False, call=None, ignore_exceptions=False):
+        call, region = self._exec_mode(call)
         if isinstance(op, tuple) or isinstance(op, list):
             func = struct.pack(f"<{len(op)}II", *op, 0xd65f03c0) # ret
+            addr = self.code_cache.load(func)
         elif isinstance(op, int):
             func = struct.pack("<II", op, 0xd65f03c0) # ret
+            addr = self.code_cache.load(func)
         elif isinstance(op, str):
-            c = ARMAsm(op + "; ret", self.code_buffer)
-            func = c.data
+            addr = self.code_cache.load_asm(op + "; ret")
         elif isinstance(op, bytes):
-            func = op
+            # Not necessarily position independent, so always run from code_buffer
+            addr = self.load_code_buffer(op)
         else:
             raise ValueError()
 
-        assert len(func) < self.CODE_BUFFER_SIZE
-        self.iface.writemem(self.code_buffer, func)
-        self.proxy.dc_cvau(self.code_buffer, len(func))
-        self.proxy.ic_ivau(self.code_buffer, len(func))
-
-        self.proxy.set_exc_guard(GUARD.SKIP | (GUARD.SILENT if silent else 0))
-        ret = call(self.code_buffer | region, r0, r1, r2, r3)
-        if not ignore_exceptions:
-            cnt = self.proxy.get_exc_count()
-            self.proxy.set_exc_guard(GUARD.OFF)
-            if cnt:
-                raise ProxyError("Exception occurred")
-        else:
-            self.proxy.set_exc_guard(GUARD.OFF)
+        ret, cnt = self._guarded_call(call, addr | region, (r0, r1, r2, r3),
+                                      GUARD.SKIP, silent, not ignore_exceptions)
+        if cnt:
+            raise ProxyError("Exception occurred")
 
         return ret
 
     inst = exec
 
-    def compressed_writemem(self, dest, data, progress):
+    def load_code_buffer(self, func):
+        '''Place func at code_buffer, unless it is already there'''
+        assert len(func) < self.CODE_BUFFER_SIZE
+        if func != self.code_buffer_func:
+            self.code_buffer_func = None
+            self.iface.writemem(self.code_buffer, func)
+            self.proxy.dc_cvau(self.code_buffer, len(func))
+            self.proxy.ic_ivau(self.code_buffer, len(func))
+            self.code_buffer_func = func
+        return self.code_buffer
+
+    def flush_code(self):
+        '''Forget all code believed to be resident (e.g. after the target was
+        reloaded or the buffers were overwritten)'''
+        self.code_cache.flush()
+        self.code_buffer_func = None
+
+    def crc32(self, addr, size, crc=0):
+        '''zlib.crc32 of target memory, computed on the target'''
+        if not size:
+            return crc
+        return self.hash_region(addr, size, "crc32", size, crc)[0]
+
+    def hash_region(self, addr, size, algo="crc32", chunk=None, seed=0):
+        '''Digests of each chunk (a page by default) of target memory,
+        computed on the target so only the digests cross the link'''
+        if algo not in self.HASH_ALGOS:
+            raise ValueError(f"Unknown hash algorithm {algo}")
+        chunk = chunk or self.HASH_CHUNK
+        count = (size + chunk - 1) // chunk
+        if not count:
+            return []
+        with self.heap.guarded_malloc(count * 4) as out:
+            self.proxy.write32(out, seed & 0xffffffff)
+            self.exec(self.HASH_STUB.format(op=algo), addr, size, chunk, out)
+            return list(struct.unpack(f"<{count}I", self.iface.readmem(out, count * 4)))
+
+    def verify_region(self, addr, data, chunk=None):
+        '''Compare target memory at addr with data without reading it back.
+        Returns the (offset, size) of every chunk that differs.'''
+        chunk = chunk or self.HASH_CHUNK
+        data = memoryview(data).cast("B")
+        digests = self.hash_region(addr, len(data), "crc32", chunk)
+        bad = []
+        for i, digest in enumerate(digests):
+            off = i * chunk
+            piece = data[off:off + chunk]
+            if zlib.crc32(piece) != digest:
+                bad.append((off, len(piece)))
+        return bad
+
+    def verify_writemem(self, addr, data, progress=False, retries=2):
+        '''compressed_writemem, then check the result on the target and
+        rewrite any chunks that did not make it'''
+        self.compressed_writemem(addr, data, progress)
+        data = memoryview(data).cast("B")
+        for i in range(retries + 1):
+            bad = self.verify_region(addr, data)
+            if not bad:
+                return
+            if progress:
+                print(f"Rewriting {len(bad)} chunks that failed verification")
+            for off, size in bad:
+                self.iface.writemem(addr + off, data[off:off + size])
+        raise ProxyError(f"Memory at {addr:#x} failed verification ({len(bad)} chunks)")
+
+    def mem_snapshot(self, addr, size, chunk=None, algo="crc32"):
+        '''Record the state of a target memory region, for mem_diff()'''
+        chunk = chunk or self.HASH_CHUNK
+        return RegionHash(addr, size, chunk, algo, self.hash_region(addr, size, algo, chunk))
+
+    def mem_diff(self, snapshot, update=False):
+        '''Addresses of the chunks that changed since snapshot was taken. If
+        update is set, snapshot is moved forward to the current state.'''
+        now = self.mem_snapshot(snapshot.addr, snapshot.size, snapshot.chunk, snapshot.algo)
+        changed = snapshot.changed(now)
+        if update:
+            snapshot.digests = now.digests
+        return changed
+
+    def enable_shadow(self, path=None):
+        '''Remember the crc32 of every chunk compressed_writemem uploads (in
+        path, so it carries over between sessions). Chunks whose content
+        matches the shadow are checked on the target and not uploaded again
+        if they are still intact.'''
+        self.shadow_path = path or self.SHADOW_PATH
+        try:
+            with open(self.shadow_path) as fd:
+                self.shadow = {int(k): tuple(v) for k, v in json.load(fd).items()}
+        except (OSError, ValueError, TypeError):
+            self.shadow = {}
+
+    def disable_shadow(self):
+        self.shadow = None
+        self.shadow_path = None
+
+    def _save_shadow(self):
+        while len(self.shadow) > self.SHADOW_MAX_ENTRIES:
+            del self.shadow[next(iter(self.shadow))]
+        try:
+            os.makedirs(os.path.dirname(self.shadow_path), exist_ok=True)
+            tmp = self.shadow_path + ".tmp"
+            with open(tmp, "w") as fd:
+                json.dump(self.shadow, fd)
+            os.replace(tmp, self.shadow_path)
+        except OSError:
+            pass
+
+    def _shadow_digests(self, dest, size):
+        '''Target crc32 of the chunks of [dest, dest + size) that have a
+        shadow entry, by offset. One exec covers all of them.'''
+        offs = [off for off in range(0, size, self.COMPRESS_CHUNK) if dest + off in self.shadow]
+        if not offs:
+            return {}
+        start, end = offs[0], min(offs[-1] + self.COMPRESS_CHUNK, size)
+        try:
+            digests = self.hash_region(dest + start, end - start, "crc32", self.COMPRESS_CHUNK)
+        except ProxyError:
+            return {}
+        return {off: digests[(off - start) // self.COMPRESS_CHUNK] for off in offs}
+
+    def _sample_ratio(self, chunk):
+        '''Estimated compression ratio of chunk, from a few spread out samples'''
+        if len(chunk) <= 0x10000:
+            sample = chunk
+        else:
+            step = len(chunk) // 16
+            sample = b"".join(chunk[i:i + 0x1000] for i in range(0, len(chunk), step))
+        return len(zlib.compress(sample, 1)) / len(sample)
+
+    def _compress_level(self, ratio, workers):
+        '''Highest level at which compression still keeps up with the link'''
+        if self.link_rate is None:
+            return 6
+        for level in sorted(self.compress_rates, reverse=True):
+            if self.compress_rates[level] * workers * ratio >= self.link_rate:
+                return level
+        return 1
+
+    def _compress_chunk(self, chunk, level):
+        t = time.perf_counter()
+        payload = gzip.compress(chunk, level)
+        dt = time.perf_counter() - t
+        if dt > 0.01:
+            rate = self.compress_rates[level]
+            self.compress_rates[level] = 0.75 * rate + 0.25 * len(chunk) / dt
+        return payload
+
+    def _upload_chunk(self, addr, payload):
+        t = time.perf_counter()
+        self.iface.writemem(addr, payload)
+        dt = time.perf_counter() - t
+        if dt > 0.01:
+            rate = len(payload) / dt
+            self.link_rate = rate if self.link_rate is None else 0.75 * self.link_rate + 0.25 * rate
+
+    def compressed_writemem(self, dest, data, progress, workers=None):
+        '''Write data to dest, gzip compressed on the host and decompressed
+        by m1n1. Chunks are compressed in parallel while earlier ones are
+        uploaded; all-zero chunks are cleared with memset and incompressible
+        ones are written as is.'''
         if not len(data):
             return
 
-        payload = gzip.compress(data)
-        compressed_size = len(payload)
-
-        with self.heap.guarded_malloc(compressed_size) as compressed_addr:
-            self.iface.writemem(compressed_addr, payload, progress)
-            timeout = self.iface.dev.timeout
-            self.iface.dev.timeout = None
-            try:
-                decompressed_size = self.proxy.gzdec(compressed_addr, compressed_size, dest, len(data))
-            finally:
-                self.iface.dev.timeout = timeout
+        data = memoryview(data).cast("B")
+        workers = workers or os.cpu_count() or 1
+        done = skipped = 0
+        target = self._shadow_digests(dest, len(data)) if self.shadow is not None else {}
+        zero = bytes(self.COMPRESS_CHUNK)
+
+        def prepare(pool, chunk):
+            if zero.startswith(chunk):
+                return "zero", None
+            ratio = self._sample_ratio(chunk)
+            if ratio > self.COMPRESS_MIN_RATIO:
+                return "raw", None
+            level = self._compress_level(ratio, workers)
+            return "gzip", pool.submit(self._compress_chunk, chunk, level)
+
+        with ThreadPoolExecutor(workers) as pool:
+            # Keep a bounded number of chunks in flight so memory use does
+            # not scale with the image size
+            queue = deque()
+            pending = iter(range(0, len(data), self.COMPRESS_CHUNK))
+
+            def refill():
+                nonlocal done, skipped
+                while len(queue) < 2 * workers:
+                    off = next(pending, None)
+                    if off is None:
+                        return
+                    chunk = data[off:off + self.COMPRESS_CHUNK]
+                    crc = None
+                    if self.shadow is not None:
+                        crc = zlib.crc32(chunk)
+                        if (self.shadow.get(dest + off) == (len(chunk), crc) and
+                            target.get(off) == crc):
+                            done += len(chunk)
+                            skipped += len(chunk)
+                            continue
+                    queue.append((off, chunk, crc) + prepare(pool, chunk))
+
+            refill()
+            while queue:
+                off, chunk, crc, kind, fut = queue.popleft()
+                refill()
+
+                if kind == "zero":
+                    self.memzero(dest + off, len(chunk))
+                elif kind == "raw":
+                    self._upload_chunk(dest + off, chunk)
+                else:
+                    payload = fut.result()
+                    with self.heap.guarded_malloc(len(payload)) as compressed_addr:
+                        self._upload_chunk(compressed_addr, payload)
+                        timeout = self.iface.dev.timeout
+                        self.iface.dev.timeout = None
+                        try:
+                            decompressed_size = self.proxy.gzdec(compressed_addr, len(payload),
+                                                                 dest + off, len(chunk))
+                        finally:
+                            self.iface.dev.timeout = timeout
+                    assert decompressed_size == len(chunk)
+
+                if self.shadow is not None:
+                    self.shadow.pop(dest + off, None)
+                    self.shadow[dest + off] = (len(chunk), crc)
+                done += len(chunk)
+                if progress:
+                    sys.stdout.write(f"\r{done / 1048576:8.2f} / {len(data) / 1048576:.2f} MiB")
+                    sys.stdout.flush()
+        if progress:
+            print()
 
-            assert decompressed_size == len(data)
+        if self.shadow is not None:
+            self.shadow_skipped += skipped
+            self._save_shadow()
+            if progress and skipped:
+                print(f"Skipped {skipped / 1048576:.2f} MiB already on the target")
+
+    def memzero(self, addr, size):
+        '''Clear memory, using dc zva for whole cache lines (the target
+        range must be normal memory)'''
+        start = align_up(addr, self.CACHE_LINE_SIZE)
+        end = (addr + size) & ~(self.CACHE_LINE_SIZE - 1)
+        if end - start < 4 * self.CACHE_LINE_SIZE:
+            if size:
+                self.proxy.memset8(addr, 0, size)
+            return
+        if start > addr:
+            self.proxy.memset8(addr, 0, start - addr)
+        self.proxy.dc_zva(start, end - start)
+        if addr + size > end:
+            self.proxy.memset8(end, 0, addr + size - end)
+
+    def write_extents(self, dest, extents, progress=False):
+        '''Write (offset, data) extents as returned by MachO.prepare_extents
+        to dest. Zero extents are cleared on the target, so only file
+        backed data is compressed and uploaded.'''
+        total = sum(data if isinstance(data, int) else len(data) for off, data in extents)
+        uploaded = 0
+        for off, data in extents:
+            if isinstance(data, int):
+                self.memzero(dest + off, data)
+            else:
+                self.compressed_writemem(dest + off, data, False)
+                uploaded += len(data)
+        if progress:
+            print(f"Wrote {total / 1048576:.2f} MiB ({uploaded / 1048576:.2f} MiB of data)")
 
     def get_adt(self):
         if self.adt_data is not None:
@@ -195,8 +563,7 @@ class ProxyUtils(Reloadable):
          optional pc address will mark that line with a '*' '''
         code = struct.unpack(f"<{size // 4}I", self.iface.readmem(start, size))
 
-        c = ARMAsm(".inst " + ",".join(str(i) for i in code), start)
-        lines = list(c.disassemble())
+        lines = disassemble(code, start)
         if pc is not None:
             idx = (pc - start) // 4
             lines[idx] = " *" + lines[idx][2:]
@@ -314,6 +681,152 @@ class ProxyUtils(Reloadable):
     def q(self):
         return self.get_simd(SIMD_Q)
 
+class RegionHash:
+    '''Per-chunk digests of a target memory region, see ProxyUtils.mem_snapshot'''
+    def __init__(self, addr, size, chunk, algo, digests):
+        self.addr = addr
+        self.size = size
+        self.chunk = chunk
+        self.algo = algo
+        self.digests = digests
+
+    def changed(self, other):
+        '''Addresses of chunks whose digests differ between two snapshots of
+        the same region'''
+        if (self.addr, self.size, self.chunk, self.algo) != (other.addr, other.size,
+                                                              other.chunk, other.algo):
+            raise ValueError("Snapshots are of different regions")
+        return [self.addr + i * self.chunk
+                for i, (a, b) in enumerate(zip(self.digests, other.digests)) if a != b]
+
+    def __repr__(self):
+        return f"<RegionHash {self.addr:#x}+{self.size:#x} ({len(self.digests)} x {self.chunk:#x})>"
+
+class CodeCache:
+    '''Cache of code resident in target memory, keyed by content.
+
+    The buffer is split into fixed-size slots and each entry takes one or
+    more contiguous slots. When there is no room left, the least recently
+    used entries are evicted. Position independent code is keyed by its
+    bytes; assembly source is keyed by its text and assembled for the slot
+    it is loaded into.'''
+    SLOT_SIZE = 0x400
+
+    def __init__(self, utils, size, slot_size=SLOT_SIZE):
+        self.utils = utils
+        self.slot_size = slot_size
+        self.nslots = size // slot_size
+        self.base = utils.memalign(slot_size, self.nslots * slot_size)
+        self.flush()
+        self.reset_stats()
+
+    def flush(self):
+        # key -> (first slot, slot count), in LRU order
+        self.entries = OrderedDict()
+        self.owner = [None] * self.nslots
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uploaded = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "entries": len(self.entries),
+            "slots_used": self.nslots - self.owner.count(None),
+            "slots": self.nslots,
+            "bytes_uploaded": self.uploaded,
+        }
+
+    def _count(self, what):
+        metrics = self.utils.iface.metrics
+        if metrics is not None:
+            metrics.add("code_cache." + what)
+
+    def lookup(self, key):
+        '''Address of the entry for key, or None'''
+        ent = self.entries.get(key, None)
+        if ent is None:
+            self.misses += 1
+            self._count("miss")
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        self._count("hit")
+        return self.base + ent[0] * self.slot_size
+
+    def _find(self, count):
+        run = 0
+        for i, owner in enumerate(self.owner):
+            run = run + 1 if owner is None else 0
+            if run == count:
+                return i - count + 1
+        return None
+
+    def _free(self, key):
+        first, count = self.entries.pop(key)
+        self.owner[first:first + count] = [None] * count
+
+    def alloc(self, key, size):
+        '''Reserve room for size bytes of code under key, evicting least
+        recently used entries as needed. Returns the address.'''
+        if key in self.entries:
+            self._free(key)
+        count = max(1, align_up(size, self.slot_size) // self.slot_size)
+        if count > self.nslots:
+            raise ValueError(f"Code too large for the cache ({size:#x} bytes)")
+        while (first := self._find(count)) is None:
+            self._free(next(iter(self.entries)))
+            self.evictions += 1
+            self._count("evict")
+        self.owner[first:first + count] = [key] * count
+        self.entries[key] = (first, count)
+        return self.base + first * self.slot_size
+
+    def _upload(self, addr, func):
+        self.utils.iface.writemem(addr, func)
+        self.utils.proxy.dc_cvau(addr, len(func))
+        self.utils.proxy.ic_ivau(addr, len(func))
+        self.uploaded += len(func)
+
+    def load(self, func):
+        '''Address of a resident copy of the position independent code func'''
+        addr = self.lookup(func)
+        if addr is None:
+            addr = self.alloc(func, len(func))
+            try:
+                self._upload(addr, func)
+            except:
+                self._free(func)
+                raise
+        return addr
+
+    def load_asm(self, source):
+        '''Address of a resident copy of source, assembled to run there'''
+        key = ("asm", source)
+        addr = self.lookup(key)
+        if addr is not None:
+            return addr
+        # Assemble for a single slot first; larger code is placed again
+        addr = self.alloc(key, self.slot_size)
+        try:
+            c = ARMAsm(source, addr)
+            if c.len > self.slot_size:
+                addr = self.alloc(key, c.len)
+                c = ARMAsm(source, addr)
+            self._upload(addr, c.data)
+        except:
+            if key in self.entries:
+                self._free(key)
+            raise
+        return addr
+
 class LazyADT:
     def __init__(self, utils):
         self.__dict__["_utils"] = utils
@@ -0,0 +1,292 @@
+# SPDX-License-Identifier: MIT
+# Recording and replay of proxy link traffic.
+#
+# A recording is the raw byte stream in both directions, timestamped, so it
+# holds every command, reply, bulk transfer, event and TTY byte exactly as
+# the host saw them. Replaying it through ReplayDevice stands in for the
+# target: reads return what the target sent, but only once the host has
+# written as much as it had when that data originally arrived.
+#
+#   M1N1RECORD=session.rec.gz python tools/...        (or iface.record(path))
+#   M1N1DEVICE=replay://session.rec.gz python tools/...
+#   python -m m1n1.record session.rec.gz              (summary/dump)
+#
+# File format: MAGIC, then <dI> (start time, version), then records of
+# <BQI> (kind, nanoseconds since start, length) followed by the data.
+# Files ending in .gz are gzip compressed.
+import atexit, gzip, struct, time
+
+from .proxy import UartError
+
+__all__ = ["RecordingDevice", "ReplayDevice", "ReplayError", "load_recording"]
+
+MAGIC = b"M1N1REC\0"
+VERSION = 1
+HDR = struct.Struct("<dI")
+REC = struct.Struct("<BQI")
+
+TX = 0 # host -> target
+RX = 1 # target -> host
+MARK = 2 # free-form note, e.g. reconnects
+
+class ReplayError(UartError):
+    pass
+
+def _open(path, mode):
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode, compresslevel=1)
+    return open(path, mode)
+
+class RecordingDevice:
+    '''Wraps a serial-like device and logs all traffic through it'''
+    def __init__(self, dev, path, initial=b""):
+        self.dev = dev
+        self.path = path
+        self.log = _open(path, "wb")
+        self.log.write(MAGIC + HDR.pack(time.time(), VERSION))
+        self.start = time.monotonic_ns()
+        atexit.register(self.close_log)
+        if initial:
+            # Data the host had already buffered when recording started
+            self._record(RX, initial)
+
+    def _record(self, kind, data):
+        if self.log is None:
+            return
+        self.log.write(REC.pack(kind, time.monotonic_ns() - self.start, len(data)))
+        self.log.write(data)
+
+    def mark(self, note):
+        self._record(MARK, note.encode("utf-8"))
+
+    def close_log(self):
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+            atexit.unregister(self.close_log)
+
+    def read(self, size=1):
+        data = self.dev.read(size)
+        if data:
+            self._record(RX, data)
+        return data
+
+    def write(self, data):
+        self._record(TX, bytes(data))
+        return self.dev.write(data)
+
+    def open(self):
+        self.mark("open")
+        self.dev.open()
+
+    def close(self):
+        self.mark("close")
+        self.dev.close()
+
+    @property
+    def timeout(self):
+        return self.dev.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.dev.timeout = timeout
+
+    @property
+    def baudrate(self):
+        return self.dev.baudrate
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self.dev.baudrate = baudrate
+
+    def __getattr__(self, attr):
+        return getattr(self.dev, attr)
+
+def load_recording(path):
+    '''Returns (start_time, [(kind, ns, data), ...])'''
+    with _open(path, "rb") as fd:
+        blob = fd.read()
+    if blob[:len(MAGIC)] != MAGIC:
+        raise ReplayError(f"{path} is not a proxy recording")
+    start, version = HDR.unpack_from(blob, len(MAGIC))
+    if version != VERSION:
+        raise ReplayError(f"Unsupported recording version {version}")
+    off = len(MAGIC) + HDR.size
+    records = []
+    while off < len(blob):
+        kind, ns, size = REC.unpack_from(blob, off)
+        off += REC.size
+        records.append((kind, ns, blob[off:off + size]))
+        off += size
+    return start, records
+
+class ReplayDevice:
+    '''Serial-like device that plays back a recording.
+
+    With realtime=True, replies are delayed like they were in the recording
+    (relative to the command that preceded them); otherwise they are
+    available as soon as the host has sent what preceded them. With
+    strict=True, host writes that differ from the recording raise
+    ReplayError instead of only being counted in self.mismatches.'''
+    def __init__(self, path, realtime=False, strict=False, timeout=None):
+        self.path = path
+        self.realtime = realtime
+        self.strict = strict
+        self.timeout = timeout
+        self.baudrate = None
+        self.is_open = True
+
+        start, records = load_recording(path)
+        tx = []
+        # RX chunks as (tx bytes needed, delay after the last TX, data)
+        self.rx = []
+        tx_len = 0
+        tx_ns = 0
+        for kind, ns, data in records:
+            if kind == TX:
+                tx.append(data)
+                tx_len += len(data)
+                tx_ns = ns
+            elif kind == RX:
+                self.rx.append((tx_len, (ns - tx_ns) / 1e9, data))
+        self.tx = b"".join(tx)
+        self.tx_pos = 0
+        self.tx_time = time.monotonic()
+        self.rx_idx = 0
+        self.rx_off = 0
+        self.mismatches = 0
+
+    @property
+    def done(self):
+        return self.rx_idx >= len(self.rx)
+
+    def _available(self):
+        '''Bytes that can be returned right now'''
+        avail = 0
+        now = time.monotonic()
+        for i in range(self.rx_idx, len(self.rx)):
+            need, delay, data = self.rx[i]
+            if need > self.tx_pos:
+                break
+            if self.realtime and now < self.tx_time + delay:
+                break
+            avail += len(data) - (self.rx_off if i == self.rx_idx else 0)
+            if avail >= 1 << 20:
+                break
+        return avail
+
+    @property
+    def in_waiting(self):
+        return self._available()
+
+    def read(self, size=1):
+        if self.done:
+            raise ReplayError("End of recording")
+        if self.timeout is not None:
+            deadline = time.monotonic() + self.timeout
+        out = []
+        got = 0
+        while got < size and not self.done:
+            need, delay, data = self.rx[self.rx_idx]
+            if need > self.tx_pos:
+                # The target only sent this after more host output
+                if self.timeout is None and not got:
+                    raise ReplayError("Host waits for data that was only received "
+                                      "after further output in the recording")
+                break
+            if self.realtime:
+                due = self.tx_time + delay
+                now = time.monotonic()
+                if now < due:
+                    if got:
+                        break
+                    if self.timeout is not None and deadline < due:
+                        time.sleep(max(0, deadline - now))
+                        break
+                    time.sleep(due - now)
+            block = data[self.rx_off:self.rx_off + size - got]
+            out.append(block)
+            got += len(block)
+            self.rx_off += len(block)
+            if self.rx_off >= len(data):
+                self.rx_idx += 1
+                self.rx_off = 0
+        return b"".join(out)
+
+    def write(self, data):
+        data = bytes(data)
+        expect = self.tx[self.tx_pos:self.tx_pos + len(data)]
+        if data != expect:
+            self.mismatches += 1
+            if self.strict:
+                raise ReplayError(f"Host output differs from the recording at TX offset "
+                                  f"{self.tx_pos:#x}")
+        self.tx_pos += len(data)
+        self.tx_time = time.monotonic()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        # Flushed data was never read on the recording side, so it is not
+        # in the recording either
+        pass
+    reset_input_buffer = flushInput
+
+    def flushOutput(self):
+        pass
+    reset_output_buffer = flushOutput
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+def _summary(path, dump=False):
+    from .proxy import UartInterface, M1N1Proxy
+
+    start, records = load_recording(path)
+    reqs = {getattr(UartInterface, k): k for k in dir(UartInterface) if k.startswith("REQ_")}
+    print(f"{path}: recorded {time.ctime(start)}, {len(records)} records")
+    totals = {TX: 0, RX: 0}
+    cmds = {}
+    tx = b"".join(data for kind, ns, data in records if kind == TX)
+    for kind, ns, data in records:
+        if kind in totals:
+            totals[kind] += len(data)
+        if dump:
+            name = {TX: "TX", RX: "RX", MARK: "--"}[kind]
+            preview = data[:32].hex() if kind != MARK else data.decode("utf-8", "replace")
+            print(f"{ns / 1e9:12.6f} {name} {len(data):8d} {preview}")
+
+    # Walk the command stream: 64-byte commands, MEMWRITE followed by its data
+    pos = 0
+    while True:
+        pos = tx.find(UartInterface.PREAMBLE, pos)
+        if pos < 0 or pos + 64 > len(tx):
+            break
+        req, = struct.unpack_from("<I", tx, pos)
+        name = reqs.get(req, f"{req:#x}")
+        if req == UartInterface.REQ_PROXY:
+            opcode, = struct.unpack_from("<Q", tx, pos + 4)
+            name = M1N1Proxy.opcode_name(opcode)
+        cmds[name] = cmds.get(name, 0) + 1
+        if req == UartInterface.REQ_MEMWRITE:
+            addr, size = struct.unpack_from("<QQ", tx, pos + 4)
+            pos += size
+        pos += 64
+
+    if records:
+        print(f"Duration {records[-1][1] / 1e9:.3f}s, TX {totals[TX]} bytes, RX {totals[RX]} bytes")
+    for name, count in sorted(cmds.items(), key=lambda i: -i[1]):
+        print(f"  {name:24s} {count:8d}")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Inspect a proxy session recording')
+    parser.add_argument('-d', '--dump', action="store_true", help="List all records")
+    parser.add_argument('recording')
+    args = parser.parse_args()
+    _summary(args.recording, args.dump)
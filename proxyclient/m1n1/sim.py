@@ -0,0 +1,540 @@
+# SPDX-License-Identifier: MIT
+# Stand-in m1n1 proxy target for offline testing and benchmarking of the host
+# stack. It speaks the same wire protocol as src/uartproxy.c (REQ_* frames,
+# checksums, feature negotiation, events) and implements the common P_* proxy
+# opcodes on top of a sparse memory model, with optional scripted MMIO models.
+#
+# Typical use as a fixture:
+#
+#   sim = SimTarget()
+#   iface = UartInterface(sim.connect())
+#   p = M1N1Proxy(iface)
+#
+# or from a shell: python -m m1n1.sim --pty (then M1N1DEVICE=pty:///dev/pts/N)
+import lzma, os, socket, struct, threading, time, tty, zlib
+
+from .checksum import checksum
+from .proxy import UartInterface, M1N1Proxy, Feature, EVENT, START, IODEV, GUARD
+from .tgtypes import BootArgs
+from .transport import SocketTransport
+from .utils import ScalarRangeMap, Reloadable
+
+__all__ = ["SimTarget", "SparseMemory", "SimError"]
+
+class SimError(Exception):
+    pass
+
+class SparseMemory:
+    '''Byte-addressable memory backed by lazily allocated pages'''
+    PAGE_BITS = 16
+    PAGE_SIZE = 1 << PAGE_BITS
+    PAGE_MASK = PAGE_SIZE - 1
+
+    def __init__(self):
+        self.pages = {}
+
+    def _chunks(self, addr, size):
+        while size > 0:
+            off = addr & self.PAGE_MASK
+            n = min(size, self.PAGE_SIZE - off)
+            yield addr >> self.PAGE_BITS, off, n
+            addr += n
+            size -= n
+
+    def read(self, addr, size):
+        out = bytearray(size)
+        pos = 0
+        for page, off, n in self._chunks(addr, size):
+            data = self.pages.get(page, None)
+            if data is not None:
+                out[pos:pos + n] = data[off:off + n]
+            pos += n
+        return bytes(out)
+
+    def write(self, addr, data):
+        data = memoryview(data).cast("B")
+        pos = 0
+        for page, off, n in self._chunks(addr, len(data)):
+            buf = self.pages.get(page, None)
+            if buf is None:
+                buf = self.pages[page] = bytearray(self.PAGE_SIZE)
+            buf[off:off + n] = data[pos:pos + n]
+            pos += n
+
+    def fill(self, addr, byte, size):
+        for page, off, n in self._chunks(addr, size):
+            buf = self.pages.get(page, None)
+            if buf is None:
+                if byte == 0:
+                    continue
+                buf = self.pages[page] = bytearray(self.PAGE_SIZE)
+            buf[off:off + n] = bytes([byte]) * n
+
+    @property
+    def resident(self):
+        return len(self.pages) * self.PAGE_SIZE
+
+class MMIOFunc:
+    def __init__(self, read=None, write=None):
+        self._read = read
+        self._write = write
+
+    def read(self, addr, width):
+        return self._read(addr, width) if self._read else 0
+
+    def write(self, addr, data, width):
+        if self._write:
+            self._write(addr, data, width)
+
+class SimTarget(Reloadable):
+    '''A fake m1n1 running the UART proxy'''
+    PHYS_BASE = 0x800000000
+    MEM_SIZE = 8 << 30
+    BASE = 0x803800000
+    BOOTARGS = 0x803000000
+    HEAPBLOCK = 0x804000000
+    MALLOC = 0x880000000
+    VIRT_BASE = 0xfffffe0007004000
+
+    # Bits of proxy call addresses that select the execution region
+    REGION_MASK = (1 << 41) - 1
+    EXC_MARK = 0xacce5515abad1dea
+
+    def __init__(self, iodev=IODEV.USB0, adt=None, latency=0):
+        self.iodev = iodev
+        self.latency = latency
+        self.mem = SparseMemory()
+        self.mmio = ScalarRangeMap()
+        self.sysregs = {}
+        self.undefined_sysregs = set()
+        self.exc_count = 0
+        self.exc_guard = 0
+        self.features = Feature(0)
+        self.heapblock_top = self.HEAPBLOCK
+        self.malloc_top = self.MALLOC
+        self.allocs = {}
+        self.requests = 0
+        self.running = False
+        self.dev = None
+        self.queued = []
+        self._lock = threading.Lock()
+        self._thread = None
+
+        if adt is None:
+            adt = b""
+        self.adt = adt
+        self.adt_addr = self.BOOTARGS + 0x10000
+        self.mem.write(self.adt_addr, adt)
+        ba = BootArgs.build(dict(
+            revision=2, version=2, virt_base=self.VIRT_BASE, phys_base=self.PHYS_BASE,
+            mem_size=self.MEM_SIZE, top_of_kernel_data=self.HEAPBLOCK,
+            video=dict(base=0, display=0, stride=0, width=0, height=0, depth=0),
+            machine_type=0,
+            devtree=self.adt_addr - self.PHYS_BASE + self.VIRT_BASE,
+            devtree_size=len(adt), cmdline="", boot_flags=0,
+            mem_size_actual=self.MEM_SIZE))
+        self.mem.write(self.BOOTARGS, ba)
+
+    # Models
+
+    def add_mmio(self, start, size, model=None, read=None, write=None):
+        '''Route accesses to [start, start + size) to a model with
+        read(addr, width) and write(addr, data, width) methods (or to the
+        read/write functions).'''
+        if model is None:
+            model = MMIOFunc(read, write)
+        self.mmio[start:start + size] = model
+        return model
+
+    def read(self, addr, width):
+        model = self.mmio.get(addr)
+        if model is not None:
+            return model.read(addr, width)
+        return int.from_bytes(self.mem.read(addr, width // 8), "little")
+
+    def write(self, addr, data, width):
+        model = self.mmio.get(addr)
+        if model is not None:
+            return model.write(addr, data, width)
+        data &= (1 << width) - 1
+        self.mem.write(addr, data.to_bytes(width // 8, "little"))
+
+    # Framing
+
+    def _send(self, data):
+        with self._lock:
+            self.dev.write(data)
+
+    def _data_checksum(self, data):
+        if self.features & Feature.DISABLE_DATA_CSUMS:
+            return UartInterface.CHECKSUM_SENTINEL
+        return checksum(data)
+
+    def _reply(self, rtype, status, payload=b""):
+        reply = struct.pack("<Ii", rtype, status) + payload.ljust(24, b"\0")
+        return reply + struct.pack("<I", checksum(reply))
+
+    def send_boot(self, reason=START.BOOT, code=0, info=0):
+        '''Send a REQ_BOOT frame, as m1n1 does on startup and on exceptions'''
+        self._send(self._reply(UartInterface.REQ_BOOT, 0,
+                               struct.pack("<IIQQ", reason, code, info, 0)))
+
+    def send_event(self, event_type, data, queue=False):
+        '''Send an EVENT frame. With queue=True, the event is held back and
+        sent just before the next reply, while the host is reading.'''
+        hdr = struct.pack("<IHH", UartInterface.REQ_EVENT, len(data), event_type)
+        frame = hdr + data
+        frame += struct.pack("<I", self._data_checksum(frame))
+        if queue:
+            self.queued.append(frame)
+        else:
+            self._send(frame)
+
+    def mmiotrace(self, addr, data, write=False, width=2, pc=0, cpu=0, multi=False, queue=False):
+        '''Inject an EVENT.MMIOTRACE as the hypervisor would send it'''
+        flags = (cpu << 16) | width | (write << 5) | (multi << 6)
+        self.send_event(EVENT.MMIOTRACE, struct.pack("<IIQQQ", flags, 0, pc, addr, data),
+                        queue)
+
+    def irqtrace(self, num, type=1, flags=1, queue=False):
+        self.send_event(EVENT.IRQTRACE, struct.pack("<IHH", flags, type, num), queue)
+
+    def _flush_queued(self):
+        if self.queued:
+            frames, self.queued = self.queued, []
+            self._send(b"".join(frames))
+
+    # Request handling
+
+    def _readexact(self, size):
+        data = b""
+        while len(data) < size:
+            block = self.dev.read(size - len(data))
+            if not block:
+                raise EOFError()
+            data += block
+        return data
+
+    def _sync(self):
+        # Look for the ff 55 aa preamble like uartproxy_run() does
+        window = b""
+        while True:
+            window = (window + self._readexact(1))[-4:]
+            if len(window) == 4 and window[:3] == b"\xff\x55\xaa":
+                return window
+
+    def handle(self):
+        '''Process one command from the host'''
+        req = self._sync() + self._readexact(UartInterface.CMD_LEN + 4)
+        rtype, = struct.unpack("<I", req[:4])
+        body = req[4:-4]
+        csum, = struct.unpack("<I", req[-4:])
+        if self.latency:
+            time.sleep(self.latency)
+        self.requests += 1
+        self._flush_queued()
+
+        if checksum(req[:-4]) != csum:
+            self._send(self._reply(rtype, UartInterface.ST_CSUMERR))
+            return
+
+        if rtype == UartInterface.REQ_NOP:
+            features, = struct.unpack("<Q", body[:8])
+            self.features = Feature(features) & Feature.get_all()
+            if self.iodev == IODEV.UART:
+                # Don't allow disabling checksums on UART
+                self.features &= ~Feature.DISABLE_DATA_CSUMS
+            self._send(self._reply(rtype, 0, struct.pack("<Q", self.features.value)))
+        elif rtype == UartInterface.REQ_PROXY:
+            opcode, *args = struct.unpack("<7Q", body)
+            try:
+                status, retval = 0, self.proxy_op(opcode, args)
+            except SimError:
+                status, retval = M1N1Proxy.S_BADCMD, 0
+            self._send(self._reply(rtype, 0, struct.pack("<QqQ", opcode, status,
+                                                         retval & 0xffffffffffffffff)))
+        elif rtype == UartInterface.REQ_MEMREAD:
+            addr, size = struct.unpack("<QQ", body[:16])
+            if size == 0:
+                self._send(self._reply(rtype, 0))
+                return
+            data = self.mem.read(addr, size)
+            frame = self._reply(rtype, 0, struct.pack("<I", self._data_checksum(data))) + data
+            if self.features & Feature.DISABLE_DATA_CSUMS:
+                frame += struct.pack("<I", UartInterface.DATA_END_SENTINEL)
+            self._send(frame)
+        elif rtype == UartInterface.REQ_MEMWRITE:
+            addr, size, dcsum = struct.unpack("<QQI", body[:20])
+            data = self._readexact(size)
+            ccsum = self._data_checksum(data)
+            status = 0
+            if ccsum != dcsum:
+                status = UartInterface.ST_XFERERR
+            elif self.features & Feature.DISABLE_DATA_CSUMS:
+                sentinel, = struct.unpack("<I", self._readexact(4))
+                if sentinel != UartInterface.DATA_END_SENTINEL:
+                    status = UartInterface.ST_XFERERR
+            if status == 0:
+                self.mem.write(addr, data)
+            self._send(self._reply(rtype, status, struct.pack("<I", ccsum)))
+        else:
+            self._send(self._reply(rtype, UartInterface.ST_BADCMD))
+
+    def call(self, addr, args):
+        '''Emulate a P_CALL into a small code stub: mrs/msr (faulting for
+        encodings in undefined_sysregs), ldr/str x, [x, #imm], barriers and
+        ret. Faults are handled according to the exception guard.'''
+        regs = list(args) + [0] * (32 - len(args))
+        pc = addr & self.REGION_MASK
+        for i in range(0x4000):
+            insn, = struct.unpack("<I", self.mem.read(pc, 4))
+            rt = insn & 0x1f
+            rn = (insn >> 5) & 0x1f
+            enc = (2 + ((insn >> 19) & 1), (insn >> 16) & 7, (insn >> 12) & 0xf,
+                   (insn >> 8) & 0xf, (insn >> 5) & 7)
+            fault = False
+            regs[31] = 0
+            if insn == 0xd65f03c0: # ret
+                return regs[0]
+            elif (insn & 0xfff00000) == 0xd5300000: # mrs
+                if enc in self.undefined_sysregs:
+                    fault = True
+                else:
+                    regs[rt] = self.sysregs.get(enc, 0)
+            elif (insn & 0xfff00000) == 0xd5100000: # msr
+                if enc in self.undefined_sysregs:
+                    fault = True
+                else:
+                    self.sysregs[enc] = regs[rt]
+            elif (insn & 0xffc00000) == 0xf9400000: # ldr xt, [xn, #imm]
+                regs[rt] = self.read(regs[rn] + ((insn >> 10) & 0xfff) * 8, 64)
+            elif (insn & 0xffc00000) == 0xf9000000: # str xt, [xn, #imm]
+                self.write(regs[rn] + ((insn >> 10) & 0xfff) * 8, regs[rt], 64)
+            elif (insn & 0xfffff000) == 0xd5033000 or (insn & 0xfffff01f) == 0xd503201f:
+                pass # barriers, hints
+            elif (insn & 0xfff80000) == 0xd5080000:
+                pass # sys (tlbi, dc, ic)
+            else:
+                fault = True
+
+            if fault:
+                self.exc_count += 1
+                guard = self.exc_guard & GUARD.RETURN
+                if guard == GUARD.MARK:
+                    regs[rt] = self.EXC_MARK
+                elif guard != GUARD.SKIP:
+                    # GUARD.OFF would reboot the real thing
+                    return self.EXC_MARK
+            pc += 4
+        self.exc_count += 1
+        return 0
+
+    def _alloc(self, top, align, size):
+        addr = (getattr(self, top) + align - 1) & ~(align - 1)
+        setattr(self, top, addr + max(size, 1))
+        return addr
+
+    def proxy_op(self, op, a):
+        P = M1N1Proxy
+        rd, wr = self.read, self.write
+
+        if op == P.P_NOP:
+            return 0
+        elif op == P.P_EXIT:
+            return 0
+        elif op in (P.P_CALL, P.P_EL0_CALL, P.P_EL1_CALL, P.P_GL1_CALL, P.P_GL2_CALL):
+            return self.call(a[0], a[1:5])
+        elif op == P.P_GET_BOOTARGS:
+            return self.BOOTARGS
+        elif op == P.P_GET_BASE:
+            return self.BASE
+        elif op == P.P_UDELAY:
+            time.sleep(a[0] / 1e6)
+            return 0
+        elif op == P.P_SET_EXC_GUARD:
+            self.exc_count = 0
+            self.exc_guard = a[0]
+            return 0
+        elif op == P.P_GET_EXC_COUNT:
+            count, self.exc_count = self.exc_count, 0
+            return count
+
+        rw = P.P_WRITE64 <= op <= P.P_WRITEREAD8
+        if rw:
+            width = 64 >> ((op - P.P_WRITE64) & 3)
+            mask = (1 << width) - 1
+            kind = (op - P.P_WRITE64) >> 2
+            if kind == 0: # write
+                wr(a[0], a[1], width)
+                return 0
+            elif kind == 1: # read
+                return rd(a[0], width)
+            elif kind == 2: # set
+                val = rd(a[0], width) | (a[1] & mask)
+            elif kind == 3: # clear
+                val = rd(a[0], width) & ~a[1] & mask
+            elif kind == 4: # mask
+                val = (rd(a[0], width) & ~a[1] & mask) | (a[2] & mask)
+            elif kind == 5: # writeread
+                wr(a[0], a[1], width)
+                return rd(a[0], width)
+            wr(a[0], val, width)
+            return val
+
+        if P.P_MEMCPY64 <= op <= P.P_MEMCPY8:
+            self.mem.write(a[0], self.mem.read(a[1], a[2]))
+            return 0
+        elif P.P_MEMSET64 <= op <= P.P_MEMSET8:
+            width = 64 >> (op - P.P_MEMSET64)
+            pattern = (a[1] & ((1 << width) - 1)).to_bytes(width // 8, "little")
+            if pattern == bytes(len(pattern)):
+                self.mem.fill(a[0], 0, a[2])
+            else:
+                self.mem.write(a[0], (pattern * (a[2] // len(pattern) + 1))[:a[2]])
+            return 0
+        elif P.P_IC_IALLUIS <= op <= P.P_DC_CIVAC:
+            if op == P.P_DC_ZVA:
+                self.mem.fill(a[0], 0, a[1])
+            return 0
+        elif op in (P.P_MMU_DISABLE, P.P_MMU_RESTORE, P.P_MMU_INIT, P.P_MMU_SHUTDOWN):
+            return 0
+        elif op == P.P_GZDEC:
+            try:
+                data = zlib.decompress(self.mem.read(a[0], a[1]), 16 + zlib.MAX_WBITS)
+            except zlib.error:
+                return -3 # TINF_DATA_ERROR
+            if len(data) > a[3]:
+                return -5 # TINF_BUF_ERROR
+            self.mem.write(a[2], data)
+            return len(data)
+        elif op == P.P_XZDEC:
+            try:
+                data = lzma.decompress(self.mem.read(a[0], a[1]))
+            except lzma.LZMAError:
+                return -1
+            if a[2]:
+                self.mem.write(a[2], data[:a[3]])
+            return len(data)
+        elif op == P.P_HEAPBLOCK_ALLOC:
+            return self._alloc("heapblock_top", 0x4000, a[0])
+        elif op == P.P_MALLOC:
+            return self._alloc("malloc_top", 0x40, a[0])
+        elif op == P.P_MEMALIGN:
+            return self._alloc("malloc_top", max(a[0], 0x40), a[1])
+        elif op == P.P_IODEV_WHOAMI:
+            return self.iodev
+        elif op in (P.P_IODEV_SET_USAGE, P.P_SMP_SET_WFE_MODE):
+            return 0
+        elif op in (P.P_HV_MAP, P.P_HV_TRACE_IRQ, P.P_HV_MAP_VUART):
+            return 1
+
+        raise SimError(f"Unsupported opcode {op:#x}")
+
+    # Connections
+
+    def serve(self, dev, boot=True):
+        '''Run the proxy loop on a serial-like device until it disconnects'''
+        self.dev = dev
+        self.running = True
+        if boot:
+            self.send_boot()
+        try:
+            while self.running:
+                self.handle()
+        except (EOFError, ConnectionError, OSError):
+            pass
+        finally:
+            self.running = False
+
+    def _start(self, dev):
+        self._thread = threading.Thread(target=self.serve, args=(dev,), daemon=True)
+        self._thread.start()
+
+    def connect(self, timeout=3):
+        '''Start serving on one end of a socketpair and return the other end,
+        ready to be passed to UartInterface'''
+        host, target = socket.socketpair()
+        self._start(SocketTransport.from_socket(target))
+        return SocketTransport.from_socket(host, timeout)
+
+    def serve_pty(self):
+        '''Serve on a new pty. Returns the device string for the host side.'''
+        master, slave = os.openpty()
+        tty.setraw(slave)
+        self._slave = slave # Keep the slave open so the master never sees a hangup
+        from .transport import PtyTransport
+        self._start(PtyTransport(fd=master))
+        return "pty://" + os.ttyname(slave)
+
+    def serve_tcp(self, host="127.0.0.1", port=0):
+        '''Accept connections on a TCP port, one at a time, in the background.
+        Returns the device string for the host side.'''
+        srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        srv.bind((host, port))
+        srv.listen(1)
+
+        def accept_loop():
+            while True:
+                conn, _ = srv.accept()
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self.serve(SocketTransport.from_socket(conn))
+
+        threading.Thread(target=accept_loop, daemon=True).start()
+        host, port = srv.getsockname()
+        return f"tcp://{host}:{port}"
+
+    def stop(self):
+        self.running = False
+        if self.dev is not None:
+            self.dev.close()
+
+def selftest():
+    '''Host stack checks that need a target on the other end'''
+    sim = SimTarget()
+    p = M1N1Proxy(UartInterface(sim.connect()))
+
+    # An event handler issuing a request while a batch is in flight must
+    # not take the reply of a pipelined request
+    base = 0x10000
+    for i in range(4):
+        p.write64(base + 8 * i, 0x1000 + i)
+    p.write64(base + 0x100, 0xdead)
+    seen = []
+    p.iface.set_event_handler(EVENT.MMIOTRACE, lambda data: seen.append(p.read64(base + 0x100)))
+    with p.batch() as b:
+        futures = [b.read64(base + 8 * i) for i in range(4)]
+        sim.mmiotrace(0x1234, 0, queue=True)
+    assert [f.result() for f in futures] == [0x1000 + i for i in range(4)]
+    assert seen == [0xdead]
+
+    sim.stop()
+    print("Self-test passed")
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Stand-in m1n1 proxy target')
+    parser.add_argument('--pty', action="store_true", help="Serve on a new pty")
+    parser.add_argument('--tcp', type=str, metavar="HOST:PORT", help="Serve on a TCP port")
+    parser.add_argument('--latency', type=float, default=0, help="Per-command latency (seconds)")
+    parser.add_argument('--adt', type=argparse.FileType("rb"), help="ADT blob to expose")
+    parser.add_argument('--selftest', action="store_true", help="Run host stack checks and exit")
+    args = parser.parse_args()
+
+    if args.selftest:
+        selftest()
+        raise SystemExit(0)
+
+    sim = SimTarget(adt=args.adt.read() if args.adt else None, latency=args.latency)
+    if args.tcp:
+        host, port = args.tcp.rsplit(":", 1)
+        dev = sim.serve_tcp(host, int(port))
+    else:
+        dev = sim.serve_pty()
+    print(f"Serving on M1N1DEVICE={dev}")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
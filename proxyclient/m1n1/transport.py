@@ -0,0 +1,223 @@
+# SPDX-License-Identifier: MIT
+# Transports for UartInterface. These mimic the subset of the serial.Serial API
+# that the proxy client uses (read/write/timeout/in_waiting/open/close), so a
+# board can be reached through something other than a local tty.
+#
+# Device strings (M1N1DEVICE):
+#   /dev/ttyACM0[:baud]        serial port (default)
+#   serial:///dev/ttyACM0[:baud]
+#   tcp://host:port            e.g. a remote USB bridge (ser2net, socat, ...)
+#   unix:///path/to/socket
+#   pty:///dev/pts/N           raw pty, e.g. a local stand-in target
+#   replay:///path/to/rec[.gz] playback of a recorded session (see m1n1.record)
+import errno, fcntl, os, select, socket, struct, termios, time, tty
+from urllib.parse import urlsplit
+
+__all__ = ["Transport", "SocketTransport", "PtyTransport", "open_transport"]
+
+class Transport:
+    '''Base class for non-serial transports, built around a pollable fd'''
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, timeout=None):
+        self._timeout = timeout
+        self.baudrate = None # Meaningless here, but bootstrap_port sets it
+        self.is_open = False
+        self.open()
+
+    @property
+    def timeout(self):
+        return self._timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self._timeout = timeout
+
+    def fileno(self):
+        raise NotImplementedError()
+
+    def _recv(self, size):
+        raise NotImplementedError()
+
+    def _send(self, data):
+        raise NotImplementedError()
+
+    @property
+    def in_waiting(self):
+        buf = fcntl.ioctl(self.fileno(), termios.FIONREAD, b"\0\0\0\0")
+        return struct.unpack("<I", buf)[0]
+
+    def read(self, size=1):
+        '''Read up to size bytes, waiting at most timeout seconds (forever if None)'''
+        if self._timeout is not None:
+            deadline = time.monotonic() + self._timeout
+        buf = bytearray()
+        while len(buf) < size:
+            if self._timeout is None:
+                wait = None
+            else:
+                wait = max(0, deadline - time.monotonic())
+            r, _, _ = select.select([self.fileno()], [], [], wait)
+            if not r:
+                break
+            block = self._recv(size - len(buf))
+            if not block:
+                raise ConnectionError("Transport closed by remote end")
+            buf += block
+        return bytes(buf)
+
+    def write(self, data):
+        data = memoryview(data).cast("B")
+        while len(data):
+            select.select([], [self.fileno()], [])
+            sent = self._send(data)
+            data = data[sent:]
+
+    def flush(self):
+        pass
+
+    def flushInput(self):
+        timeout = self._timeout
+        self._timeout = 0
+        try:
+            while self.read(self.CHUNK_SIZE):
+                pass
+        finally:
+            self._timeout = timeout
+    reset_input_buffer = flushInput
+
+    def flushOutput(self):
+        pass
+    reset_output_buffer = flushOutput
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+class SocketTransport(Transport):
+    '''TCP or Unix domain socket'''
+    def __init__(self, address, family=socket.AF_INET, timeout=None):
+        self.address = address
+        self.family = family
+        self.sock = None
+        super().__init__(timeout)
+
+    @classmethod
+    def from_socket(cls, sock, timeout=None):
+        '''Wrap an already connected socket (e.g. from accept())'''
+        self = cls.__new__(cls)
+        self.address = None
+        self.family = sock.family
+        self._timeout = timeout
+        self.baudrate = None
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.is_open = True
+        return self
+
+    def open(self):
+        if self.family == socket.AF_UNIX:
+            sock = socket.socket(self.family, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.address)
+            except OSError:
+                sock.close()
+                raise
+        else:
+            # Resolves the host and tries each address, IPv4 or IPv6
+            sock = socket.create_connection(self.address)
+            self.family = sock.family
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setblocking(False)
+        self.sock = sock
+        self.is_open = True
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.is_open = False
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def _recv(self, size):
+        try:
+            return self.sock.recv(size)
+        except BlockingIOError:
+            select.select([self.sock], [], [])
+            return self.sock.recv(size)
+
+    def _send(self, data):
+        try:
+            return self.sock.send(data)
+        except BlockingIOError:
+            return 0
+
+class PtyTransport(Transport):
+    '''A raw pty (or any other character device that does not need serial setup)'''
+    def __init__(self, path=None, fd=None, timeout=None):
+        self.path = path
+        self.fd = fd
+        super().__init__(timeout)
+
+    def open(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+        else:
+            os.set_blocking(self.fd, False)
+        if os.isatty(self.fd):
+            tty.setraw(self.fd)
+        self.is_open = True
+
+    def close(self):
+        if self.fd is not None and self.path is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.is_open = False
+
+    def fileno(self):
+        return self.fd
+
+    def _recv(self, size):
+        try:
+            return os.read(self.fd, size)
+        except BlockingIOError:
+            select.select([self.fd], [], [])
+            return os.read(self.fd, size)
+        except OSError as e:
+            # Linux reports a hung-up pty master/slave as EIO
+            if e.errno == errno.EIO:
+                return b""
+            raise
+
+    def _send(self, data):
+        try:
+            return os.write(self.fd, data)
+        except BlockingIOError:
+            return 0
+
+def open_transport(device, timeout=None):
+    '''Open a transport from a URL-style device string.
+
+    Returns None for plain serial device paths, which are handled by
+    UartInterface itself.'''
+    if "://" not in device:
+        return None
+    url = urlsplit(device)
+    if url.scheme == "tcp":
+        return SocketTransport((url.hostname, url.port), socket.AF_INET, timeout)
+    elif url.scheme == "unix":
+        return SocketTransport(url.path, socket.AF_UNIX, timeout)
+    elif url.scheme == "pty":
+        return PtyTransport(url.path, timeout=timeout)
+    elif url.scheme == "replay":
+        from .record import ReplayDevice
+        return ReplayDevice(url.netloc + url.path, timeout=timeout)
+    elif url.scheme == "serial":
+        return None
+    else:
+        raise ValueError(f"Unknown transport {url.scheme!r} in {device!r}")
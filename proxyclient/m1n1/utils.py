@@ -2,6 +2,7 @@
 from enum import Enum
 import bisect, copy, heapq, importlib, sys, itertools, time, os, functools, struct, re
 from construct import Adapter, Int64ul, Int32ul, Int16ul, Int8ul, ExprAdapter, GreedyRange, ListContainer, StopFieldError, ExplicitError, StreamError
+from construct import Array, FormatField, Hex, Renamed
 
 __all__ = ["FourCC"]
 
@@ -356,28 +357,151 @@ class RegAdapter(Adapter):
     def _encode(self, obj, context, path):
         return obj.value
 
+class StructView:
+    '''Decoded CompiledStruct. Attributes are the struct fields: ints, lists
+    for arrays and Register objects for RegAdapter fields.'''
+    __slots__ = ("_raw",)
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        setattr(self, name, value)
+
+    def _flat(self):
+        vals = []
+        for name, count, reg in self._layout:
+            v = getattr(self, name)
+            if count is not None:
+                vals.extend(v)
+            else:
+                vals.append(int(v) if reg else v)
+        return tuple(vals)
+
+    def changed(self):
+        '''Whether any field differs from the parsed data'''
+        return self._flat() != self._raw
+
+    def __repr__(self):
+        fields = []
+        for name, count, reg in self._layout:
+            v = getattr(self, name)
+            if count is not None:
+                v = "[" + ", ".join(f"{i:#x}" for i in v) + "]"
+            elif not reg:
+                v = f"{v:#x}"
+            fields.append(f"{name}={v}")
+        return f"{type(self).__name__}({', '.join(fields)})"
+
+class CompiledStruct:
+    '''Drop-in replacement for a flat construct Struct of integers, integer
+    arrays and RegAdapter registers, decoded with a single struct.Struct.
+    Hex is accepted as it only changes how values print; any other field
+    type raises TypeError.
+
+    parse() returns a StructView with the same attributes as the construct
+    Container would have, and build() packs one back. Anything else is
+    passed on to the construct Struct.
+
+    Unlike RegAdapter, parse() does not validate register fields, so an
+    invalid enum field value only raises when that field is accessed.'''
+
+    def __init__(self, con):
+        self.con = con
+        fmt = "<"
+        layout = []
+        for sc in con.subcons:
+            if not isinstance(sc, Renamed):
+                raise TypeError(f"Unsupported struct member {sc!r}")
+            name, sub, count, reg = sc.name, sc.subcon, None, None
+            while not isinstance(sub, FormatField):
+                if isinstance(sub, Array):
+                    if count is not None or not isinstance(sub.count, int):
+                        raise TypeError(f"Unsupported array {name}")
+                    count = sub.count
+                elif isinstance(sub, RegAdapter):
+                    reg = sub.reg
+                elif not isinstance(sub, (Hex, Renamed)):
+                    # Other adapters decode values, which would be lost
+                    raise TypeError(f"Unsupported field type {type(sub).__name__} for {name}")
+                sub = sub.subcon
+            if not sub.fmtstr.startswith("<"):
+                raise TypeError(f"Field {name} is not little endian")
+            if count is not None and reg is not None:
+                raise TypeError(f"Unsupported register array {name}")
+            fmt += sub.fmtstr[1:] * (count or 1)
+            layout.append((name, count, reg))
+        self.struct = struct.Struct(fmt)
+        self.view = type("StructView", (StructView,), {
+            "__slots__": tuple(name for name, count, reg in layout),
+            "_layout": tuple(layout),
+        })
+
+    def sizeof(self):
+        return self.struct.size
+
+    def parse(self, data):
+        raw = self.struct.unpack_from(data)
+        obj = self.view.__new__(self.view)
+        obj._raw = raw
+        pos = 0
+        for name, count, reg in obj._layout:
+            if count is not None:
+                setattr(obj, name, list(raw[pos:pos + count]))
+                pos += count
+                continue
+            v = raw[pos]
+            pos += 1
+            if reg is not None:
+                # Skip Register.__init__, which checks every field
+                r = reg.__new__(reg)
+                r._value = v
+                v = r
+            setattr(obj, name, v)
+        return obj
+
+    def build(self, obj):
+        if isinstance(obj, StructView):
+            return self.struct.pack(*obj._flat())
+        return self.con.build(obj)
+
+    def __getattr__(self, attr):
+        return getattr(self.con, attr)
+
 class RangeMap(Reloadable):
+    '''Map from disjoint address ranges to values.
+
+    Ranges are kept sorted in blocks of up to 2 * BLOCK_SIZE entries, each
+    block holding parallel start/end/value lists, with the last end address
+    of every block indexed for bisection. Lookups are O(log n) and updates
+    only shift entries within the blocks they touch.'''
+    BLOCK_SIZE = 256
+
     def __init__(self):
-        self.__start = []
-        self.__end = []
-        self.__value = []
+        self._reset()
+
+    def _reset(self):
+        self.__start = []   # per block: sorted range starts
+        self.__end = []     # per block: inclusive range ends
+        self.__value = []   # per block: values
+        self.__last = []    # last end of each block
+        self.__count = 0
+
+    def _load(self, starts, ends, values):
+        self._reset()
+        n = self.BLOCK_SIZE
+        for i in range(0, len(starts), n):
+            self.__start.append(starts[i:i + n])
+            self.__end.append(ends[i:i + n])
+            self.__value.append(values[i:i + n])
+            self.__last.append(ends[min(i + n, len(ends)) - 1])
+        self.__count = len(starts)
 
     def __len__(self):
-        return len(self.__start)
+        return self.__count
 
     def __nonzero__(self):
-        return bool(self.__start)
-
-    def __contains(self, pos, addr):
-        if pos < 0 or pos >= len(self.__start):
-            return False
-
-        return self.__start[pos] <= addr and addr <= self.__end[pos]
-
-    def __split(self, pos, addr):
-        self.__start.insert(pos + 1, addr)
-        self.__end.insert(pos, addr - 1)
-        self.__value.insert(pos + 1, copy.copy(self.__value[pos]))
+        return bool(self.__count)
 
     def __zone(self, zone):
         if isinstance(zone, slice):
@@ -388,12 +512,107 @@ class RangeMap(Reloadable):
 
         return zone
 
+    def __locate(self, addr):
+        '''(block, index) of the first range ending at or after addr'''
+        b = bisect.bisect_left(self.__last, addr)
+        if b == len(self.__last):
+            return b, 0
+        return b, bisect.bisect_left(self.__end[b], addr)
+
+    def __fixup(self, b):
+        '''Rebalance block b after it changed size'''
+        n = len(self.__start[b])
+        if n > 2 * self.BLOCK_SIZE:
+            h = n // 2
+            for blocks in (self.__start, self.__end, self.__value):
+                block = blocks[b]
+                blocks[b:b + 1] = [block[:h], block[h:]]
+            self.__last[b:b + 1] = [self.__end[b][-1], self.__end[b + 1][-1]]
+        elif n == 0:
+            for blocks in (self.__start, self.__end, self.__value, self.__last):
+                del blocks[b]
+        elif (n < self.BLOCK_SIZE // 2 and b + 1 < len(self.__last) and
+              n + len(self.__start[b + 1]) <= self.BLOCK_SIZE):
+            for blocks in (self.__start, self.__end, self.__value):
+                blocks[b:b + 2] = [blocks[b] + blocks[b + 1]]
+            del self.__last[b]
+        else:
+            self.__last[b] = self.__end[b][-1]
+
+    def __split(self, addr):
+        '''Make sure no range crosses the boundary at addr'''
+        b, i = self.__locate(addr)
+        if b == len(self.__last) or self.__start[b][i] >= addr:
+            return
+        self.__start[b].insert(i + 1, addr)
+        self.__end[b].insert(i, addr - 1)
+        self.__value[b].insert(i + 1, copy.copy(self.__value[b][i]))
+        self.__count += 1
+        self.__fixup(b)
+
+    def __insert(self, start, end, value):
+        '''Add a range, which must not overlap any existing one'''
+        b, i = self.__locate(start)
+        if b == len(self.__last):
+            if not self.__last:
+                self.__start.append([])
+                self.__end.append([])
+                self.__value.append([])
+                self.__last.append(end)
+            b = len(self.__last) - 1
+            i = len(self.__start[b])
+        self.__start[b].insert(i, start)
+        self.__end[b].insert(i, end)
+        self.__value[b].insert(i, value)
+        self.__count += 1
+        self.__fixup(b)
+
+    def __remove(self, zone):
+        '''Drop all ranges within zone (whose edges must already be split)'''
+        b, i = self.__locate(zone.start)
+        while b < len(self.__last):
+            start = self.__start[b]
+            j = bisect.bisect_left(start, zone.stop, i)
+            if j == i:
+                break
+            full = j == len(start)
+            for blocks in (self.__start, self.__end, self.__value):
+                del blocks[b][i:j]
+            self.__count -= j - i
+            if not start:
+                for blocks in (self.__start, self.__end, self.__value, self.__last):
+                    del blocks[b]
+                i = 0
+                continue
+            self.__last[b] = self.__end[b][-1]
+            if not full:
+                break
+            b += 1
+            i = 0
+        if b < len(self.__last):
+            self.__fixup(b)
+
+    def __iter_zone(self, zone):
+        b, i = self.__locate(zone.start)
+        while b < len(self.__last):
+            start, end, value = self.__start[b], self.__end[b], self.__value[b]
+            for k in range(i, len(start)):
+                if start[k] >= zone.stop:
+                    return
+                yield start[k], end[k], value[k]
+            b += 1
+            i = 0
+
     def lookup(self, addr, default=None):
         addr = int(addr)
 
-        pos = bisect.bisect_left(self.__end, addr)
-        if self.__contains(pos, addr):
-            return self.__value[pos]
+        last = self.__last
+        b = bisect.bisect_left(last, addr)
+        if b == len(last):
+            return default
+        i = bisect.bisect_left(self.__end[b], addr)
+        if self.__start[b][i] <= addr:
+            return self.__value[b][i]
         else:
             return default
 
@@ -401,112 +620,68 @@ class RangeMap(Reloadable):
         return self.ranges()
 
     def ranges(self):
-        return (range(s, e + 1) for s, e in zip(self.__start, self.__end))
+        return (range(s, e + 1) for s, e, v in self.__all())
 
     def items(self):
-        return ((range(s, e + 1), v) for s, e, v in zip(self.__start, self.__end, self.__value))
-
-    def _overlap_range(self, zone, split=False):
-        zone = self.__zone(zone)
-        if len(zone) == 0:
-            return 0, 0
-
-        start = bisect.bisect_left(self.__end, zone.start)
+        return ((range(s, e + 1), v) for s, e, v in self.__all())
 
-        if split:
-            # Handle left-side overlap
-            if self.__contains(start, zone.start) and self.__start[start] != zone.start:
-                self.__split(start, zone.start)
-                start += 1
-                assert self.__start[start] == zone.start
-
-        for pos in range(start, len(self.__start)):
-            if self.__start[pos] >= zone.stop:
-                return start, pos
-            if split and (self.__end[pos] + 1) > zone.stop:
-                self.__split(pos, zone.stop)
-                return start, pos + 1
-
-        return start, len(self.__start)
+    def __all(self):
+        for start, end, value in zip(self.__start, self.__end, self.__value):
+            yield from zip(start, end, value)
 
     def populate(self, zone, default=[]):
         zone = self.__zone(zone)
         if len(zone) == 0:
             return
 
-        start, stop = zone.start, zone.stop
-
-        # Starting insertion point, overlap inclusive
-        pos = bisect.bisect_left(self.__end, zone.start)
-
-        # Handle left-side overlap
-        if self.__contains(pos, zone.start) and self.__start[pos] != zone.start:
-            self.__split(pos, zone.start)
-            pos += 1
-            assert self.__start[pos] == zone.start
+        self.__split(zone.start)
+        self.__split(zone.stop)
 
-        # Iterate through overlapping ranges
-        while start < stop:
-            if pos == len(self.__start):
-                # Append to end
+        # Fill the gaps between existing ranges as we go
+        pos = zone.start
+        for s, e, v in list(self.__iter_zone(zone)):
+            if s > pos:
                 val = copy.copy(default)
-                self.__start.append(start)
-                self.__end.append(stop - 1)
-                self.__value.append(val)
-                yield range(start, stop), val
-                break
+                self.__insert(pos, s - 1, val)
+                yield range(pos, s), val
+            yield range(s, e + 1), v
+            pos = e + 1
+        if pos < zone.stop:
+            val = copy.copy(default)
+            self.__insert(pos, zone.stop - 1, val)
+            yield range(pos, zone.stop), val
 
-            assert self.__start[pos] >= start
-            if self.__start[pos] > start:
-                # Insert new range
-                boundary = stop
-                if pos < len(self.__start):
-                    boundary = min(stop, self.__start[pos])
-                val = copy.copy(default)
-                self.__start.insert(pos, start)
-                self.__end.insert(pos, boundary - 1)
-                self.__value.insert(pos, val)
-                yield range(start, boundary), val
-                start = boundary
-            else:
-                # Handle right-side overlap
-                if self.__end[pos] > stop - 1:
-                    self.__split(pos, stop)
-                # Add to existing range
-                yield range(self.__start[pos], self.__end[pos] + 1), self.__value[pos]
-                start = self.__end[pos] + 1
+    def overlaps(self, zone, split=False):
+        zone = self.__zone(zone)
+        if len(zone) == 0:
+            return
 
-            pos += 1
-        else:
-            assert start == stop
+        if split:
+            self.__split(zone.start)
+            self.__split(zone.stop)
 
-    def overlaps(self, zone, split=False):
-        start, stop = self._overlap_range(zone, split)
-        for pos in range(start, stop):
-            yield range(self.__start[pos], self.__end[pos] + 1), self.__value[pos]
+        for s, e, v in list(self.__iter_zone(zone)):
+            yield range(s, e + 1), v
 
     def replace(self, zone, val):
         zone = self.__zone(zone)
         if zone.start == zone.stop:
             return
-        start, stop = self._overlap_range(zone, True)
-        self.__start = self.__start[:start] + [zone.start] + self.__start[stop:]
-        self.__end = self.__end[:start] + [zone.stop - 1] + self.__end[stop:]
-        self.__value = self.__value[:start] + [val] + self.__value[stop:]
+        self.__split(zone.start)
+        self.__split(zone.stop)
+        self.__remove(zone)
+        self.__insert(zone.start, zone.stop - 1, val)
 
     def clear(self, zone=None):
         if zone is None:
-            self.__start = []
-            self.__end = []
-            self.__value = []
+            self._reset()
         else:
             zone = self.__zone(zone)
             if zone.start == zone.stop:
                 return
-            start, stop = self._overlap_range(zone, True)
-            self.__start = self.__start[:start] + self.__start[stop:]
-            self.__end = self.__end[:start] + self.__end[stop:]
-            self.__value = self.__value[:start] + self.__value[stop:]
+            self.__split(zone.start)
+            self.__split(zone.stop)
+            self.__remove(zone)
 
     def compact(self, equal=lambda a, b: a == b, empty=lambda a: not a):
         if len(self) == 0:
@@ -514,8 +689,7 @@ class RangeMap(Reloadable):
 
         new_s, new_e, new_v = [], [], []
 
-        for pos in range(len(self)):
-            s, e, v = self.__start[pos], self.__end[pos], self.__value[pos]
+        for s, e, v in self.__all():
             if empty(v):
                 continue
             if new_v and equal(last, v) and s == new_e[-1] + 1:
@@ -526,11 +700,11 @@ class RangeMap(Reloadable):
                 new_v.append(v)
                 last = v
 
-        self.__start, self.__end, self.__value = new_s, new_e, new_v
+        self._load(new_s, new_e, new_v)
 
     def _assert(self, expect, val=lambda a:a):
         state = []
-        for i, j, v in zip(self.__start, self.__end, self.__value):
+        for i, j, v in self.__all():
             state.append((i, j, val(v)))
         if state != expect:
             print(f"Expected: {expect}")
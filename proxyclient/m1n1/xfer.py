@@ -0,0 +1,150 @@
+# SPDX-License-Identifier: MIT
+import sys, time
+
+from .proxy import UartError, UartTimeout, UartRemoteError
+from .utils import Reloadable
+
+__all__ = ["TransferEngine", "TransferError"]
+
+class TransferError(UartError):
+    pass
+
+class TransferEngine(Reloadable):
+    '''Large readmem/writemem transfers split into independently checksummed chunks.
+
+    A failed chunk is retried on its own after resyncing the link, so a single
+    checksum error or timeout does not lose the whole transfer. The chunk size
+    grows while transfers succeed quickly and shrinks on errors.'''
+
+    MIN_CHUNK = 0x1000
+    MAX_CHUNK = 0x1000000
+    # Aim for chunks that take about this long, so a retry is cheap but the
+    # per-chunk round trip is amortized
+    TARGET_TIME = 0.25
+    GROW_AFTER = 4
+
+    def __init__(self, iface, chunk_size=0x40000, retries=8, verbose=False):
+        self.iface = iface
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.verbose = verbose
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.bytes = 0
+        self.chunks = 0
+        self.errors = 0
+        self.resyncs = 0
+        self.elapsed = 0.0
+
+    @property
+    def throughput(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def stats(self):
+        return {
+            "bytes": self.bytes,
+            "chunks": self.chunks,
+            "errors": self.errors,
+            "resyncs": self.resyncs,
+            "elapsed": self.elapsed,
+            "throughput": self.throughput,
+            "chunk_size": self.chunk_size,
+        }
+
+    def resync(self):
+        '''Get the link back into a known state after a failed chunk'''
+        self.resyncs += 1
+        iface = self.iface
+        for i in range(self.retries):
+            # Drop anything left over from the failed transfer
+            iface.reader.reset()
+            timeout = iface.dev.timeout
+            iface.dev.timeout = 0.1
+            try:
+                while iface.dev.read(0x10000):
+                    pass
+            finally:
+                iface.dev.timeout = timeout
+            try:
+                iface.nop()
+                return
+            except UartError:
+                # The target may still be waiting for the rest of a write;
+                # pad it out (stray zeros are ignored outside of a command)
+                iface.dev.write(bytes(self.chunk_size))
+        raise TransferError("Unable to resync proxy link")
+
+    def _adapt(self, ok, size, dt, streak):
+        if not ok:
+            self.chunk_size = max(self.MIN_CHUNK, self.chunk_size // 2)
+        elif (streak >= self.GROW_AFTER and size == self.chunk_size and
+              dt < self.TARGET_TIME / 2):
+            self.chunk_size = min(self.MAX_CHUNK, self.chunk_size * 2)
+
+    def _run(self, total, do_chunk, progress):
+        off = 0
+        streak = 0
+        start = time.time()
+        while off < total:
+            size = min(self.chunk_size, total - off)
+            for attempt in range(self.retries + 1):
+                t = time.time()
+                try:
+                    do_chunk(off, size)
+                except UartError as e:
+                    self.errors += 1
+                    streak = 0
+                    if self.verbose:
+                        print(f"Chunk at +{off:#x} ({size:#x} bytes) failed: {e!r}")
+                    if attempt == self.retries:
+                        raise TransferError(f"Chunk at +{off:#x} failed after "
+                                            f"{self.retries} retries") from e
+                    if not isinstance(e, UartRemoteError):
+                        # Remote errors come with a full reply, so the link is in sync
+                        self.resync()
+                    self._adapt(False, size, 0, 0)
+                    size = min(self.chunk_size, total - off)
+                else:
+                    dt = time.time() - t
+                    streak += 1
+                    self._adapt(True, size, dt, streak)
+                    break
+
+            off += size
+            self.chunks += 1
+            self.bytes += size
+            if progress:
+                elapsed = time.time() - start
+                rate = off / elapsed if elapsed else 0
+                if callable(progress):
+                    progress(off, total, rate)
+                else:
+                    sys.stdout.write(f"\r{off / 1048576:8.2f} / {total / 1048576:.2f} MiB "
+                                     f"({rate / 1048576:.2f} MiB/s, {self.errors} errors)")
+                    sys.stdout.flush()
+
+        self.elapsed += time.time() - start
+        if progress and not callable(progress):
+            print()
+
+    def readmem(self, addr, size, progress=False):
+        '''Read size bytes from addr. progress may be True (print) or a
+        callable taking (done, total, bytes_per_second).'''
+        buf = bytearray(size)
+
+        def do_chunk(off, chunk):
+            buf[off:off + chunk] = self.iface.readmem(addr + off, chunk)
+
+        self._run(size, do_chunk, progress)
+        return bytes(buf)
+
+    def writemem(self, addr, data, progress=False):
+        '''Write data to addr. progress may be True (print) or a callable
+        taking (done, total, bytes_per_second).'''
+        data = memoryview(data).cast("B")
+
+        def do_chunk(off, chunk):
+            self.iface.writemem(addr + off, data[off:off + chunk])
+
+        self._run(len(data), do_chunk, progress)
@@ -23,12 +23,14 @@ new_base = u.base
 
 if args.raw:
     image = args.payload.read_bytes()
-    image += b"\x00\x00\x00\x00"
+    extents = [(0, image), (len(image), 4)]
+    image_len = len(image) + 4
     entry = new_base + 0x800
 else:
     macho = MachO(args.payload.read_bytes())
-    image = macho.prepare_image()
-    image += b"\x00\x00\x00\x00"
+    extents, image_len = macho.prepare_extents()
+    extents.append((image_len, 4))
+    image_len += 4
     entry = macho.entry
     entry -= macho.vmin
     entry += new_base
@@ -43,7 +45,7 @@ if args.no_sepfw:
 else:
     sepfw_start, sepfw_length = u.adt["chosen"]["memory-map"].SEPFW
 
-image_size = align(len(image))
+image_size = align(image_len)
 sepfw_off = image_size
 image_size += align(sepfw_length)
 bootargs_off = image_size
@@ -53,9 +55,9 @@ image_size += bootargs_size
 print(f"Total region size: 0x{image_size:x} bytes")
 image_addr = u.malloc(image_size)
 
-print(f"Loading kernel image (0x{len(image):x} bytes)...")
-u.compressed_writemem(image_addr, image, True)
-p.dc_cvau(image_addr, len(image))
+print(f"Loading kernel image (0x{image_len:x} bytes)...")
+u.write_extents(image_addr, extents, True)
+p.dc_cvau(image_addr, image_len)
 
 if not args.no_sepfw:
     print(f"Copying SEPFW (0x{sepfw_length:x} bytes)...")
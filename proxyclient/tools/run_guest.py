@@ -14,6 +14,7 @@ parser.add_argument('-e', '--hook-exceptions', action="store_true")
 parser.add_argument('-d', '--debug-xnu', action="store_true")
 parser.add_argument('-l', '--logfile', type=pathlib.Path)
 parser.add_argument('-C', '--cpus', default=None)
+parser.add_argument('-Q', '--tracer-queue', choices=("drop", "coalesce", "block"), default=None)
 parser.add_argument('payload', type=pathlib.Path)
 parser.add_argument('boot_args', default=[], nargs="*")
 args = parser.parse_args()
@@ -35,6 +36,9 @@ hv.hook_exceptions = args.hook_exceptions
 
 hv.init()
 
+if args.tracer_queue:
+    hv.enable_tracer_queue(policy=args.tracer_queue)
+
 if args.cpus:
     avail = [i.name for i in hv.adt["/cpus"]]
     want = set(f"cpu{i}" for i in args.cpus)